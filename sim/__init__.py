@@ -0,0 +1,11 @@
+"""Host-side simulation of the Kyupad hardware for running the firmware on a PC.
+
+hardware.py provides stand-ins for the CircuitPython modules (board, digitalio,
+usb_hid, keypad, supervisor, alarm, adafruit_ble, ...) built around a virtual
+clock, a scripted 4x4 matrix, a scripted USB cable and BLE host, and recording
+HID sinks. harness.py boots the unmodified src/temp_code.py on top of them.
+bench.py is the benchmark suite and checks.py the regression checks.
+"""
+from .hardware import (VirtualClock, VirtualMatrix, HidSink, VirtualUsbPort, VirtualBleRadio, StopSimulation,
+                       open_pty_pair)
+from .harness import Simulation, make_keymap
@@ -0,0 +1,470 @@
+"""Benchmarks for KyupadFirmware on simulated hardware.
+
+Run from the repository root:
+
+    python -m sim.bench [--backend gpio|keymatrix] [--presses N] [--scans N]
+
+Latency and timing numbers are in simulated time, so they show what the
+firmware's scheduling and sleeps allow, independent of the host. Scan
+throughput is host CPU time and is only comparable between runs on the same
+machine. Allocations are CPython's; on the device use debug_alloc_check_scans.
+"""
+import argparse
+import difflib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from .hardware import open_pty_pair
+from .harness import Simulation, make_keymap, SRC_DIR
+
+# Tap spacing that does not line up with the scan period
+TAP_INTERVAL_MS = 237
+
+TIMING_MACRO = [
+    {'keys': ['A'], 'delay': 0},
+    {'keys': ['B'], 'delay': 100},
+    {'keys': ['Ctrl_press', 'C_press', 'C_release', 'Ctrl_release'], 'delay': 250},
+    {'keys': ['D'], 'delay': 40},
+    {'keys': ['E'], 'delay': 500},
+]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return "no samples"
+    mean = sum(values) / len(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return f"min {values[0]:.2f} mean {mean:.2f} p95 {p95:.2f} max {values[-1]:.2f}"
+
+
+def first_press_after(hid, keycode, after_ns):
+    """Send time of the first report after after_ns that holds keycode"""
+    for sent_ns, report in hid.reports:
+        if sent_ns >= after_ns and keycode in hid.keys_down(report):
+            return sent_ns
+    return None
+
+
+def count_presses(hid, keycode):
+    """Reports that newly hold keycode"""
+    presses = 0
+    held = False
+    for _, report in hid.reports:
+        down = keycode in hid.keys_down(report)
+        if down and not held:
+            presses += 1
+        held = down
+    return presses
+
+
+def bench_scan_throughput(backend, scans):
+    sim = Simulation(make_keymap({}, scanner_backend=backend))
+    firmware = sim.firmware
+    with sim.firmware_context():
+        start = time.perf_counter()
+        for _ in range(scans):
+            firmware.scan_matrix()
+        elapsed = time.perf_counter() - start
+    sim.close()
+    print(f"Scan throughput ({backend}): {scans / elapsed:,.0f} scans/s on host, "
+          f"{elapsed / scans * 1_000_000:.1f}us per scan_matrix()")
+
+
+def bench_press_latency(backend, presses):
+    # Keycode 0x04 is 'A'
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}, scanner_backend=backend))
+    press_times = []
+    for tap in range(presses):
+        at_ms = 100 + tap * TAP_INTERVAL_MS
+        sim.matrix.tap(at_ms, 0, hold_ms=60)
+        press_times.append(sim.clock.ns + at_ms * 1_000_000)
+    sim.run(200 + presses * TAP_INTERVAL_MS)
+
+    latencies = []
+    missed = 0
+    for press_ns in press_times:
+        sent_ns = first_press_after(sim.hid, 0x04, press_ns)
+        if sent_ns is None or sent_ns - press_ns > TAP_INTERVAL_MS * 1_000_000:
+            missed += 1
+        else:
+            latencies.append((sent_ns - press_ns) / 1_000_000)
+    sim.close()
+    print(f"Press to report ({backend}, {presses} taps): {summarize(latencies)} ms"
+          + (f", {missed} taps without a report" if missed else ""))
+
+
+def bench_macro_timing(backend):
+    sim = Simulation(make_keymap({0: TIMING_MACRO}, scanner_backend=backend))
+    expected = expected_press_offsets(sim.firmware_module, TIMING_MACRO)
+    sim.matrix.tap(100, 0, hold_ms=60)
+    sim.run(100 + sum(action['delay'] for action in TIMING_MACRO) + 500)
+
+    start_ns = None
+    errors = []
+    after_ns = 0
+    for keycode, expected_ms in expected:
+        sent_ns = first_press_after(sim.hid, keycode, after_ns)
+        if sent_ns is None:
+            print(f"Macro timing ({backend}): keycode 0x{keycode:02X} was never sent")
+            sim.close()
+            return
+        if start_ns is None:
+            start_ns = sent_ns
+        errors.append((sent_ns - start_ns) / 1_000_000 - expected_ms)
+        after_ns = sent_ns
+    sim.close()
+    print(f"Macro timing error ({backend}, {len(errors)} presses vs JSON delays): {summarize(errors)} ms")
+
+
+def expected_press_offsets(firmware_module, macro):
+    """(keycode, ms after the first press) for every press in the compiled macro"""
+    steps = firmware_module.compile_macro(macro, 1.0, firmware_module.DEFAULT_MIN_HOLD_MS)
+    offsets = []
+    elapsed_ms = 0
+    for delay, op, keycode in steps:
+        elapsed_ms += delay
+        if op == firmware_module.OP_PRESS:
+            offsets.append((keycode, elapsed_ms))
+    first_ms = offsets[0][1]
+    return [(keycode, offset - first_ms) for keycode, offset in offsets]
+
+
+def bench_macro_reports():
+    """HID reports per macro against one report per key event, which is what the step count is"""
+    chord = [{'keys': ['Ctrl_press', 'Shift_press', 'Alt_press', 'K_press',
+                       'K_release', 'Alt_release', 'Shift_release', 'Ctrl_release'], 'delay': 0}]
+    sim = Simulation(make_keymap({0: chord, 1: TIMING_MACRO}))
+    sim.matrix.tap(100, 0, hold_ms=60)
+    sim.matrix.tap(300, 1, hold_ms=60)
+    sim.run(300 + sum(action['delay'] for action in TIMING_MACRO) + 500)
+    scheduler = sim.firmware.macro_scheduler
+    results = [f"{label} {scheduler.report_counts[button]} vs {scheduler.step_counts[button]}"
+               for label, button in (("Ctrl+Shift+Alt+K", 0), ("timing macro", 1))]
+    sim.close()
+    print(f"Macro reports (merged vs one per key event): {', '.join(results)}")
+
+
+def bench_scan_allocations(backend, scans):
+    sim = Simulation(make_keymap({}, scanner_backend=backend))
+    firmware = sim.firmware
+    transient = []
+    with sim.firmware_context():
+        # Warm up so one-time allocations are not counted
+        for _ in range(100):
+            firmware.scan_matrix()
+        tracemalloc.start()
+        start_current, _ = tracemalloc.get_traced_memory()
+        for _ in range(scans):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            firmware.scan_matrix()
+            _, peak = tracemalloc.get_traced_memory()
+            transient.append(peak - before)
+        end_current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    sim.close()
+    print(f"Allocations per scan ({backend}): {summarize(transient)} bytes peak, "
+          f"{(end_current - start_current) / scans:.1f} bytes retained")
+
+
+def bench_ble_reconnect():
+    """Host drops the link for 500ms while two keys are tapped, then comes back"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}, connection_mode='bluetooth'))
+    sim.radio.host_arrives(50)
+    sim.radio.host_leaves(1000)
+    sim.radio.host_arrives(1500)
+    for at_ms in (500, 1200, 1400):
+        sim.matrix.tap(at_ms, 0, hold_ms=60)
+    sim.run(3000)
+
+    link = sim.firmware.ble_link
+    presses = count_presses(sim.ble_hid, 0x04)
+    intervals = sorted(set([int(interval * 1000) for _, interval in sim.radio.advertising_log]))
+    connection_interval = sim.radio.connections[0].connection_interval if sim.radio.connections else None
+    sim.close()
+    print(f"BLE reconnect: {link.last_reconnect_ms}ms, {link.buffered_keys} keys buffered, "
+          f"{link.dropped_keys} dropped, {presses}/3 taps sent, advertising intervals {intervals}ms, "
+          f"connection interval {connection_interval}ms")
+
+
+def bench_transport_failover():
+    """Auto mode: USB unplugged and replugged with BLE standing by, then an outage with neither"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}, connection_mode='auto'))
+    sim.radio.host_arrives(50)
+    sim.usb.unplug(1000)
+    sim.usb.plug(2000)
+    sim.radio.host_leaves(2500)
+    sim.usb.unplug(3000)
+    sim.radio.host_arrives(3200)
+    taps = (500, 1200, 2200, 3100, 3600)
+    for at_ms in taps:
+        sim.matrix.tap(at_ms, 0, hold_ms=60)
+    sim.run(4000)
+
+    transport = sim.firmware.transport
+    usb_presses = count_presses(sim.hid, 0x04)
+    ble_presses = count_presses(sim.ble_hid, 0x04)
+    sim.close()
+    print(f"Transport failover: {transport.switches} switches, last {transport.last_switch_ms}ms "
+          f"max {transport.max_switch_ms}ms, {transport.no_transport_ms}ms without a transport, "
+          f"{usb_presses + ble_presses}/{len(taps)} taps sent ({usb_presses} USB, {ble_presses} BLE)")
+
+
+def bench_live_keymap(frames):
+    """Editor client pushes button deltas to the running firmware through a pty"""
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    # Imported before the stand-ins are installed so the client keeps the real time module
+    from keymap_live import LiveKeymapClient
+    from keymap_format import STATUS_OK
+
+    device_end, host_end = open_pty_pair()
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}), cdc_data=device_end)
+    client = LiveKeymapClient(host_end)
+    sim.start()
+    round_trips = []
+    failed = 0
+    try:
+        for frame in range(frames):
+            macro = [{'keys': ['Ctrl', chr(ord('A') + frame % 26)], 'delay': 0}, {'keys': ['Enter'], 'delay': 20}]
+            status, _ = client.send_button(frame % 16, {'name': f'Live {frame}', 'macro': macro},
+                                                  persist=frame == frames - 1)
+            if status != STATUS_OK:
+                failed += 1
+            round_trips.append(client.last_round_trip_s * 1000)
+    finally:
+        sim.stop()
+        client.close()
+        device_end.close()
+
+    # The firmware's own apply timer runs on the simulated clock, so time the apply on the host
+    firmware = sim.firmware
+    button_data = {'name': 'Timed', 'macro': [{'keys': ['Ctrl', 'Shift', 'Escape'], 'delay': 0}] * 8}
+    with sim.firmware_context():
+        start = time.perf_counter()
+        for _ in range(200):
+            firmware.apply_button_delta(1, button_data)
+        apply_ms = (time.perf_counter() - start) / 200 * 1000
+    with open(os.path.join(sim.workdir.name, 'keymap.json'), encoding='utf-8') as f:
+        persisted = json.load(f)['buttons'][str((frames - 1) % 16)]['name'] == f'Live {frames - 1}'
+    sim.close()
+    print(f"Live keymap ({frames} button deltas over a pty, host wall time): round trip {summarize(round_trips)} ms, "
+          f"apply {apply_ms:.3f}ms on host, {failed} not applied, persisted {'yes' if persisted else 'no'}")
+
+
+def recorded_keymap(actions_per_button):
+    """keymap.json as the editor writes it after long recordings"""
+    keys = ('Ctrl', 'Shift', 'A', 'S', 'D', 'F', 'Space', 'Enter')
+    buttons = {}
+    for button_index in range(16):
+        macro = []
+        for action in range(actions_per_button):
+            key = keys[(button_index + action) % len(keys)]
+            macro.append({'keys': [f'{key}_press' if action % 2 == 0 else f'{key}_release'], 'delay': 7 + action % 40})
+        buttons[str(button_index)] = {
+            'name': f'Recording {button_index + 1}',
+            'description': f'Recorded sequence {button_index + 1} ' * 12,
+            'macro': macro,
+            'button_color': '#3A7BD5',
+        }
+    keymap_data = make_keymap({})
+    keymap_data['buttons'] = buttons
+    return json.dumps(keymap_data, indent=2).encode('utf-8')
+
+
+def measure_heap(load, source):
+    """(result, peak bytes, retained bytes) of load(file) under tracemalloc"""
+    tracemalloc.start()
+    result = load(io.BytesIO(source))
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, retained
+
+
+def measure_time(load, source, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        load(io.BytesIO(source))
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_keymap_heap(actions_per_button):
+    """json.load against the streaming loader on a keymap of long recorded macros"""
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    from keymap_format import load_keymap_stream, compile_macro, DEFAULT_MIN_HOLD_MS
+
+    def load_and_compile(f):
+        """What the firmware keeps: compiled steps, plus names and settings"""
+        keymap_data = load_keymap_stream(f)
+        compiled = []
+        for button_data in keymap_data['buttons'].values():
+            compiled.append(tuple(compile_macro(button_data.pop('macro', []), 1.0, DEFAULT_MIN_HOLD_MS)))
+        return keymap_data, compiled
+
+    source = recorded_keymap(actions_per_button)
+    full, full_peak, full_retained = measure_heap(json.load, source)
+    streamed, stream_peak, stream_retained = measure_heap(load_keymap_stream, source)
+    _, compiled_peak, compiled_retained = measure_heap(load_and_compile, source)
+    same_macros = all(streamed['buttons'][key]['macro'] == button['macro'] for key, button in full['buttons'].items())
+    print(f"Keymap load ({len(source) // 1024}KB keymap.json, {actions_per_button} actions per button, CPython heap):\n"
+          f"  json.load: peak {full_peak // 1024}KB, retained {full_retained // 1024}KB, "
+          f"{measure_time(json.load, source):.1f}ms\n"
+          f"  streaming: peak {stream_peak // 1024}KB, retained {stream_retained // 1024}KB, "
+          f"{measure_time(load_keymap_stream, source):.1f}ms"
+          + ("" if same_macros else " (MACROS DIFFER)") + "\n"
+          f"  streaming + compile: peak {compiled_peak // 1024}KB, retained {compiled_retained // 1024}KB")
+
+
+def layered_keymap(layer_count):
+    """Layer i types letter i on buttons 0-14; button 15 steps to the next layer"""
+    layers = []
+    for layer_index in range(layer_count):
+        letter = chr(ord('A') + layer_index)
+        buttons = {}
+        for button_index in range(15):
+            buttons[str(button_index)] = {'name': f'{letter}{button_index}',
+                                          'macro': [{'keys': [letter], 'delay': 0}]}
+        buttons['15'] = {'name': 'Next layer', 'layer': 'next', 'macro': []}
+        layers.append({'name': f'Layer {letter}', 'buttons': buttons})
+    keymap = make_keymap({})
+    keymap['buttons'] = layers[0]['buttons']
+    keymap['layers'] = layers[1:]
+    return keymap
+
+
+def bench_layers(layer_count):
+    """Layer key taps followed by a tap on button 0, which has to type the new layer's letter"""
+    sim = Simulation(layered_keymap(layer_count))
+    press_times = []
+    for switch in range(1, layer_count + 1):
+        at_ms = 100 + switch * 2 * TAP_INTERVAL_MS
+        sim.matrix.tap(at_ms, 15, hold_ms=60)
+        sim.matrix.tap(at_ms + TAP_INTERVAL_MS, 0, hold_ms=60)
+        # Keycode of the letter on the layer this switch lands on
+        press_times.append((0x04 + switch % layer_count, sim.clock.ns + (at_ms + TAP_INTERVAL_MS) * 1_000_000))
+    sim.run(200 + (layer_count + 1) * 2 * TAP_INTERVAL_MS)
+
+    latencies = []
+    wrong = 0
+    for keycode, press_ns in press_times:
+        sent_ns = first_press_after(sim.hid, keycode, press_ns)
+        if sent_ns is None or sent_ns - press_ns > TAP_INTERVAL_MS * 1_000_000:
+            wrong += 1
+        else:
+            latencies.append((sent_ns - press_ns) / 1_000_000)
+    firmware = sim.firmware
+    switches = firmware.layer_key_switches
+
+    # Simulated time stands still inside a call, so the switch itself is timed on the host
+    with sim.firmware_context():
+        start = time.perf_counter()
+        for _ in range(10000):
+            firmware.switch_layer(sim.firmware_module.LAYER_NEXT)
+        switch_us = (time.perf_counter() - start) / 10000 * 1_000_000
+
+        # Heap of the compiled layers, from a fresh load of the same keymap.json
+        with open('keymap.json', 'rb') as f:
+            firmware.keymap = sim.firmware_module.load_keymap_stream(f)
+        tracemalloc.start()
+        layers = firmware.compile_layers()
+        compiled_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    sim.close()
+    print(f"Layers ({len(layers)} layers, {switches} switches by layer key): switch_layer() {switch_us:.2f}us "
+          f"on host, press to report on the new layer {summarize(latencies)} ms"
+          + (f", {wrong} taps on the wrong layer" if wrong else "") +
+          f", {compiled_bytes / len(layers) / 1024:.1f}KB per compiled layer (CPython heap)")
+
+
+TYPING_TEXT = ("The quick brown fox jumps over the lazy dog! PACK MY BOX WITH FIVE DOZEN LIQUOR JUGS. "
+               "Sphinx of black quartz, judge my vow: {tabs=4; \"quotes\" & [brackets]} ~/path_to/file.txt?\n")
+
+
+def host_typed_text(hid, poll_ms):
+    """Text a host sees when it samples the keyboard state every poll_ms.
+
+    A report replaced by the next one before the host polls is lost, which is
+    how a too-fast press and release of one character goes missing.
+    """
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    from keymap_format import TEXT_UNSHIFTED as unshifted, TEXT_SHIFTED as shifted, TEXT_FIRST_USAGE as first_usage
+
+    if not hid.reports:
+        return ""
+    typed = []
+    held = set()
+    index = 0
+    state = bytes(8)
+    poll_ns = hid.reports[0][0]
+    end_ns = hid.reports[-1][0] + poll_ms * 1_000_000
+    while poll_ns <= end_ns:
+        while index < len(hid.reports) and hid.reports[index][0] <= poll_ns:
+            state = hid.reports[index][1]
+            index += 1
+        down = set(keycode for keycode in state[2:] if keycode)
+        table = shifted if state[0] & 0x22 else unshifted
+        for keycode in sorted(down - held):
+            if 0 <= keycode - first_usage < len(table):
+                typed.append(table[keycode - first_usage])
+        held = down
+        poll_ns += poll_ms * 1_000_000
+    return "".join(typed)
+
+
+def bench_text_typing(rates, repeats):
+    """Sustained rate of a text action and the characters a polling host would miss"""
+    text = TYPING_TEXT * repeats
+    for cps in rates:
+        sim = Simulation(make_keymap({0: [{'action': 'text', 'text': text, 'delay': 0}]}, text_cps=cps))
+        sim.matrix.tap(100, 0, hold_ms=60)
+        # Generous upper bound on the playback time
+        sim.run(200 + len(text) * max(1000 // cps, 2 * sim.firmware_module.DEFAULT_MIN_HOLD_MS + 1) * 2)
+        reports = sim.hid.reports
+        elapsed_s = (reports[-1][0] - reports[0][0]) / 1e9 if len(reports) > 1 else 0
+        results = []
+        for label, poll_ms in (("USB 1ms", 1), ("USB 8ms", 8), ("BLE 15ms", 15)):
+            typed = host_typed_text(sim.hid, poll_ms)
+            matched = sum(block.size for block in difflib.SequenceMatcher(None, text, typed, autojunk=False)
+                          .get_matching_blocks())
+            results.append(f"{label} {100 * (len(text) - matched) / len(text):.1f}%")
+        sim.close()
+        print(f"Text typing ({len(text)} chars, text_cps {cps}): sustained {len(text) / elapsed_s:.1f} cps, "
+              f"{len(reports)} reports, dropped: {', '.join(results)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark KyupadFirmware on simulated hardware")
+    parser.add_argument('--backend', choices=('gpio', 'keymatrix'), action='append',
+                        help="scanner backend to benchmark (repeatable, default both)")
+    parser.add_argument('--presses', type=int, default=50, help="taps for the latency benchmark")
+    parser.add_argument('--scans', type=int, default=20000, help="scans for throughput and allocations")
+    parser.add_argument('--frames', type=int, default=50, help="deltas for the live keymap benchmark")
+    parser.add_argument('--actions', type=int, default=400, help="recorded actions per button for the keymap load benchmark")
+    parser.add_argument('--layers', type=int, default=8, help="layers for the layer switch benchmark")
+    parser.add_argument('--cps', type=int, action='append', help="text_cps for the typing benchmark (repeatable)")
+    args = parser.parse_args()
+
+    for backend in args.backend or ('gpio', 'keymatrix'):
+        bench_scan_throughput(backend, args.scans)
+        bench_press_latency(backend, args.presses)
+        bench_macro_timing(backend)
+        bench_scan_allocations(backend, min(args.scans, 2000))
+    bench_macro_reports()
+    bench_ble_reconnect()
+    bench_transport_failover()
+    bench_keymap_heap(args.actions)
+    bench_layers(args.layers)
+    bench_text_typing(args.cps or (30, 60, 120), 2)
+    if os.name == 'posix':
+        bench_live_keymap(args.frames)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+"""Regression checks for KyupadFirmware on simulated hardware.
+
+Run from the repository root:
+
+    python -m sim.checks [name ...]
+
+Each check scripts a scenario, runs the real firmware and asserts on what
+the host would have seen. The exit status is non-zero if any check fails.
+"""
+import json
+import os
+import sys
+import traceback
+
+from .bench import count_presses, first_press_after
+from .harness import Simulation, make_keymap, SRC_DIR
+
+# Keycodes as sent in HID reports
+KEY_A = 0x04
+KEY_B = 0x05
+KEY_C = 0x06
+KEY_SPACE = 0x2C
+LEFT_CTRL = 0xE0
+
+
+def check_legacy_string_macro():
+    """A "Ctrl+C" string macro loads next to keys-array macros instead of failing the whole keymap"""
+    sim = Simulation(make_keymap({0: "Ctrl+C", 1: [{'keys': ['B'], 'delay': 0}]}))
+    try:
+        sim.matrix.tap(100, 0, hold_ms=60)
+        sim.matrix.tap(400, 1, hold_ms=60)
+        start_ns = sim.clock.ns
+        sim.run(800)
+        log = sim.log.getvalue()
+        assert "Error loading keymap" not in log, log
+        assert first_press_after(sim.hid, KEY_SPACE, start_ns) is None, "fallback keymap was loaded"
+        ctrl_c = [keys for _, report in sim.hid.reports for keys in [sim.hid.keys_down(report)]
+                  if KEY_C in keys]
+        assert ctrl_c and LEFT_CTRL in ctrl_c[0], "button 1 did not send Ctrl+C"
+        assert first_press_after(sim.hid, KEY_B, start_ns) is not None, "button 2 did not send B"
+    finally:
+        sim.close()
+
+
+def keymap_format():
+    """The editor's and firmware's shared keymap_format module from src/"""
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    import keymap_format
+    return keymap_format
+
+
+def pack_keymap(keymap_data):
+    """keymap.bin for keymap_data as the Simulation writes it to keymap.json"""
+    return keymap_format().pack_keymap(keymap_data, json.dumps(keymap_data).encode('utf-8'))
+
+
+def check_keymap_bin_same_size_edit():
+    """A keymap.json edit that keeps its size still makes the pad skip the old keymap.bin"""
+    old_keymap = make_keymap({0: [{'keys': ['A'], 'delay': 0}]})
+    new_keymap = make_keymap({0: [{'keys': ['B'], 'delay': 0}]})
+    assert len(json.dumps(old_keymap)) == len(json.dumps(new_keymap))
+    sim = Simulation(new_keymap, files={'keymap.bin': pack_keymap(old_keymap)})
+    try:
+        assert sim.firmware.keymap_bin is None, "stale keymap.bin was used"
+        start_ns = sim.clock.ns
+        sim.matrix.tap(100, 0, hold_ms=60)
+        sim.run(400)
+        assert first_press_after(sim.hid, KEY_B, start_ns) is not None, "button 1 did not send B"
+        assert first_press_after(sim.hid, KEY_A, start_ns) is None, "button 1 sent the old A"
+    finally:
+        sim.close()
+
+
+def check_keymap_bin_debounce_override():
+    """Per-button debounce_ms overrides apply when the pad boots from keymap.bin"""
+    keymap_data = make_keymap({0: [{'keys': ['A'], 'delay': 0}]}, debounce_ms=40)
+    keymap_data['buttons']['3']['debounce_ms'] = 5
+    sim = Simulation(keymap_data, files={'keymap.bin': pack_keymap(keymap_data)})
+    try:
+        assert sim.firmware.keymap_bin is not None, "matching keymap.bin was not used"
+        debounce_ms = list(sim.firmware.debouncer.debounce_ms)
+        assert debounce_ms[3] == 5 and debounce_ms[0] == 40, debounce_ms
+    finally:
+        sim.close()
+
+
+def check_keymap_bin_max_layers():
+    """keymap.bin packs and loads with MAX_LAYERS layers, and a key on the last one plays from it"""
+    max_layers = keymap_format().MAX_LAYERS
+    keymap_data = make_keymap({0: [{'keys': ['A'], 'delay': 0}]})
+    button = {'name': 'B', 'macro': [{'keys': ['B'], 'delay': 0}]}
+    keymap_data['layers'] = [{'name': f'L{layer_index}', 'buttons': {'0': button}}
+                             for layer_index in range(1, max_layers)]
+    sim = Simulation(keymap_data, files={'keymap.bin': pack_keymap(keymap_data)})
+    try:
+        firmware = sim.firmware
+        assert firmware.keymap_bin is not None, "keymap.bin was not used"
+        assert len(firmware.layer_names) == max_layers, firmware.layer_names
+        sim.call(firmware.select_layer, f'L{max_layers - 1}')
+        start_ns = sim.clock.ns
+        sim.matrix.tap(100, 0, hold_ms=60)
+        sim.run(400)
+        assert first_press_after(sim.hid, KEY_B, start_ns) is not None, "the last layer's key did not send B"
+    finally:
+        sim.close()
+
+
+def check_persisted_delta_replaces_keymap_bin():
+    """A persisted live button change survives a reboot even when keymap.json keeps its size"""
+    keymap_data = make_keymap({0: [{'keys': ['A'], 'delay': 0}], 1: [{'keys': ['C'], 'delay': 0}]})
+    sim = Simulation(keymap_data, files={'keymap.bin': pack_keymap(keymap_data)})
+    try:
+        assert sim.firmware.keymap_bin is not None, "matching keymap.bin was not used"
+        changed = dict(keymap_data['buttons']['0'], macro=[{'keys': ['B'], 'delay': 0}])
+        sim.call(sim.firmware.apply_button_delta, 0, changed)
+        sim.call(sim.firmware.persist_delta, sim.firmware_module.FRAME_BUTTON, {'button': 0, 'data': changed})
+        # Buttons that were still read from keymap.bin keep working
+        start_ns = sim.clock.ns
+        sim.matrix.tap(100, 1, hold_ms=60)
+        sim.run(400)
+        assert first_press_after(sim.hid, KEY_C, start_ns) is not None, "button 2 lost its macro"
+        files = {}
+        for name in os.listdir(sim.workdir.name):
+            with open(os.path.join(sim.workdir.name, name), 'rb') as f:
+                files[name] = f.read()
+    finally:
+        sim.close()
+    assert 'keymap.bin' not in files, "keymap.bin was left behind"
+    assert len(files['keymap.json']) == len(json.dumps(keymap_data)), "edit did not keep the size"
+
+    rebooted = Simulation(keymap_data, files=files)
+    try:
+        start_ns = rebooted.clock.ns
+        rebooted.matrix.tap(100, 0, hold_ms=60)
+        rebooted.run(400)
+        assert first_press_after(rebooted.hid, KEY_B, start_ns) is not None, "button 1 reverted after reboot"
+    finally:
+        rebooted.close()
+
+
+def check_idle_sleeps_stay_out_of_full_scan_period():
+    """The full-rate scan period is measured apart from the idle tiers' longer sleeps"""
+    sim = Simulation(make_keymap({}, scan_idle_reduced_after_ms=1000, scan_idle_minimal_after_ms=600_000))
+    try:
+        sim.run(13_000)
+        periods = sim.firmware.scan_period_us
+        full_us, reduced_us = periods[sim.firmware_module.TIER_FULL], periods[sim.firmware_module.TIER_REDUCED]
+        assert 0 < full_us < 2000, f"full-rate scan period {full_us}us"
+        assert reduced_us >= 10_000, f"reduced scan period {reduced_us}us"
+    finally:
+        sim.close()
+
+
+def check_invalid_settings_delta_changes_nothing():
+    """A settings delta with one bad value is rejected whole and leaves the live settings alone"""
+    sim = Simulation(make_keymap({}, debounce_ms=40))
+    try:
+        firmware = sim.firmware
+        before = dict(firmware.settings)
+        try:
+            sim.call(firmware.apply_settings_delta, {'gc_idle_ms': 100, 'debounce_ms': 'fast'})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("invalid delta was accepted")
+        assert firmware.settings == before, firmware.settings
+        assert firmware.debounce_ms == 40 and firmware.gc_idle_ms != 100
+    finally:
+        sim.close()
+
+
+def check_deferred_press_keeps_macro_delays():
+    """A macro that starts a debounce window after the switch closed still plays its delays"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}, {'keys': ['B'], 'delay': 30}]},
+                                 debounce_mode='defer', debounce_ms=50))
+    try:
+        start_ns = sim.clock.ns
+        sim.matrix.tap(100, 0, hold_ms=80)
+        sim.run(400)
+        a_ns = first_press_after(sim.hid, KEY_A, start_ns)
+        b_ns = first_press_after(sim.hid, KEY_B, start_ns)
+        assert a_ns is not None and b_ns is not None, "the macro did not play"
+        gap_ms = (b_ns - a_ns) / 1_000_000
+        assert gap_ms >= 30, f"B followed A after {gap_ms:.1f}ms"
+    finally:
+        sim.close()
+
+
+def check_boot_timing_in_stats():
+    """The boot phase timings stay available to the serial "stats" command at the default log level"""
+    sim = Simulation(make_keymap({}))
+    try:
+        sim.run(200)
+        start = len(sim.log.getvalue())
+        sim.call(sim.firmware.handle_serial_command, "stats")
+        stats = sim.log.getvalue()[start:]
+        assert "first scan" in stats and "after power-on" in stats, stats
+    finally:
+        sim.close()
+
+
+def check_wake_from_light_sleep():
+    """A press during light sleep wakes the pad, is reported and sets the wake latency"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}, power_save_mode=True,
+                                 sleep_timeout_minutes=0.01))
+    try:
+        sim.matrix.tap(2000, 0, hold_ms=60)
+        press_ns = sim.clock.ns + 2000 * 1_000_000
+        sim.run(2500)
+        power_manager = sim.firmware.power_manager
+        assert power_manager.sleep_count >= 1, "the pad never went to sleep"
+        sent_ns = first_press_after(sim.hid, KEY_A, press_ns)
+        assert sent_ns is not None, "the wake key was not reported"
+        latency_ms = power_manager.last_wake_latency_ms
+        assert 0 <= latency_ms <= 10 and latency_ms == (sent_ns - press_ns) // 1_000_000, latency_ms
+    finally:
+        sim.close()
+
+
+def check_wake_without_report_ends_measurement():
+    """A wake key that sends nothing does not leave the wake latency armed for a later press"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}, power_save_mode=True,
+                                 sleep_timeout_minutes=0.01, wake_key_hold_ms=300))
+    try:
+        # Button 2 has no macro; button 1 is pressed after the wake window
+        sim.matrix.tap(2000, 1, hold_ms=60)
+        sim.matrix.tap(2400, 0, hold_ms=60)
+        start_ns = sim.clock.ns
+        sim.run(2550)
+        power_manager = sim.firmware.power_manager
+        assert first_press_after(sim.hid, KEY_A, start_ns) is not None, "button 1 was not reported"
+        assert not power_manager.measuring_wake, "wake measurement still armed"
+        assert power_manager.last_wake_latency_ms == -1, power_manager.last_wake_latency_ms
+    finally:
+        sim.close()
+
+
+def check_buffered_press_keeps_macro_delays():
+    """A press buffered while the BLE link is down plays its macro with its delays after reconnect"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}, {'keys': ['B'], 'delay': 500}]},
+                                 connection_mode='bluetooth'))
+    try:
+        sim.radio.host_arrives(50)
+        sim.radio.host_leaves(1000)
+        sim.radio.host_arrives(2000)
+        start_ns = sim.clock.ns
+        sim.matrix.tap(1200, 0, hold_ms=60)
+        sim.run(3500)
+        a_ns = first_press_after(sim.ble_hid, KEY_A, start_ns)
+        b_ns = first_press_after(sim.ble_hid, KEY_B, start_ns)
+        assert a_ns is not None and b_ns is not None, "the buffered press was not played"
+        assert a_ns >= start_ns + 2000 * 1_000_000, "A was sent while the link was down"
+        gap_ms = (b_ns - a_ns) / 1_000_000
+        assert gap_ms >= 500, f"B followed A after {gap_ms:.1f}ms"
+    finally:
+        sim.close()
+
+
+def check_paused_macro_keeps_delays():
+    """A macro cut off by a link drop resumes with the delays between its remaining steps"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}, {'keys': ['B'], 'delay': 500},
+                                      {'keys': ['C'], 'delay': 300}]}, connection_mode='bluetooth'))
+    try:
+        sim.radio.host_arrives(50)
+        sim.radio.host_leaves(500)
+        sim.radio.host_arrives(1500)
+        start_ns = sim.clock.ns
+        sim.matrix.tap(300, 0, hold_ms=60)
+        sim.run(3000)
+        b_ns = first_press_after(sim.ble_hid, KEY_B, start_ns)
+        c_ns = first_press_after(sim.ble_hid, KEY_C, start_ns)
+        assert b_ns is not None and c_ns is not None, "the macro did not finish after reconnect"
+        assert b_ns >= start_ns + 1500 * 1_000_000, "B was sent while the link was down"
+        gap_ms = (c_ns - b_ns) / 1_000_000
+        assert gap_ms >= 300, f"C followed B after {gap_ms:.1f}ms"
+    finally:
+        sim.close()
+
+
+def check_idle_loop_skips_stats_timing():
+    """Once the idle gc.collect() has run, main loop passes read no monotonic_ns() for stats"""
+    sim = Simulation(make_keymap({0: [{'keys': ['A'], 'delay': 0}]}))
+    try:
+        time_module = sim.modules['time']
+        monotonic_ns = time_module.monotonic_ns
+        idle_calls = [0]
+        # Boot reads the clock once more for its own timing
+        active_seen = [False]
+
+        def counting_monotonic_ns():
+            if not sim.firmware.idle_collected:
+                active_seen[0] = True
+            elif active_seen[0]:
+                idle_calls[0] += 1
+            return monotonic_ns()
+
+        time_module.monotonic_ns = counting_monotonic_ns
+        sim.matrix.tap(100, 0, hold_ms=60)
+        sim.run(3000)
+        stats = sim.firmware.stats
+        assert stats.scan_us.count, "no scans were timed around the key press"
+        assert not idle_calls[0], f"{idle_calls[0]} monotonic_ns() calls while idle"
+    finally:
+        sim.close()
+
+
+def check_key_path_reads_no_monotonic_ns():
+    """Scanning and dispatching presses, releases and layer keys never reads monotonic_ns().
+
+    On CircuitPython its result is a heap-allocated long, so this stands in
+    for the device's debug_alloc_check_scans check of the same path.
+    """
+    keymap_data = make_keymap({0: [{'keys': ['A'], 'delay': 0}]})
+    keymap_data['buttons']['1']['layer'] = 'next'
+    keymap_data['layers'] = [{'name': 'Fn', 'buttons': {'1': {'name': 'Back', 'layer': 'prev'}}}]
+    sim = Simulation(keymap_data)
+    try:
+        firmware = sim.firmware
+        time_module = sim.modules['time']
+        monotonic_ns = time_module.monotonic_ns
+        in_key_path = [False]
+        key_path_calls = [0]
+
+        def counting_monotonic_ns():
+            key_path_calls[0] += in_key_path[0]
+            return monotonic_ns()
+
+        def traced(method):
+            def call():
+                in_key_path[0] = True
+                try:
+                    method()
+                finally:
+                    in_key_path[0] = False
+            return call
+
+        time_module.monotonic_ns = counting_monotonic_ns
+        firmware.scan_matrix = traced(firmware.scan_matrix)
+        firmware.dispatch_key_events = traced(firmware.dispatch_key_events)
+        start_ns = sim.clock.ns
+        sim.matrix.tap(100, 0, hold_ms=60)
+        sim.matrix.tap(300, 1, hold_ms=60)
+        sim.matrix.tap(500, 1, hold_ms=60)
+        sim.run(800)
+        assert first_press_after(sim.hid, KEY_A, start_ns) is not None, "button 1 did not send A"
+        assert firmware.layer.index == 0, "layer keys did not switch there and back"
+        assert not key_path_calls[0], f"{key_path_calls[0]} monotonic_ns() calls on the key path"
+    finally:
+        sim.close()
+
+
+def check_keymatrix_release_chatter():
+    """The keypad backend filters release chatter in eager mode with each key's own debounce_ms"""
+    keymap_data = make_keymap({0: [{'keys': ['A'], 'delay': 0}], 1: [{'keys': ['B'], 'delay': 0}]},
+                              debounce_ms=30, debounce_mode='eager', scanner_backend='keymatrix')
+    keymap_data['buttons']['1']['debounce_ms'] = 5
+    sim = Simulation(keymap_data)
+    try:
+        assert sim.firmware.scanner.name == 'keymatrix', sim.firmware.scanner.name
+        # Both keys read open for 20ms in the middle of one press
+        for key, at_ms in ((0, 100), (1, 400)):
+            sim.matrix.press(at_ms, key)
+            sim.matrix.release(at_ms + 60, key)
+            sim.matrix.press(at_ms + 80, key)
+            sim.matrix.release(at_ms + 140, key)
+        sim.run(800)
+        assert count_presses(sim.hid, KEY_A) == 1, "chatter within debounce_ms re-triggered button 1"
+        assert count_presses(sim.hid, KEY_B) == 2, "button 2 ignored its shorter debounce_ms"
+    finally:
+        sim.close()
+
+
+CHECKS = [(name[len('check_'):], function) for name, function in sorted(globals().items())
+          if name.startswith('check_')]
+
+
+def main():
+    selected = sys.argv[1:]
+    failed = 0
+    for name, check in CHECKS:
+        if selected and name not in selected:
+            continue
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print(f"FAIL {name}")
+            traceback.print_exc()
+        else:
+            print(f"ok   {name}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
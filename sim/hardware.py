@@ -0,0 +1,563 @@
+import os
+import select
+import struct
+import sys
+import time as host_time
+import types
+
+# Pins the firmware looks up on an ESP32-S3 board
+ROW_PIN_NAMES = ('GPIO1', 'GPIO2', 'GPIO3', 'GPIO4')
+COL_PIN_NAMES = ('GPIO5', 'GPIO6', 'GPIO7', 'GPIO8')
+
+TICKS_MASK = (1 << 29) - 1
+
+
+class VirtualClock:
+    """Simulated time that only moves when the firmware sleeps.
+
+    Code between sleeps takes no simulated time, so every latency the harness
+    reports comes from the firmware's own scheduling and sleep choices. With
+    realtime set the clock follows the host's, for runs that talk to a real
+    process such as the live keymap client.
+    """
+
+    def __init__(self, start_ns=1_000_000_000):
+        self.ns = start_ns
+        self.listeners = []
+        self.realtime = False
+        # (host ns, simulated ns) when realtime was first used
+        self.realtime_anchor = None
+        # Set by the harness to end a run once the clock passes it
+        self.stop_ns = None
+
+    def monotonic(self):
+        return self.ns / 1_000_000_000
+
+    def monotonic_ns(self):
+        return self.ns
+
+    def ticks_ms(self):
+        return (self.ns // 1_000_000) & TICKS_MASK
+
+    def sleep(self, seconds):
+        self.advance(int(seconds * 1_000_000_000))
+
+    def advance(self, delta_ns):
+        """Move time forward, letting timelines apply every change due on the way"""
+        target_ns = self.ns + max(delta_ns, 0)
+        if self.realtime:
+            target_ns = self.follow_host(target_ns)
+        while True:
+            due_ns = target_ns
+            for listener in self.listeners:
+                next_ns = listener.next_due_ns()
+                if next_ns is not None and next_ns < due_ns:
+                    due_ns = next_ns
+            self.ns = max(self.ns, due_ns)
+            for listener in self.listeners:
+                listener.apply_due(self.ns)
+            if self.ns >= target_ns:
+                break
+        if self.stop_ns is not None and self.ns >= self.stop_ns:
+            raise StopSimulation()
+
+    def follow_host(self, target_ns):
+        """Sleep on the host until target_ns, then catch up with the host's elapsed time"""
+        if self.realtime_anchor is None:
+            self.realtime_anchor = (host_time.monotonic_ns(), self.ns)
+        host_start_ns, sim_start_ns = self.realtime_anchor
+        remaining_ns = target_ns - sim_start_ns - (host_time.monotonic_ns() - host_start_ns)
+        if remaining_ns > 0:
+            host_time.sleep(remaining_ns / 1_000_000_000)
+        return max(target_ns, sim_start_ns + host_time.monotonic_ns() - host_start_ns)
+
+    def time_module(self):
+        """A stand-in for the time module backed by this clock"""
+        module = types.ModuleType('time')
+        module.monotonic = self.monotonic
+        module.monotonic_ns = self.monotonic_ns
+        module.sleep = self.sleep
+        return module
+
+
+class StopSimulation(KeyboardInterrupt):
+    """Raised from sleep() at the end of a run; the firmware loop exits on KeyboardInterrupt"""
+
+
+class VirtualMatrix:
+    """4x4 switch matrix driven by a scripted press/release timeline.
+
+    Keys are numbered like the firmware: row * 4 + column.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.pressed = bytearray(16)
+        self.timeline = []
+        # Row pins currently driven high by the scanner
+        self.driven_rows = set()
+        clock.listeners.append(self)
+
+    def press(self, at_ms, key):
+        self.schedule(at_ms, key, True)
+
+    def release(self, at_ms, key):
+        self.schedule(at_ms, key, False)
+
+    def tap(self, at_ms, key, hold_ms=30):
+        self.press(at_ms, key)
+        self.release(at_ms + hold_ms, key)
+
+    def schedule(self, at_ms, key, pressed):
+        """Change key at at_ms of simulated time (relative to the current time)"""
+        self.timeline.append((self.clock.ns + int(at_ms * 1_000_000), key, pressed))
+        self.timeline.sort()
+
+    def next_due_ns(self):
+        return self.timeline[0][0] if self.timeline else None
+
+    def apply_due(self, now_ns):
+        while self.timeline and self.timeline[0][0] <= now_ns:
+            _, key, pressed = self.timeline.pop(0)
+            self.pressed[key] = 1 if pressed else 0
+
+    def column_level(self, col):
+        """Column input level: pulled up unless a pressed key connects it to a driven row"""
+        for row in range(4):
+            if self.pressed[row * 4 + col] and ROW_PIN_NAMES[row] in self.driven_rows:
+                return False
+        return True
+
+
+class HidSink:
+    """HID keyboard device that records every report with its simulated send time.
+
+    online, if given, is called on every send; while it returns False the
+    send fails with OSError like a device whose host is gone.
+    """
+
+    usage_page = 0x1
+    usage = 0x06
+
+    def __init__(self, clock, online=None):
+        self.clock = clock
+        self.online = online
+        self.reports = []
+
+    def send_report(self, report, report_id=None):
+        if self.online is not None and not self.online():
+            raise OSError("HID device not connected")
+        self.reports.append((self.clock.ns, bytes(report)))
+
+    def clear(self):
+        self.reports = []
+
+    def keys_down(self, report):
+        """Keycodes held in a report, modifiers included as 0xE0-0xE7"""
+        keys = [0xE0 + bit for bit in range(8) if report[0] & (1 << bit)]
+        keys.extend([keycode for keycode in report[2:] if keycode])
+        return keys
+
+
+class VirtualUsbPort:
+    """USB port with a scripted cable: plug()/unplug() at times like key changes.
+
+    Starts plugged in and enumerated. Its HID device only accepts reports while
+    plugged in.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.connected = True
+        self.timeline = []
+        self.hid = HidSink(clock, online=lambda: self.connected)
+        # usb_cdc.data, None unless boot.py would have enabled the data channel
+        self.cdc_data = None
+        clock.listeners.append(self)
+
+    def plug(self, at_ms):
+        self.timeline.append((self.clock.ns + int(at_ms * 1_000_000), True))
+        self.timeline.sort()
+
+    def unplug(self, at_ms):
+        self.timeline.append((self.clock.ns + int(at_ms * 1_000_000), False))
+        self.timeline.sort()
+
+    def next_due_ns(self):
+        return self.timeline[0][0] if self.timeline else None
+
+    def apply_due(self, now_ns):
+        while self.timeline and self.timeline[0][0] <= now_ns:
+            _, self.connected = self.timeline.pop(0)
+
+
+class PtySerial:
+    """One end of a pseudo-terminal, with the parts of usb_cdc.Serial and
+    pyserial's Serial that the firmware and keymap_live.py use"""
+
+    def __init__(self, fd, timeout=0):
+        self.fd = fd
+        self.timeout = timeout
+        self.write_timeout = None
+
+    @property
+    def in_waiting(self):
+        import fcntl
+        import termios
+        return struct.unpack('i', fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def read(self, size=1):
+        if not size:
+            return b''
+        ready, _, _ = select.select([self.fd], [], [], self.timeout or 0)
+        return os.read(self.fd, size) if ready else b''
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_pty_pair(host_timeout=0.05):
+    """(device end, host end) of a raw pty: the device end stands in for
+    usb_cdc.data, the host end for the pad's serial port on the PC (its
+    path, os.ttyname(host.fd), can also be opened with pyserial). POSIX only.
+    """
+    import tty
+    device_fd, host_fd = os.openpty()
+    tty.setraw(device_fd)
+    tty.setraw(host_fd)
+    return PtySerial(device_fd), PtySerial(host_fd, host_timeout)
+
+
+class VirtualBleConnection:
+    def __init__(self):
+        self.connected = True
+        self.paired = True
+        # Host default until the firmware asks for something shorter
+        self.connection_interval = 30.0
+
+
+class VirtualBleRadio:
+    """adafruit_ble.BLERadio stand-in with a scripted host.
+
+    A host in range connects after seeing HOST_SCAN_ADVERTISEMENTS
+    advertisements, so the advertising interval decides how long a reconnect
+    takes. host_arrives()/host_leaves() script the host like key changes.
+    """
+
+    HOST_SCAN_ADVERTISEMENTS = 3
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.advertising = False
+        self.interval_s = None
+        self.advertising_start_ns = 0
+        self.host_in_range = False
+        self.host_arrival_ns = 0
+        self.connections = ()
+        self.timeline = []
+        # (time_ns, interval_s) for every start_advertising() call
+        self.advertising_log = []
+        # The BLE HIDService keyboard, only accepting reports while a host is connected
+        self.hid = HidSink(clock, online=lambda: self.connected)
+        clock.listeners.append(self)
+
+    @property
+    def connected(self):
+        return bool(self.connections)
+
+    def start_advertising(self, advertisement, scan_response=None, interval=0.1, timeout=None):
+        self.advertising = True
+        self.interval_s = interval
+        self.advertising_start_ns = self.clock.ns
+        self.advertising_log.append((self.clock.ns, interval))
+
+    def stop_advertising(self):
+        self.advertising = False
+
+    def host_arrives(self, at_ms):
+        self.timeline.append((self.clock.ns + int(at_ms * 1_000_000), True))
+        self.timeline.sort()
+
+    def host_leaves(self, at_ms):
+        self.timeline.append((self.clock.ns + int(at_ms * 1_000_000), False))
+        self.timeline.sort()
+
+    def connect_due_ns(self):
+        if not self.host_in_range or not self.advertising or self.connections:
+            return None
+        start_ns = max(self.advertising_start_ns, self.host_arrival_ns)
+        return start_ns + int(self.HOST_SCAN_ADVERTISEMENTS * self.interval_s * 1_000_000_000)
+
+    def next_due_ns(self):
+        due_ns = self.connect_due_ns()
+        if self.timeline and (due_ns is None or self.timeline[0][0] < due_ns):
+            due_ns = self.timeline[0][0]
+        return due_ns
+
+    def apply_due(self, now_ns):
+        while self.timeline and self.timeline[0][0] <= now_ns:
+            _, arrives = self.timeline.pop(0)
+            self.host_in_range = arrives
+            if arrives:
+                self.host_arrival_ns = now_ns
+            else:
+                self.connections = ()
+        connect_ns = self.connect_due_ns()
+        if connect_ns is not None and connect_ns <= now_ns:
+            # The radio stops advertising once a central connects
+            self.advertising = False
+            self.connections = (VirtualBleConnection(),)
+
+
+def make_adafruit_ble(radio):
+    """adafruit_ble package stand-in whose BLERadio() returns radio"""
+    package = types.ModuleType('adafruit_ble')
+    package.__version__ = '0.0.0-sim'
+    package.BLERadio = lambda: radio
+
+    advertising = types.ModuleType('adafruit_ble.advertising')
+    standard = types.ModuleType('adafruit_ble.advertising.standard')
+
+    class ProvideServicesAdvertisement:
+        def __init__(self, *services):
+            self.services = services
+            self.appearance = 0
+            self.complete_name = None
+
+    standard.ProvideServicesAdvertisement = ProvideServicesAdvertisement
+
+    services = types.ModuleType('adafruit_ble.services')
+    hid_module = types.ModuleType('adafruit_ble.services.hid')
+
+    class HIDService:
+        def __init__(self):
+            self.devices = [radio.hid]
+
+    hid_module.HIDService = HIDService
+
+    deviceinfo = types.ModuleType('adafruit_ble.services.deviceinfo')
+
+    class DeviceInfoService:
+        def __init__(self, **info):
+            self.info = info
+
+    deviceinfo.DeviceInfoService = DeviceInfoService
+    return {
+        'adafruit_ble': package,
+        'adafruit_ble.advertising': advertising,
+        'adafruit_ble.advertising.standard': standard,
+        'adafruit_ble.services': services,
+        'adafruit_ble.services.hid': hid_module,
+        'adafruit_ble.services.deviceinfo': deviceinfo,
+    }
+
+
+class Pin:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"board.{self.name}"
+
+
+def make_board():
+    board = types.ModuleType('board')
+    for number in range(48):
+        setattr(board, f'GPIO{number}', Pin(f'GPIO{number}'))
+    return board
+
+
+def make_digitalio(matrix):
+    digitalio = types.ModuleType('digitalio')
+
+    class Direction:
+        INPUT = 'input'
+        OUTPUT = 'output'
+
+    class Pull:
+        UP = 'up'
+        DOWN = 'down'
+
+    class DigitalInOut:
+        def __init__(self, pin):
+            self.pin = pin
+            self.direction = Direction.INPUT
+            self.pull = None
+            self.output_value = False
+
+        @property
+        def value(self):
+            if self.pin.name in COL_PIN_NAMES:
+                return matrix.column_level(COL_PIN_NAMES.index(self.pin.name))
+            return self.output_value
+
+        @value.setter
+        def value(self, value):
+            self.output_value = value
+            if self.pin.name in ROW_PIN_NAMES:
+                if value:
+                    matrix.driven_rows.add(self.pin.name)
+                else:
+                    matrix.driven_rows.discard(self.pin.name)
+
+        def deinit(self):
+            matrix.driven_rows.discard(self.pin.name)
+
+    digitalio.DigitalInOut = DigitalInOut
+    digitalio.Direction = Direction
+    digitalio.Pull = Pull
+    return digitalio
+
+
+def make_keypad(clock, matrix):
+    """keypad stand-in whose KeyMatrix reports state changes of the virtual matrix"""
+    keypad = types.ModuleType('keypad')
+
+    class Event:
+        def __init__(self, key_number=0, pressed=True):
+            self.key_number = key_number
+            self.pressed = pressed
+            self.timestamp = 0
+
+    class EventQueue:
+        def __init__(self, owner):
+            self.owner = owner
+            self.overflowed = False
+
+        def get_into(self, event):
+            reported = self.owner.reported
+            for key in range(16):
+                if matrix.pressed[key] != reported[key]:
+                    reported[key] = matrix.pressed[key]
+                    event.key_number = key
+                    event.pressed = bool(reported[key])
+                    event.timestamp = clock.ticks_ms()
+                    return True
+            return False
+
+        def clear(self):
+            pass
+
+    class KeyMatrix:
+        def __init__(self, row_pins, column_pins, interval=0.02, max_events=64, debounce_threshold=1):
+            self.reported = bytearray(16)
+            self.events = EventQueue(self)
+
+        def reset(self):
+            self.reported = bytearray(16)
+
+        def deinit(self):
+            pass
+
+    keypad.Event = Event
+    keypad.KeyMatrix = KeyMatrix
+    return keypad
+
+
+def make_alarm(clock, matrix):
+    """alarm stand-in whose light sleep lasts until the next scripted key press"""
+    alarm = types.ModuleType('alarm')
+    alarm_pin = types.ModuleType('alarm.pin')
+
+    class PinAlarm:
+        def __init__(self, pin, value, edge=False, pull=False):
+            self.pin = pin
+            self.value = value
+            self.pull = pull
+
+    def light_sleep_until_alarms(*alarms):
+        # The column pin alarms are in column order; the run ends if no press is scheduled
+        while not any(matrix.pressed):
+            due_ns = matrix.next_due_ns()
+            if due_ns is None:
+                raise StopSimulation()
+            clock.advance(due_ns - clock.ns)
+        key = matrix.pressed.index(1)
+        alarm.wake_alarm = alarms[key % len(alarms)]
+        return alarm.wake_alarm
+
+    def exit_and_deep_sleep_until_alarms(*alarms, preserve_dios=()):
+        raise SystemExit("deep sleep")
+
+    alarm_pin.PinAlarm = PinAlarm
+    alarm.pin = alarm_pin
+    alarm.wake_alarm = None
+    alarm.light_sleep_until_alarms = light_sleep_until_alarms
+    alarm.exit_and_deep_sleep_until_alarms = exit_and_deep_sleep_until_alarms
+    return alarm
+
+
+def make_modules(clock, matrix, usb, radio):
+    """Stand-ins for the CircuitPython modules the firmware imports, by module name"""
+    usb_hid = types.ModuleType('usb_hid')
+    usb_hid.devices = [usb.hid]
+
+    microcontroller = types.ModuleType('microcontroller')
+
+    def reset():
+        raise SystemExit("microcontroller.reset()")
+
+    microcontroller.reset = reset
+
+    adafruit_hid = types.ModuleType('adafruit_hid')
+
+    def find_device(devices, usage_page, usage):
+        for device in devices:
+            if device.usage_page == usage_page and device.usage == usage:
+                return device
+        raise ValueError("Could not find matching HID device.")
+
+    adafruit_hid.find_device = find_device
+
+    usb_cdc = types.ModuleType('usb_cdc')
+    usb_cdc.console = None
+    usb_cdc.data = usb.cdc_data
+
+    supervisor = types.ModuleType('supervisor')
+    supervisor.ticks_ms = clock.ticks_ms
+
+    class Runtime:
+        serial_bytes_available = 0
+
+        @property
+        def usb_connected(self):
+            return usb.connected
+
+    supervisor.runtime = Runtime()
+
+    alarm = make_alarm(clock, matrix)
+    modules = make_adafruit_ble(radio)
+    modules.update({
+        'time': clock.time_module(),
+        'board': make_board(),
+        'digitalio': make_digitalio(matrix),
+        'usb_hid': usb_hid,
+        'usb_cdc': usb_cdc,
+        'microcontroller': microcontroller,
+        'adafruit_hid': adafruit_hid,
+        'keypad': make_keypad(clock, matrix),
+        'supervisor': supervisor,
+        'alarm': alarm,
+        'alarm.pin': alarm.pin,
+    })
+    return modules
+
+
+def install(modules):
+    """Put the stand-ins in sys.modules; returns what they replaced for uninstall()"""
+    replaced = {}
+    for name, module in modules.items():
+        replaced[name] = sys.modules.get(name)
+        sys.modules[name] = module
+    return replaced
+
+
+def uninstall(replaced):
+    for name, module in replaced.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
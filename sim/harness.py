@@ -0,0 +1,133 @@
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+
+from .hardware import (VirtualClock, VirtualMatrix, VirtualUsbPort, VirtualBleRadio, StopSimulation,
+                       make_modules, install, uninstall)
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Firmware modules imported fresh for every simulation so each binds its own stand-ins
+FIRMWARE_MODULES = ('temp_code', 'keymap_format')
+
+
+def make_keymap(macros, **settings):
+    """Build keymap data with the given {button index: macro} and setting overrides.
+
+    The defaults keep runs deterministic: USB only and no sleep.
+    """
+    keymap_settings = {
+        'debounce_ms': 50,
+        'macro_playback_speed': 1.0,
+        'connection_mode': 'usb',
+        'device_id': 1,
+        'power_save_mode': False,
+    }
+    keymap_settings.update(settings)
+    buttons = {}
+    for button_index in range(16):
+        buttons[str(button_index)] = {
+            'name': f'Macro {button_index + 1}',
+            'macro': macros.get(button_index, []),
+        }
+    return {'version': '1.0', 'buttons': buttons, 'settings': keymap_settings}
+
+
+class Simulation:
+    """Runs the real KyupadFirmware from src/temp_code.py against simulated hardware.
+
+    Schedule key changes on self.matrix (and the USB cable on self.usb, BLE
+    host presence on self.radio), call run() once, or start() and stop() for
+    a real-time run on a thread, then inspect the HID reports in
+    self.hid.reports (USB) and self.ble_hid.reports (BLE).
+    Firmware output is captured in self.log unless quiet is False.
+    cdc_data stands in for usb_cdc.data, e.g. the device end of open_pty_pair().
+    files adds {name: bytes} next to keymap.json before boot, e.g. a keymap.bin.
+    """
+
+    def __init__(self, keymap_data, quiet=True, cdc_data=None, files=None):
+        self.clock = VirtualClock()
+        self.matrix = VirtualMatrix(self.clock)
+        self.usb = VirtualUsbPort(self.clock)
+        self.usb.cdc_data = cdc_data
+        self.radio = VirtualBleRadio(self.clock)
+        self.hid = self.usb.hid
+        self.ble_hid = self.radio.hid
+        self.modules = make_modules(self.clock, self.matrix, self.usb, self.radio)
+        self.quiet = quiet
+        self.log = io.StringIO()
+        self.ran = False
+        self.thread = None
+
+        self.workdir = tempfile.TemporaryDirectory(prefix='kyupad-sim-')
+        with open(os.path.join(self.workdir.name, 'keymap.json'), 'w', encoding='utf-8') as f:
+            json.dump(keymap_data, f)
+        for name, data in (files or {}).items():
+            with open(os.path.join(self.workdir.name, name), 'wb') as f:
+                f.write(data)
+
+        with self.firmware_context():
+            self.firmware_module = self.import_firmware()
+            self.firmware = self.firmware_module.KyupadFirmware()
+
+    @contextlib.contextmanager
+    def firmware_context(self):
+        """Stand-ins installed, keymap directory as cwd and firmware output captured"""
+        replaced = install(self.modules)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        try:
+            if self.quiet:
+                with contextlib.redirect_stdout(self.log):
+                    yield
+            else:
+                yield
+        finally:
+            os.chdir(cwd)
+            uninstall(replaced)
+
+    def import_firmware(self):
+        for name in FIRMWARE_MODULES:
+            sys.modules.pop(name, None)
+        if SRC_DIR not in sys.path:
+            sys.path.insert(0, SRC_DIR)
+        return importlib.import_module('temp_code')
+
+    def run(self, duration_ms=None):
+        """Run KyupadFirmware.run() for duration_ms of simulated time (None: until stop())"""
+        if self.ran:
+            raise RuntimeError("KyupadFirmware.run() can only be simulated once per Simulation")
+        self.ran = True
+        if duration_ms is not None:
+            self.clock.stop_ns = self.clock.ns + int(duration_ms * 1_000_000)
+        with self.firmware_context():
+            try:
+                self.firmware.run()
+            except StopSimulation:
+                pass
+        self.clock.stop_ns = None
+
+    def start(self):
+        """Run the firmware in real time on a background thread until stop()"""
+        self.clock.realtime = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.clock.stop_ns = self.clock.ns
+        self.thread.join()
+
+    def call(self, function, *args):
+        """Call into the firmware outside run(), e.g. a single scan_matrix()"""
+        with self.firmware_context():
+            return function(*args)
+
+    def close(self):
+        if self.firmware.keymap_bin is not None:
+            self.firmware.keymap_bin.close()
+        self.workdir.cleanup()
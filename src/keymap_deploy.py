@@ -0,0 +1,140 @@
+"""Copies the keymap and firmware to a pad's CIRCUITPY drive, changed files only.
+
+Every write to the drive restarts the auto-reload countdown on the pad and
+wears its flash, so files whose content is already there are skipped and
+the rest are written back to back, which the pad picks up in one reload.
+Any directory works as a drive, e.g. a temporary one standing in for the
+pad; KYUPAD_DRIVE points the editor at one.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+from keymap_format import pack_keymap
+
+DRIVE_LABEL = "CIRCUITPY"
+
+# Name on the drive and source file next to the editor, in write order.
+# code.py goes last so the pad never reloads into new firmware with an old keymap_format.py
+FIRMWARE_FILES = (("keymap_format.py", "keymap_format.py"), ("code.py", "temp_code.py"))
+
+logger = logging.getLogger("kyupad.editor.deploy")
+
+
+class DeployError(Exception):
+    pass
+
+
+def find_drives():
+    """Mount points of the CIRCUITPY drives that are plugged in"""
+    override = os.environ.get("KYUPAD_DRIVE")
+    if override:
+        return [override] if os.path.isdir(override) else []
+    if sys.platform == "win32":
+        return windows_drives()
+    if sys.platform == "darwin":
+        return sorted(glob.glob(f"/Volumes/{DRIVE_LABEL}*"))
+    return linux_drives()
+
+
+def linux_drives():
+    drives = []
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                # /proc/mounts escapes spaces in paths as \040
+                mount_point = fields[1].replace("\\040", " ")
+                if os.path.basename(mount_point).startswith(DRIVE_LABEL):
+                    drives.append(mount_point)
+    except OSError as e:
+        logger.debug("Could not read /proc/mounts: %s", e)
+    return drives
+
+
+def windows_drives():
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    drives = []
+    bitmask = kernel32.GetLogicalDrives()
+    for i in range(26):
+        if not bitmask & (1 << i):
+            continue
+        root = f"{chr(ord('A') + i)}:\\"
+        label = ctypes.create_unicode_buffer(261)
+        if kernel32.GetVolumeInformationW(root, label, len(label), None, None, None, None, 0):
+            if label.value.startswith(DRIVE_LABEL):
+                drives.append(root)
+    return drives
+
+
+def deploy_files(keymap_blob, src_dir):
+    """{name on the drive: content} for a serialized keymap and the firmware in src_dir.
+
+    keymap.bin is packed from the same snapshot, so the pad's CRC check
+    always pairs it with the keymap.json written alongside it. A keymap that
+    cannot be packed raises DeployError.
+    """
+    try:
+        keymap_bin = pack_keymap(json.loads(keymap_blob), keymap_blob)
+    except Exception as e:
+        raise DeployError(f"keymap.bin could not be packed: {e}") from e
+    files = {"keymap.json": keymap_blob, "keymap.bin": keymap_bin}
+    for drive_name, source_name in FIRMWARE_FILES:
+        with open(os.path.join(src_dir, source_name), "rb") as f:
+            files[drive_name] = f.read()
+    return files
+
+
+def changed_files(drive, files):
+    """Names in files whose content differs from the drive's copy.
+
+    Sizes are compared first, so only files of equal size are read back and hashed.
+    """
+    changed = []
+    for name, data in files.items():
+        path = os.path.join(drive, name)
+        try:
+            if os.stat(path).st_size == len(data):
+                with open(path, "rb") as f:
+                    if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                        continue
+        except OSError:
+            pass
+        changed.append(name)
+    return changed
+
+
+def deploy(drive, files):
+    """Write the changed files to drive in one batch; returns (names written, bytes written, seconds).
+
+    Files are written in place rather than through a temporary file and a
+    rename, which on the pad's FAT drive would cost a second write per file.
+    The time runs until the data is flushed to the drive.
+    """
+    if not os.path.isdir(drive):
+        raise DeployError(f"{drive} is not mounted")
+    start = time.perf_counter()
+    changed = changed_files(drive, files)
+    written = 0
+    try:
+        for name in changed:
+            with open(os.path.join(drive, name), "wb") as f:
+                f.write(files[name])
+                f.flush()
+                os.fsync(f.fileno())
+            written += len(files[name])
+        if changed and hasattr(os, "sync"):
+            os.sync()
+    except OSError as e:
+        raise DeployError(f"Writing to {drive} failed: {e}") from e
+    elapsed = time.perf_counter() - start
+    logger.info("Deployed %s to %s: %d bytes in %.0fms", ", ".join(changed) or "nothing", drive, written,
+                elapsed * 1000)
+    return changed, written, elapsed
@@ -1,15 +1,278 @@
 from PySide6.QtWidgets import (QApplication, QMainWindow, QPushButton, QWidget, QVBoxLayout, 
-                               QHBoxLayout, QMessageBox, QDialog, QLabel, QListWidget, QLineEdit, 
+                               QHBoxLayout, QMessageBox, QDialog, QLabel, QPlainTextEdit, QLineEdit, 
                                QTextEdit, QGridLayout, QScrollArea, QComboBox, QSpinBox, QGroupBox,
-                               QTableWidget, QTableWidgetItem, QHeaderView, QColorDialog)
-from PySide6.QtCore import Qt, QRect, QCoreApplication, QEvent, QTimer
-from PySide6.QtGui import QColor
+                               QTableView, QAbstractItemView, QStyledItemDelegate, QStyle, QHeaderView,
+                               QColorDialog, QInputDialog, QTableWidget, QTableWidgetItem)
+from PySide6.QtCore import (Qt, QRect, QCoreApplication, QEvent, QTimer, QAbstractTableModel, QModelIndex, QSize,
+                            QObject, Signal)
+from PySide6.QtGui import QColor, QKeySequence, QShortcut, QFont, QFontMetrics, QPainter
 import sys
 import json
 import os
 import time
 import subprocess
 import platform
+import logging
+import threading
+from collections import deque
+from keymap_format import (pack_keymap, keymap_layers, untypeable_chars, MAX_LAYERS, DEFAULT_TEXT_CPS,
+                           STATUS_OK, STATUS_NAMES, STATUS_PERSIST_FAILED)
+from keymap_live import LiveKeymapClient, LiveKeymapError
+from keymap_optimizer import optimize_macro, macro_stats, macro_steps
+from keymap_deploy import find_drives, deploy_files, deploy, DeployError
+
+# Saves requested closer together than this are written once
+SAVE_DEBOUNCE_MS = 250
+
+# Console level comes from KYUPAD_LOG_LEVEL (quiet by default); the ring keeps INFO and up
+LOG_RING_SIZE = 500
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+logger = logging.getLogger("kyupad.editor")
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent log records so they can be dumped on demand"""
+    def __init__(self, capacity=LOG_RING_SIZE):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream=None):
+        stream = stream or sys.stderr
+        for record in list(self.records):
+            stream.write(self.format(record) + "\n")
+        stream.flush()
+
+
+log_ring = RingBufferHandler()
+
+
+def setup_logging():
+    console_level = logging.getLevelName(os.environ.get("KYUPAD_LOG_LEVEL", "WARNING").upper())
+    if not isinstance(console_level, int):
+        console_level = logging.WARNING
+    formatter = logging.Formatter(LOG_FORMAT)
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(formatter)
+    log_ring.setLevel(logging.INFO)
+    log_ring.setFormatter(formatter)
+    logger.addHandler(console)
+    logger.addHandler(log_ring)
+    # Records below both handler levels are dropped before any formatting
+    logger.setLevel(min(console_level, logging.INFO))
+    logger.propagate = False
+
+
+def is_editable_action(action):
+    """Macro actions the button dialog shows: keys arrays and text"""
+    if not isinstance(action, dict):
+        return False
+    return isinstance(action.get("keys"), list) or action.get("action") == "text"
+
+
+# Role that hands the delegate the action dict of a row
+ACTION_ROLE = Qt.ItemDataRole.UserRole
+# Key events listed in a row's tooltip before it is cut short
+TOOLTIP_KEY_EVENTS = 40
+
+
+class MacroTableModel(QAbstractTableModel):
+    """Key and text actions of a macro, one row per action.
+
+    self.rows maps view rows to indexes in the macro list, so adding or
+    deleting an action inserts or removes just that row and the view only
+    asks for the rows it shows.
+    """
+
+    def __init__(self, macro, parent=None):
+        super().__init__(parent)
+        # Legacy string macros have no editable actions
+        self.macro = macro if isinstance(macro, list) else []
+        self.rows = [i for i, action in enumerate(self.macro) if is_editable_action(action)]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return "Key Events"
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        action = self.macro[self.rows[index.row()]]
+        if role == ACTION_ROLE:
+            return action
+        if role == Qt.ItemDataRole.ToolTipRole:
+            if action.get("action") == "text":
+                return action.get("text", "")
+            keys = action["keys"]
+            more = f" … +{len(keys) - TOOLTIP_KEY_EVENTS} more" if len(keys) > TOOLTIP_KEY_EVENTS else ""
+            return " → ".join(keys[:TOOLTIP_KEY_EVENTS]) + more
+        return None
+
+    def macro_index(self, row):
+        """Index in the macro list of the action shown at row"""
+        return self.rows[row]
+
+    def append_actions(self, actions):
+        editable = [action for action in actions if is_editable_action(action)]
+        if editable:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(editable) - 1)
+        for action in actions:
+            if is_editable_action(action):
+                self.rows.append(len(self.macro))
+            self.macro.append(action)
+        if editable:
+            self.endInsertRows()
+
+    def remove_row(self, row):
+        macro_index = self.rows[row]
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.macro[macro_index]
+        del self.rows[row]
+        for later in range(row, len(self.rows)):
+            self.rows[later] -= 1
+        self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.macro.clear()
+        self.rows.clear()
+        self.endResetModel()
+
+
+def key_chip(key_event):
+    """Label and color of the chip drawn for one key event"""
+    if key_event.endswith("_press"):
+        return f"↓{key_event[:-len('_press')]}", QColor("#4CAF50")
+    if key_event.endswith("_release"):
+        return f"↑{key_event[:-len('_release')]}", QColor("#f44336")
+    return key_event, QColor("#9E9E9E")
+
+
+class KeyChipDelegate(QStyledItemDelegate):
+    """Paints an action's key events as ↓/↑ chips on a single line.
+
+    Chips that do not fit are summed up in a "+N more" chip, so painting a
+    recording with thousands of events costs the same as a short one.
+    """
+
+    ROW_HEIGHT = 29
+    CHIP_HEIGHT = 21
+    CHIP_MIN_WIDTH = 60
+    SPACING = 5
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.chip_font = QFont()
+        self.chip_font.setPixelSize(10)
+        self.chip_font.setBold(True)
+        self.chip_metrics = QFontMetrics(self.chip_font)
+        self.note_font = QFont()
+        self.note_font.setPixelSize(10)
+
+    def sizeHint(self, option, index):
+        return QSize(option.rect.width(), self.ROW_HEIGHT)
+
+    def chip_width(self, label):
+        return max(self.CHIP_MIN_WIDTH, self.chip_metrics.horizontalAdvance(label) + 12)
+
+    def draw_chip(self, painter, x, y, label, color):
+        width = self.chip_width(label)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(color)
+        painter.drawRoundedRect(QRect(x, y, width, self.CHIP_HEIGHT), 3, 3)
+        painter.setPen(QColor("white"))
+        painter.drawText(QRect(x, y, width, self.CHIP_HEIGHT), Qt.AlignmentFlag.AlignCenter, label)
+        return x + width + self.SPACING
+
+    def paint(self, painter, option, index):
+        action = index.data(ACTION_ROLE)
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        rect = option.rect.adjusted(self.SPACING, 0, -self.SPACING, 0)
+        y = rect.top() + (rect.height() - self.CHIP_HEIGHT) // 2
+        x = rect.left()
+
+        # Repeat count, delay, and the rate of text actions go at the end of the row
+        notes = []
+        if action.get("repeat", 1) > 1:
+            notes.append(f"×{action['repeat']}")
+        if action.get("action") == "text" and "cps" in action:
+            notes.append(f"{action['cps']} cps")
+        if action.get("delay", 0) > 0:
+            notes.append(f"({action['delay']}ms)")
+        note = " ".join(notes)
+        right = rect.right() - (QFontMetrics(self.note_font).horizontalAdvance(note) + self.SPACING if note else 0)
+
+        painter.setFont(self.chip_font)
+        if action.get("action") == "text":
+            painter.setPen(option.palette.text().color())
+            label = self.chip_metrics.elidedText(f"Type: {action.get('text', '')!r}", Qt.TextElideMode.ElideRight,
+                                                 right - x)
+            painter.drawText(QRect(x, rect.top(), right - x, rect.height()), Qt.AlignmentFlag.AlignVCenter, label)
+            x += self.chip_metrics.horizontalAdvance(label) + self.SPACING
+        else:
+            keys = action["keys"]
+            for i, key_event in enumerate(keys):
+                label, color = key_chip(key_event)
+                remaining = len(keys) - i
+                needed = self.chip_width(label)
+                if remaining > 1:
+                    needed += self.SPACING + self.chip_width(f"+{remaining - 1} more")
+                if x + needed > right and i:
+                    x = self.draw_chip(painter, x, y, f"+{remaining} more", QColor("#757575"))
+                    break
+                x = self.draw_chip(painter, x, y, label, color)
+
+        if note:
+            painter.setFont(self.note_font)
+            painter.setPen(QColor("#666"))
+            painter.drawText(QRect(x, rect.top(), rect.right() - x, rect.height()),
+                             Qt.AlignmentFlag.AlignVCenter, note)
+        painter.restore()
+
+
+class MacroTableView(QTableView):
+    """Macro table that says so when there is nothing to show"""
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.model() is not None and self.model().rowCount() == 0:
+            painter = QPainter(self.viewport())
+            painter.setPen(QColor("#666"))
+            painter.drawText(self.viewport().rect().adjusted(8, 8, -8, -8),
+                             Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop, "(No macro)")
+
+
+# Recording: Qt key -> keymap.json key name, built once rather than per key event
+QT_KEY_NAMES = {
+    Qt.Key_Control: "Ctrl", Qt.Key_Alt: "Alt", Qt.Key_Shift: "Shift", Qt.Key_Meta: "Win",
+    Qt.Key_Tab: "Tab", Qt.Key_Return: "Enter", Qt.Key_Enter: "Enter", Qt.Key_Escape: "Escape",
+    Qt.Key_Backspace: "Backspace", Qt.Key_Delete: "Delete", Qt.Key_Space: "Space",
+    Qt.Key_Left: "Left", Qt.Key_Right: "Right", Qt.Key_Up: "Up", Qt.Key_Down: "Down",
+}
+for _offset in range(26):
+    QT_KEY_NAMES[Qt.Key_A + _offset] = chr(ord("A") + _offset)
+for _offset in range(10):
+    QT_KEY_NAMES[Qt.Key_0 + _offset] = str(_offset)
+for _offset in range(12):
+    QT_KEY_NAMES[Qt.Key_F1 + _offset] = f"F{_offset + 1}"
+
+# The recording view is refreshed at most this often (about 30 Hz), however fast keys arrive
+RECORD_VIEW_INTERVAL_MS = 33
+
 
 class ButtonEditDialog(QDialog):
     def __init__(self, parent, button_id):
@@ -18,12 +281,20 @@ class ButtonEditDialog(QDialog):
         self.button_id = button_id
         self.recording = False
         self.recorded_macro = []
-        self.current_keys = []
+        self.recorded_keys = []
+        self.recorded_delay = 0
         self.last_key_time = None
-        self.record_macro_list = None
-        
-        # Load current button data
-        self.button_data = self.parent_window.keymap_data.get("buttons", {}).get(button_id, {
+        self.record_view = None
+        self.record_status = None
+        self.record_view_count = 0
+        self.record_last_delay = 0
+        self.record_repeats = 0
+        self.record_timer = QTimer(self)
+        self.record_timer.setInterval(RECORD_VIEW_INTERVAL_MS)
+        self.record_timer.timeout.connect(self.refresh_record_view)
+        
+        # Load current button data from the layer shown in the grid
+        self.button_data = self.parent_window.layer_buttons().get(button_id, {
             "name": f"Button {int(button_id)+1}",
             "description": "",
             "macro": []
@@ -77,21 +348,45 @@ class ButtonEditDialog(QDialog):
         color_layout.addStretch()
         layout.addLayout(color_layout)
         
+        # Layer key: pressing the button switches layers instead of playing the macro
+        layer_layout = QHBoxLayout()
+        layer_layout.addWidget(QLabel("Layer Key:"))
+        self.layer_combo = QComboBox()
+        self.layer_combo.addItem("None", None)
+        self.layer_combo.addItem("Next layer", "next")
+        self.layer_combo.addItem("Previous layer", "prev")
+        layer_names = self.parent_window.layer_names()
+        for name in layer_names:
+            self.layer_combo.addItem(f"Go to {name}", name)
+        target = self.button_data.get("layer")
+        if isinstance(target, int) and 0 <= target < len(layer_names):
+            target = layer_names[target]
+        self.layer_combo.setCurrentIndex(max(0, self.layer_combo.findData(target)))
+        layer_layout.addWidget(self.layer_combo)
+        layer_layout.addStretch()
+        layout.addLayout(layer_layout)
+        
         # Current macro display
         layout.addWidget(QLabel("Current Macro:"))
-        self.current_macro_display = QTableWidget()
-        self.current_macro_display.setColumnCount(1)
-        self.current_macro_display.setHorizontalHeaderLabels(["Key Events"])
+        self.macro_model = MacroTableModel(self.button_data.get("macro", []), self)
+        self.current_macro_display = MacroTableView()
+        self.current_macro_display.setModel(self.macro_model)
+        self.macro_delegate = KeyChipDelegate(self.current_macro_display)
+        self.current_macro_display.setItemDelegate(self.macro_delegate)
         
         # Set column widths
         header = self.current_macro_display.horizontalHeader()
         header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        # Fixed row height, so the view never measures rows it does not show
+        vertical_header = self.current_macro_display.verticalHeader()
+        vertical_header.setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        vertical_header.setDefaultSectionSize(KeyChipDelegate.ROW_HEIGHT)
         
         # Set selection behavior
-        self.current_macro_display.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
-        self.current_macro_display.setSelectionMode(QTableWidget.SelectionMode.SingleSelection)
+        self.current_macro_display.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.current_macro_display.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.current_macro_display.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
         
-        self.update_macro_display()
         layout.addWidget(self.current_macro_display)
         
         # Manual macro input - single line
@@ -145,6 +440,24 @@ class ButtonEditDialog(QDialog):
         
         layout.addLayout(manual_layout)
         
+        # Text to type, paced in characters per second
+        text_layout = QHBoxLayout()
+        text_layout.addWidget(QLabel("Type Text:"))
+        self.text_input = QLineEdit()
+        self.text_input.setPlaceholderText("Typed with the US layout, \\n for Enter")
+        text_layout.addWidget(self.text_input)
+        self.text_cps = self.parent_window.keymap_data.get("settings", {}).get("text_cps", DEFAULT_TEXT_CPS)
+        self.cps_spinbox = QSpinBox()
+        self.cps_spinbox.setRange(1, 500)
+        self.cps_spinbox.setValue(self.text_cps)
+        self.cps_spinbox.setSuffix(" cps")
+        self.cps_spinbox.setToolTip("Bluetooth hosts drop characters above about 30 cps")
+        text_layout.addWidget(self.cps_spinbox)
+        add_text_btn = QPushButton("Add Text")
+        add_text_btn.clicked.connect(self.add_text_macro)
+        text_layout.addWidget(add_text_btn)
+        layout.addLayout(text_layout)
+        
         # Action buttons
         button_layout = QHBoxLayout()
         
@@ -164,108 +477,44 @@ class ButtonEditDialog(QDialog):
         
         self.setLayout(layout)
     
-    def update_macro_display(self):
-        self.current_macro_display.setRowCount(0)
-        macro = self.button_data.get("macro", [])
-        
-        if not macro:
-            self.current_macro_display.setRowCount(1)
-            self.current_macro_display.setItem(0, 0, QTableWidgetItem("(No macro)"))
-            return
-        
-        # Filter only key actions, skip consumer/special actions
-        key_actions = []
-        for action in macro:
-            if "keys" in action and isinstance(action["keys"], list):
-                key_actions.append(action)
-        
-        if not key_actions:
-            self.current_macro_display.setRowCount(1)
-            self.current_macro_display.setItem(0, 0, QTableWidgetItem("(No key actions)"))
-            return
-        
-        self.current_macro_display.setRowCount(len(key_actions))
-        
-        for i, action in enumerate(key_actions):
-            # Create a widget container for the row
-            row_widget = QWidget()
-            row_layout = QHBoxLayout(row_widget)
-            row_layout.setContentsMargins(5, 2, 5, 2)
-            row_layout.setSpacing(5)
-            
-            # Create buttons for each key in this action
-            keys = action.get("keys", [])
-            for key_event in keys:
-                key_button = QPushButton(key_event)
-                key_button.setMaximumHeight(25)
-                key_button.setMinimumWidth(60)
-                
-                # Style the button based on key type
-                if "_press" in key_event:
-                    key_name = key_event.replace("_press", "")
-                    key_button.setText(f"↓{key_name}")
-                    key_button.setStyleSheet("background-color: #4CAF50; color: white; font-weight: bold; font-size: 10px;")
-                elif "_release" in key_event:
-                    key_name = key_event.replace("_release", "")
-                    key_button.setText(f"↑{key_name}")
-                    key_button.setStyleSheet("background-color: #f44336; color: white; font-weight: bold; font-size: 10px;")
-                
-                row_layout.addWidget(key_button)
-            
-            # Add delay info at the end
-            delay = action.get("delay", 0)
-            if delay > 0:
-                delay_label = QLabel(f"({delay}ms)")
-                delay_label.setStyleSheet("color: #666; font-size: 10px;")
-                row_layout.addWidget(delay_label)
-            
-            row_layout.addStretch()
-            
-            # Set the widget to the table cell
-            self.current_macro_display.setCellWidget(i, 0, row_widget)
-        
-        # Auto-resize rows
-        self.current_macro_display.resizeRowsToContents()
+    def append_actions(self, actions):
+        """Add actions to the macro; the view inserts just their rows"""
+        self.macro_model.append_actions(actions)
+        # A legacy string macro is replaced by the list the model edits
+        self.button_data["macro"] = self.macro_model.macro
+        self.current_macro_display.scrollToBottom()
     
     def save_changes(self):
         # Update button data
         self.button_data["name"] = self.name_input.text().strip() or f"Button {int(self.button_id)+1}"
         self.button_data["description"] = self.desc_input.toPlainText().strip()
         self.button_data["button_color"] = self.current_color
+        target = self.layer_combo.currentData()
+        if target is None:
+            self.button_data.pop("layer", None)
+        else:
+            self.button_data["layer"] = target
         
         # Save to parent keymap
-        self.parent_window.keymap_data.setdefault("buttons", {})[self.button_id] = self.button_data
+        self.parent_window.layer_buttons()[self.button_id] = self.button_data
         self.parent_window.save_keymap_json()
         self.parent_window.update_button_text(self.button_id, self.button_data["name"])
         self.parent_window.update_button_color(self.button_id, self.current_color)
+        self.parent_window.push_button(self.button_id)
         
         self.close()
     
     def delete_selected_action(self):
-        current_row = self.current_macro_display.currentRow()
-        if current_row < 0:
-            QMessageBox.warning(self, "Error", "Select an action to delete!")
+        if not self.macro_model.rowCount():
+            QMessageBox.warning(self, "Error", "No macro to delete!")
             return
         
-        # Check if there are actual macro actions (not the empty state)
-        if not self.button_data.get("macro", []):
-            QMessageBox.warning(self, "Error", "No macro to delete!")
+        current_row = self.current_macro_display.currentIndex().row()
+        if current_row < 0:
+            QMessageBox.warning(self, "Error", "Select an action to delete!")
             return
         
-        # Filter only key actions
-        key_actions = []
-        key_action_indices = []
-        for i, action in enumerate(self.button_data.get("macro", [])):
-            if "keys" in action and isinstance(action["keys"], list):
-                key_actions.append(action)
-                key_action_indices.append(i)
-        
-        if current_row < len(key_action_indices):
-            original_index = key_action_indices[current_row]
-            del self.button_data["macro"][original_index]
-            self.update_macro_display()
-        else:
-            QMessageBox.warning(self, "Error", "Invalid action!")
+        self.macro_model.remove_row(current_row)
     
     def add_manual_macro(self):
         # Get selected modifier and main key
@@ -313,19 +562,31 @@ class ButtonEditDialog(QDialog):
         }
         
         # Add to macro
-        if not self.button_data["macro"]:
-            self.button_data["macro"] = []
-        
-        self.button_data["macro"].append(new_action)
-        
-        # Update display
-        self.update_macro_display()
+        self.append_actions([new_action])
         
         # Reset inputs
         self.modifier_combo.setCurrentIndex(0)
         self.main_key_combo.setCurrentIndex(0)
         self.delay_spinbox.setValue(100)
     
+    def add_text_macro(self):
+        # Typed escapes let one line hold Enter and Tab
+        text = self.text_input.text().replace("\\n", "\n").replace("\\t", "\t")
+        if not text:
+            QMessageBox.warning(self, "Error", "Please enter some text!")
+            return
+        skipped = untypeable_chars(text)
+        if skipped:
+            QMessageBox.warning(self, "Warning", f"These characters are not on the US layout and will be skipped: "
+                                                 f"{' '.join(skipped)}")
+        
+        new_action = {"action": "text", "text": text, "delay": self.delay_spinbox.value()}
+        # Only a rate that differs from the keymap's text_cps is stored with the action
+        if self.cps_spinbox.value() != self.text_cps:
+            new_action["cps"] = self.cps_spinbox.value()
+        self.append_actions([new_action])
+        self.text_input.clear()
+    
     def toggle_recording(self):
         if not self.recording:
             self.start_recording()
@@ -334,44 +595,63 @@ class ButtonEditDialog(QDialog):
     
     def start_recording(self):
         self.recording = True
+        # Key events go into this buffer; the view catches up on record_timer
+        self.recorded_keys = []
+        self.recorded_delay = 0
         self.recorded_macro = []
-        self.current_keys = []
         self.last_key_time = time.time()
+        self.record_view_count = 0
+        self.record_last_delay = 0
+        self.record_repeats = 0
 
         self.record_btn.setText("Stop")
-        self.record_macro_list = QListWidget()
-        self.record_macro_list.setMinimumHeight(120)
-        self.record_macro_list.setWordWrap(True)
-        self.record_macro_list.addItem("🔴 Recording... Press any keys!")
-        self.record_macro_list.addItem("(This dialog is now capturing keyboard)")
-        self.layout().insertWidget(-2, self.record_macro_list)  # Insert before button layout
+        self.record_status = QLabel("🔴 Recording... Press any keys! (This dialog is now capturing keyboard)")
+        self.record_view = QPlainTextEdit()
+        self.record_view.setReadOnly(True)
+        # Keys must keep going to the dialog, not the view
+        self.record_view.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.record_view.setMinimumHeight(120)
+        self.layout().insertWidget(-2, self.record_status)  # Insert before button layout
+        self.layout().insertWidget(-2, self.record_view)
+        self.record_timer.start()
 
         # Set focus to this dialog
         self.setFocus()
         self.activateWindow()
 
-        print("Recording started in custom dialog")
+        logger.info("Recording started in custom dialog")
+    
+    def refresh_record_view(self):
+        """Append the events recorded since the last refresh; earlier ones are never redrawn"""
+        count = len(self.recorded_keys)
+        if count == self.record_view_count:
+            return
+        self.record_view.appendPlainText(" → ".join(self.recorded_keys[self.record_view_count:count]))
+        self.record_view_count = count
+        repeats = f", {self.record_repeats} auto-repeats skipped" if self.record_repeats else ""
+        self.record_status.setText(f"🔴 Recording: {count} events, last delay {self.record_last_delay}ms{repeats}")
     
     def stop_recording(self):
         self.recording = False
+        self.record_timer.stop()
         self.record_btn.setText("Record")
         
-        if self.recorded_macro:
+        if self.recorded_keys:
             # Add new recorded action to existing macro instead of overwriting
-            if not self.button_data["macro"]:
-                self.button_data["macro"] = []
-            
-            # Add the recorded action to the macro list
-            self.button_data["macro"].extend(self.recorded_macro)
-            self.update_macro_display()
-        
-        # Remove recording list if exists
-        if self.record_macro_list:
-            self.record_macro_list.setParent(None)
-            self.record_macro_list = None
+            self.recorded_macro = [{"keys": self.recorded_keys, "delay": self.recorded_delay}]
+            self.append_actions(self.recorded_macro)
+        logger.info("Recording stopped: %d events, %d auto-repeats skipped",
+                    len(self.recorded_keys), self.record_repeats)
+        
+        # Remove recording view if exists
+        for widget in (self.record_status, self.record_view):
+            if widget is not None:
+                widget.setParent(None)
+        self.record_status = None
+        self.record_view = None
     
     def keyPressEvent(self, event):
-        print(f"ButtonEditDialog keyPressEvent: Recording={self.recording}, Key={event.key()}")
+        logger.debug("ButtonEditDialog keyPressEvent: Recording=%s, Key=%s", self.recording, event.key())
         
         if self.recording:
             self.process_key_event(event, "press")
@@ -381,7 +661,7 @@ class ButtonEditDialog(QDialog):
             super().keyPressEvent(event)
     
     def keyReleaseEvent(self, event):
-        print(f"ButtonEditDialog keyReleaseEvent: Recording={self.recording}, Key={event.key()}")
+        logger.debug("ButtonEditDialog keyReleaseEvent: Recording=%s, Key=%s", self.recording, event.key())
         
         if self.recording:
             self.process_key_event(event, "release")
@@ -391,85 +671,37 @@ class ButtonEditDialog(QDialog):
             super().keyReleaseEvent(event)
     
     def process_key_event(self, event, action_type):
+        # A held key is one press and one release, not Qt's stream of repeats
+        if event.isAutoRepeat():
+            if action_type == "press":
+                self.record_repeats += 1
+            return
+        
         now = time.time()
         delay = int((now - self.last_key_time) * 1000) if self.last_key_time else 0
         self.last_key_time = now
         
-        key_name = ""
         key = event.key()
-        
-        print(f"Processing {action_type} key in dialog: {key}, text: '{event.text()}'")
-        
-        # Check for modifier keys first
-        if key in [Qt.Key_Control, Qt.Key_Alt, Qt.Key_Shift, Qt.Key_Meta]:
-            if key == Qt.Key_Control:
-                key_name = "Ctrl"
-            elif key == Qt.Key_Alt:
-                key_name = "Alt"
-            elif key == Qt.Key_Shift:
-                key_name = "Shift"
-            elif key == Qt.Key_Meta:
-                key_name = "Win"
-        else:
-            # Try to get key name from text first
+        key_name = QT_KEY_NAMES.get(key)
+        if key_name is None:
+            # Other printable keys go by the character they type
             text = event.text()
-            if text and text.isprintable() and len(text) == 1:
-                key_name = text.upper()
-            else:
-                # If no text, try direct key code mapping for letters and numbers
-                if Qt.Key_A <= key <= Qt.Key_Z:
-                    key_name = chr(key)  # Convert key code to letter
-                elif Qt.Key_0 <= key <= Qt.Key_9:
-                    key_name = chr(key)  # Convert key code to number
-                else:
-                    # Special keys mapping
-                    qt_key_map = {
-                        Qt.Key_Tab: "Tab",
-                        Qt.Key_Return: "Enter",
-                        Qt.Key_Enter: "Enter",
-                        Qt.Key_Escape: "Escape",
-                        Qt.Key_Backspace: "Backspace",
-                        Qt.Key_Delete: "Delete",
-                        Qt.Key_Space: "Space",
-                        Qt.Key_Left: "Left",
-                        Qt.Key_Right: "Right",
-                        Qt.Key_Up: "Up",
-                        Qt.Key_Down: "Down",
-                        Qt.Key_F1: "F1", Qt.Key_F2: "F2", Qt.Key_F3: "F3", Qt.Key_F4: "F4",
-                        Qt.Key_F5: "F5", Qt.Key_F6: "F6", Qt.Key_F7: "F7", Qt.Key_F8: "F8",
-                        Qt.Key_F9: "F9", Qt.Key_F10: "F10", Qt.Key_F11: "F11", Qt.Key_F12: "F12",
-                    }
-                    key_name = qt_key_map.get(key, "")
-        
-        print(f"Key name determined: '{key_name}' ({action_type})")
+            key_name = text.upper() if len(text) == 1 and text.isprintable() else ""
         
         if key_name:
             # Add action type to the key name for clarity
             full_key_action = f"{key_name}_{action_type}"
-            self.current_keys.append(full_key_action)
-            
-            if len(self.recorded_macro) == 0:
-                self.recorded_macro.append({
-                    "keys": [full_key_action],
-                    "delay": delay
-                })
-            else:
-                self.recorded_macro[0]["keys"].append(full_key_action)
-            
-            if self.record_macro_list:
-                keys_display = " → ".join(self.current_keys)
-                self.record_macro_list.clear()
-                self.record_macro_list.addItem(f'🔴 Recording: {keys_display}')
-                self.record_macro_list.addItem(f'Total: {len(self.current_keys)} events')
-                self.record_macro_list.addItem(f'Last delay: {delay}ms')
-            
-            print(f"Key {action_type} recorded in dialog: {full_key_action}")
+            if not self.recorded_keys:
+                self.recorded_delay = delay
+            self.recorded_keys.append(full_key_action)
+            self.record_last_delay = delay
+            logger.debug("Key %s recorded in dialog: %s", action_type, full_key_action)
         else:
-            print(f"Key not recognized in dialog: {key} (text: '{event.text()}')")
+            logger.info("Key not recognized in dialog: %s (text: '%s')", key, event.text())
 
     def clear_macro(self):
-        self.button_data["macro"] = []
-        self.update_macro_display()
+        self.macro_model.clear()
+        self.button_data["macro"] = self.macro_model.macro
     
     def open_color_picker(self):
         """Open color picker dialog"""
@@ -503,15 +735,267 @@ class ButtonEditDialog(QDialog):
         # Update button data
         self.button_data["button_color"] = self.current_color
 
+class MacroOptimizerDialog(QDialog):
+    """Preview of optimize_macro() for every button of every layer, applied on request"""
+
+    COLUMNS = ["Layer", "Button", "Events", "Steps", "Playback"]
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.parent_window = parent
+        self.setWindowTitle("Optimize Macros")
+        self.resize(560, 420)
+        self.optimized = {}
+        self.init_ui()
+        self.refresh_preview()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+
+        quantize_layout = QHBoxLayout()
+        quantize_layout.addWidget(QLabel("Quantize delays to (ms, 0 = off):"))
+        self.quantize_spinbox = QSpinBox()
+        self.quantize_spinbox.setRange(0, 1000)
+        self.quantize_spinbox.setSingleStep(5)
+        self.quantize_spinbox.valueChanged.connect(self.refresh_preview)
+        quantize_layout.addWidget(self.quantize_spinbox)
+        quantize_layout.addStretch()
+        layout.addLayout(quantize_layout)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table)
+
+        self.summary_label = QLabel()
+        layout.addWidget(self.summary_label)
+
+        btn_layout = QHBoxLayout()
+        self.apply_btn = QPushButton("Apply")
+        self.apply_btn.clicked.connect(self.apply)
+        btn_layout.addWidget(self.apply_btn)
+        close_btn = QPushButton("Cancel")
+        close_btn.clicked.connect(self.reject)
+        btn_layout.addWidget(close_btn)
+        layout.addLayout(btn_layout)
+        self.setLayout(layout)
+
+    def refresh_preview(self):
+        """Optimize every keys macro with the current quantize step and list what changes"""
+        settings = self.parent_window.keymap_data.get("settings", {})
+        quantize_ms = self.quantize_spinbox.value()
+        self.optimized = {}
+        rows = []
+        before_total = after_total = 0
+        for layer_index, (layer_name, buttons) in enumerate(keymap_layers(self.parent_window.keymap_data)):
+            for button_id, button_data in sorted(buttons.items(), key=lambda item: int(item[0])):
+                macro = button_data.get("macro", [])
+                if not isinstance(macro, list) or not macro:
+                    continue
+                optimized = optimize_macro(macro, quantize_ms)
+                before, after = macro_stats(macro, settings), macro_stats(optimized, settings)
+                # Dropped "delay": 0 fields or merged actions alone are not worth rewriting a button
+                if after[0] == before[0] and macro_steps(optimized, settings) == macro_steps(macro, settings):
+                    continue
+                self.optimized[(layer_index, button_id)] = optimized
+                before_total += before[0]
+                after_total += after[0]
+                rows.append((layer_name, button_data.get("name", f"Macro {int(button_id)+1}"),
+                             f"{before[0]} → {after[0]}", f"{before[1]} → {after[1]}",
+                             f"{before[2]}ms → {after[2]}ms"))
+
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+        if rows:
+            self.summary_label.setText(f"{len(rows)} macros change, {before_total} → {after_total} stored events")
+        else:
+            self.summary_label.setText("All macros are already optimal")
+        self.apply_btn.setEnabled(bool(rows))
+
+    def apply(self):
+        window = self.parent_window
+        layers = keymap_layers(window.keymap_data)
+        for (layer_index, button_id), optimized in self.optimized.items():
+            layers[layer_index][1][button_id]["macro"] = optimized
+        window.save_keymap_json()
+        # Buttons are replaced on the pad one by one, like edits in the button dialog
+        if window.live_client is not None:
+            for layer_index, button_id in self.optimized:
+                window.push_live(f"Button {int(button_id)+1}", window.live_client.send_button, button_id,
+                                 layers[layer_index][1][button_id], layer_index)
+                if window.live_client is None:
+                    break
+        window.statusBar().showMessage(f"Optimized {len(self.optimized)} macros", 3000)
+        self.accept()
+
+
+def write_file_atomic(path, data):
+    """Replace path with data so a crash leaves the old file or the new one, never a mix"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class KeymapSaver(QObject):
+    """Writes keymap.json and keymap.bin on a background thread.
+
+    save() hands over a serialized snapshot of the keymap; snapshots that
+    arrive while a write is in progress collapse into the newest one.
+    Results come back to the GUI thread through the saved and failed signals.
+    """
+
+    saved = Signal(str)
+    failed = Signal(str)
+
+    def __init__(self, json_path, bin_path):
+        super().__init__()
+        self.json_path = json_path
+        self.bin_path = bin_path
+        self.condition = threading.Condition()
+        self.pending = None
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, name="keymap-saver", daemon=True)
+        self.thread.start()
+
+    def save(self, blob):
+        with self.condition:
+            self.pending = blob
+            self.condition.notify()
+
+    def close(self, timeout=10):
+        """Finish the pending write, then stop the thread"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closing:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                blob, self.pending = self.pending, None
+            start = time.perf_counter()
+            try:
+                write_file_atomic(self.json_path, blob)
+            except Exception as e:
+                logger.error("Error saving keymap: %s", e)
+                self.failed.emit(f"Save failed: {e}")
+                continue
+            try:
+                # Packed from the snapshot, so the binary always matches the JSON written with it
+                write_file_atomic(self.bin_path, pack_keymap(json.loads(blob), blob))
+            except Exception as e:
+                logger.error("Error packing keymap.bin: %s", e)
+                # The pad would skip the old binary anyway, as it no longer matches keymap.json
+                try:
+                    os.remove(self.bin_path)
+                except OSError:
+                    pass
+                self.failed.emit(f"keymap.json saved, keymap.bin not written: {e}")
+                continue
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            logger.info("Keymap saved: %d bytes in %.0fms", len(blob), elapsed_ms)
+            self.saved.emit(f"Saved keymap.json ({len(blob) // 1024}KB) in {elapsed_ms:.0f}ms")
+
+
+class KeymapLoader(QObject):
+    """Reads and parses keymap.json on a background thread"""
+
+    loaded = Signal(object)
+    failed = Signal(str)
+
+    def __init__(self, json_path):
+        super().__init__()
+        self.json_path = json_path
+
+    def start(self):
+        threading.Thread(target=self.run, name="keymap-loader", daemon=True).start()
+
+    def run(self):
+        try:
+            with open(self.json_path, "rb") as f:
+                data = f.read()
+            self.loaded.emit(json.loads(data))
+        except FileNotFoundError:
+            self.loaded.emit({"buttons": {}, "settings": {}})
+        except Exception as e:
+            logger.error("Error loading keymap: %s", e)
+            self.failed.emit(str(e))
+
+
+class KeymapDeployer(QObject):
+    """Copies the changed keymap and firmware files to a CIRCUITPY drive on a background thread.
+
+    finished always fires exactly once with a status line, whatever went wrong.
+    """
+
+    finished = Signal(str)
+
+    def __init__(self, drive, keymap_blob, src_dir):
+        super().__init__()
+        self.drive = drive
+        self.keymap_blob = keymap_blob
+        self.src_dir = src_dir
+
+    def start(self):
+        threading.Thread(target=self.run, name="keymap-deployer", daemon=True).start()
+
+    def run(self):
+        status = "Deploy failed"
+        try:
+            changed, written, elapsed = deploy(self.drive, deploy_files(self.keymap_blob, self.src_dir))
+            if changed:
+                status = (f"Wrote {', '.join(changed)} ({written / 1024:.1f}KB), "
+                          f"ready in {elapsed * 1000:.0f}ms; the pad reloads once")
+            else:
+                status = "Pad is up to date, nothing written"
+        except (DeployError, OSError) as e:
+            logger.error("Deploy to %s failed: %s", self.drive, e)
+            status = f"Deploy failed: {e}"
+        except Exception as e:
+            logger.exception("Deploy to %s failed", self.drive)
+            status = f"Deploy failed: {e}"
+        finally:
+            # The GUI re-enables the Deploy button on this signal
+            self.finished.emit(status)
+
+
 class KeymapEditorWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Kyupad Keymap Editor")
         self.resize(600, 500)
         self.center_window()
-        self.keymap_data = self.load_keymap_json()
+        # Empty until the loader thread has read keymap.json
+        self.keymap_data = {"buttons": {}, "settings": {}}
         self.buttons = {}  # Store button references
+        self.current_layer = 0  # Layer shown in the grid
+        self.live_client = None
         self.init_ui()
+        src_dir = os.path.dirname(__file__)
+        self.saver = KeymapSaver(os.path.join(src_dir, "keymap.json"), os.path.join(src_dir, "keymap.bin"))
+        self.saver.saved.connect(self.statusBar().showMessage)
+        self.saver.failed.connect(self.statusBar().showMessage)
+        self.save_timer = QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(SAVE_DEBOUNCE_MS)
+        self.save_timer.timeout.connect(self.flush_save)
+        self.load_keymap_json()
+        # Ctrl+Shift+L writes the recent log records to the console
+        self.dump_log_shortcut = QShortcut(QKeySequence("Ctrl+Shift+L"), self)
+        self.dump_log_shortcut.activated.connect(log_ring.dump)
 
     def center_window(self):
         screen = QApplication.primaryScreen()
@@ -522,20 +1006,71 @@ class KeymapEditorWindow(QMainWindow):
         self.move(window_geometry.topLeft())
 
     def load_keymap_json(self):
-        json_path = os.path.join(os.path.dirname(__file__), "keymap.json")
-        try:
-            with open(json_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            return {"buttons": {}, "settings": {}}
+        """Read keymap.json off the GUI thread; editing is enabled once it is in"""
+        self.centralWidget().setEnabled(False)
+        self.statusBar().showMessage("Loading keymap.json...")
+        self.loader = KeymapLoader(os.path.join(os.path.dirname(__file__), "keymap.json"))
+        self.loader.loaded.connect(self.on_keymap_loaded)
+        self.loader.failed.connect(self.on_keymap_load_failed)
+        self.loader.start()
+
+    def on_keymap_loaded(self, keymap_data):
+        self.keymap_data = keymap_data
+        self.current_layer = 0
+        self.refresh_settings()
+        self.refresh_layer_combo()
+        self.centralWidget().setEnabled(True)
+        self.statusBar().showMessage("Keymap loaded", 3000)
+
+    def on_keymap_load_failed(self, error):
+        # Same as a missing file: start from an empty keymap
+        self.centralWidget().setEnabled(True)
+        self.statusBar().showMessage(f"Could not load keymap.json: {error}")
 
     def save_keymap_json(self):
-        json_path = os.path.join(os.path.dirname(__file__), "keymap.json")
-        try:
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(self.keymap_data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Error saving keymap: {e}")
+        """Schedule a save; rapid edits are written together once they settle"""
+        self.statusBar().showMessage("Saving...")
+        self.save_timer.start()
+
+    def keymap_blob(self):
+        """Serialized snapshot of self.keymap_data as written to keymap.json"""
+        # Compact JSON uses the C encoder, so the snapshot is quick even for long recordings
+        return json.dumps(self.keymap_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def flush_save(self):
+        """Hand a snapshot to the saver thread; keymap.bin is packed there alongside"""
+        self.save_timer.stop()
+        self.saver.save(self.keymap_blob())
+
+    def refresh_drives(self):
+        drives = find_drives()
+        self.drive_combo.clear()
+        self.drive_combo.addItems(drives)
+        self.deploy_status_label.setText("" if drives else "No CIRCUITPY drive found")
+
+    def deploy_to_drive(self):
+        """Copy the keymap and firmware files that differ from the drive's copies"""
+        drive = self.drive_combo.currentText()
+        if not drive:
+            self.refresh_drives()
+            drive = self.drive_combo.currentText()
+            if not drive:
+                return
+        self.deploy_btn.setEnabled(False)
+        self.deploy_status_label.setText(f"Deploying to {drive}...")
+        self.deployer = KeymapDeployer(drive, self.keymap_blob(), os.path.dirname(__file__))
+        self.deployer.finished.connect(self.on_deploy_done)
+        self.deployer.start()
+
+    def on_deploy_done(self, status_text):
+        self.deploy_btn.setEnabled(True)
+        self.deploy_status_label.setText(status_text)
+
+    def closeEvent(self, event):
+        if self.save_timer.isActive():
+            self.flush_save()
+        self.saver.close()
+        super().closeEvent(event)
 
     def init_ui(self):
         central_widget = QWidget()
@@ -549,77 +1084,213 @@ class KeymapEditorWindow(QMainWindow):
 
         # Version (read-only)
         settings_layout.addWidget(QLabel("Version:"), 0, 0)
-        self.version_label = QLabel(str(self.keymap_data.get("version", "?")))
+        self.version_label = QLabel()
         settings_layout.addWidget(self.version_label, 0, 1)
 
         # Bluetooth enabled (editable)
         settings_layout.addWidget(QLabel("Bluetooth Enabled:"), 1, 0)
         self.bluetooth_combo = QComboBox()
         self.bluetooth_combo.addItems(["True", "False"])
-        bt_enabled = self.keymap_data.get("settings", {}).get("auto_reconnect", True)
-        self.bluetooth_combo.setCurrentText("True" if bt_enabled else "False")
         settings_layout.addWidget(self.bluetooth_combo, 1, 1)
 
         # Sleep timeout (editable)
         settings_layout.addWidget(QLabel("Sleep Timeout (min):"), 2, 0)
         self.sleep_spinbox = QSpinBox()
         self.sleep_spinbox.setRange(1, 999)
-        self.sleep_spinbox.setValue(self.keymap_data.get("settings", {}).get("sleep_timeout_minutes", 30))
         settings_layout.addWidget(self.sleep_spinbox, 2, 1)
 
         # Device ID (editable)
         settings_layout.addWidget(QLabel("Device ID:"), 3, 0)
         self.device_id_spinbox = QSpinBox()
         self.device_id_spinbox.setRange(1, 9999)
-        self.device_id_spinbox.setValue(self.keymap_data.get("settings", {}).get("device_id", 1))
         settings_layout.addWidget(self.device_id_spinbox, 3, 1)
 
         # Device Name (editable)
         settings_layout.addWidget(QLabel("Device Name:"), 4, 0)
-        self.device_name_edit = QLineEdit(self.keymap_data.get("settings", {}).get("device_name", "Kyupad-1"))
+        self.device_name_edit = QLineEdit()
         settings_layout.addWidget(self.device_name_edit, 4, 1)
 
         # Auto reconnect (editable)
         settings_layout.addWidget(QLabel("Auto Reconnect:"), 5, 0)
         self.auto_reconnect_combo = QComboBox()
         self.auto_reconnect_combo.addItems(["True", "False"])
-        auto_reconnect = self.keymap_data.get("settings", {}).get("auto_reconnect", True)
-        self.auto_reconnect_combo.setCurrentText("True" if auto_reconnect else "False")
         settings_layout.addWidget(self.auto_reconnect_combo, 5, 1)
 
         # Power save mode (editable)
         settings_layout.addWidget(QLabel("Power Save Mode:"), 6, 0)
         self.power_save_combo = QComboBox()
         self.power_save_combo.addItems(["True", "False"])
-        power_save = self.keymap_data.get("settings", {}).get("power_save_mode", True)
-        self.power_save_combo.setCurrentText("True" if power_save else "False")
         settings_layout.addWidget(self.power_save_combo, 6, 1)
 
+        # Live push to a running pad over its USB data serial port
+        settings_layout.addWidget(QLabel("Live Pad Port:"), 7, 0)
+        live_layout = QHBoxLayout()
+        self.live_port_edit = QLineEdit(os.environ.get("KYUPAD_PORT", ""))
+        self.live_port_edit.setPlaceholderText("e.g. /dev/ttyACM1 or COM5")
+        live_layout.addWidget(self.live_port_edit)
+        self.live_connect_btn = QPushButton("Connect")
+        self.live_connect_btn.clicked.connect(self.toggle_live_connection)
+        live_layout.addWidget(self.live_connect_btn)
+        settings_layout.addLayout(live_layout, 7, 1)
+        self.live_status_label = QLabel("Not connected")
+        settings_layout.addWidget(self.live_status_label, 8, 1)
+
+        # Copy the keymap and firmware to the pad's CIRCUITPY drive
+        settings_layout.addWidget(QLabel("Pad Drive:"), 9, 0)
+        drive_layout = QHBoxLayout()
+        self.drive_combo = QComboBox()
+        drive_layout.addWidget(self.drive_combo, 1)
+        refresh_drives_btn = QPushButton("Refresh")
+        refresh_drives_btn.clicked.connect(self.refresh_drives)
+        drive_layout.addWidget(refresh_drives_btn)
+        self.deploy_btn = QPushButton("Deploy")
+        self.deploy_btn.clicked.connect(self.deploy_to_drive)
+        drive_layout.addWidget(self.deploy_btn)
+        settings_layout.addLayout(drive_layout, 9, 1)
+        self.deploy_status_label = QLabel()
+        settings_layout.addWidget(self.deploy_status_label, 10, 1)
+        self.refresh_drives()
+
         # Save button
         self.save_settings_btn = QPushButton("Save Settings")
         self.save_settings_btn.clicked.connect(self.save_basic_settings)
-        settings_layout.addWidget(self.save_settings_btn, 7, 0, 1, 2)
+        settings_layout.addWidget(self.save_settings_btn, 11, 0, 1, 2)
 
         settings_group.setLayout(settings_layout)
         main_layout.addWidget(settings_group)
 
+        # --- Layer selector ---
+        layer_layout = QHBoxLayout()
+        layer_layout.addWidget(QLabel("Layer:"))
+        self.layer_combo = QComboBox()
+        self.layer_combo.addItems(self.layer_names())
+        self.layer_combo.currentIndexChanged.connect(self.on_layer_changed)
+        layer_layout.addWidget(self.layer_combo, 1)
+        self.add_layer_btn = QPushButton("Add Layer")
+        self.add_layer_btn.clicked.connect(self.add_layer)
+        layer_layout.addWidget(self.add_layer_btn)
+        self.remove_layer_btn = QPushButton("Remove Layer")
+        self.remove_layer_btn.clicked.connect(self.remove_layer)
+        layer_layout.addWidget(self.remove_layer_btn)
+        self.optimize_btn = QPushButton("Optimize Macros")
+        self.optimize_btn.clicked.connect(lambda: MacroOptimizerDialog(self).exec())
+        layer_layout.addWidget(self.optimize_btn)
+        main_layout.addLayout(layer_layout)
+
         # --- Grid of buttons ---
         grid_layout = QGridLayout()
         grid_layout.setSpacing(10)
         for row in range(4):
             for col in range(4):
                 button_id = str(row * 4 + col)
-                button_data = self.keymap_data.get("buttons", {}).get(button_id, {})
-                btn_text = button_data.get("name", f"Macro {int(button_id)+1}")
-                btn_color = button_data.get("button_color", "#CCCCCC")
-                btn = QPushButton(btn_text)
+                btn = QPushButton()
                 btn.setMinimumSize(80, 60)
-                btn.setStyleSheet(f"background-color: {btn_color}; color: white; font-weight: bold; font-size: 14px;")
                 btn.clicked.connect(lambda checked, bid=button_id: self.show_edit_dialog(bid))
                 self.buttons[button_id] = btn
                 grid_layout.addWidget(btn, row, col)
         main_layout.addLayout(grid_layout)
         central_widget.setLayout(main_layout)
+        self.refresh_settings()
+        self.refresh_grid()
+
+    def refresh_settings(self):
+        """Show the settings of self.keymap_data in the settings area"""
+        settings = self.keymap_data.get("settings", {})
+        self.version_label.setText(str(self.keymap_data.get("version", "?")))
+        # Bluetooth enabled is mapped to auto_reconnect for simplicity
+        self.bluetooth_combo.setCurrentText("True" if settings.get("auto_reconnect", True) else "False")
+        self.sleep_spinbox.setValue(settings.get("sleep_timeout_minutes", 30))
+        self.device_id_spinbox.setValue(settings.get("device_id", 1))
+        self.device_name_edit.setText(settings.get("device_name", "Kyupad-1"))
+        self.auto_reconnect_combo.setCurrentText("True" if settings.get("auto_reconnect", True) else "False")
+        self.power_save_combo.setCurrentText("True" if settings.get("power_save_mode", True) else "False")
+
+    def layer_names(self):
+        return [name for name, _ in keymap_layers(self.keymap_data)]
+
+    def layer_buttons(self):
+        """Buttons dict of the layer shown in the grid; layer 0 is the top-level "buttons" """
+        if self.current_layer == 0:
+            return self.keymap_data.setdefault("buttons", {})
+        return self.keymap_data["layers"][self.current_layer - 1].setdefault("buttons", {})
+
+    def refresh_grid(self):
+        buttons = self.layer_buttons()
+        for button_id in self.buttons:
+            button_data = buttons.get(button_id, {})
+            self.update_button_text(button_id, button_data.get("name", f"Macro {int(button_id)+1}"))
+            self.update_button_color(button_id, button_data.get("button_color", "#CCCCCC"))
+        self.remove_layer_btn.setEnabled(self.current_layer > 0)
+        self.add_layer_btn.setEnabled(len(self.layer_names()) < MAX_LAYERS)
+
+    def refresh_layer_combo(self):
+        self.layer_combo.blockSignals(True)
+        self.layer_combo.clear()
+        self.layer_combo.addItems(self.layer_names())
+        self.layer_combo.setCurrentIndex(self.current_layer)
+        self.layer_combo.blockSignals(False)
+        self.refresh_grid()
+
+    def on_layer_changed(self, index):
+        if index < 0:
+            return
+        self.current_layer = index
+        self.refresh_grid()
+        # Follow the editor on the pad, without changing the layer it boots into
+        if self.live_client is not None:
+            self.push_live(f"Layer {self.layer_combo.currentText()}", self.live_client.select_layer, index,
+                           persist=False)
+
+    def add_layer(self):
+        name, ok = QInputDialog.getText(self, "Add Layer", "Layer name:")
+        name = name.strip()
+        if not ok or not name:
+            return
+        if name in self.layer_names():
+            QMessageBox.warning(self, "Error", f"There already is a layer named {name}!")
+            return
+        self.keymap_data.setdefault("layers", []).append({"name": name, "buttons": {}})
+        self.save_keymap_json()
+        self.current_layer = len(self.layer_names()) - 1
+        self.refresh_layer_combo()
+        if self.live_client is not None:
+            self.live_status_label.setText(f"Layer {name} reaches the pad after a restart")
+
+    def remove_layer(self):
+        if self.current_layer == 0:
+            return
+        name = self.layer_combo.currentText()
+        answer = QMessageBox.question(self, "Remove Layer", f"Remove layer {name} and its buttons?")
+        if answer != QMessageBox.StandardButton.Yes:
+            return
+        del self.keymap_data["layers"][self.current_layer - 1]
+        if not self.keymap_data["layers"]:
+            del self.keymap_data["layers"]
+        cleared = self.retarget_layer_keys(self.current_layer, name)
+        self.save_keymap_json()
+        self.current_layer -= 1
+        self.refresh_layer_combo()
+        if cleared:
+            self.statusBar().showMessage(f"{cleared} layer keys to {name} cleared", 5000)
+
+    def retarget_layer_keys(self, removed, name):
+        """Clear layer keys that went to the removed layer and renumber those past it; returns the cleared count"""
+        cleared = 0
+        for _, buttons in keymap_layers(self.keymap_data):
+            for button_data in buttons.values():
+                target = button_data.get("layer")
+                if target == name or target == removed:
+                    del button_data["layer"]
+                    cleared += 1
+                elif isinstance(target, int) and target > removed:
+                    button_data["layer"] = target - 1
+        settings = self.keymap_data.get("settings", {})
+        default_layer = settings.get("default_layer")
+        if default_layer == name or default_layer == removed:
+            del settings["default_layer"]
+        elif isinstance(default_layer, int) and default_layer > removed:
+            settings["default_layer"] = default_layer - 1
+        return cleared
 
     def save_basic_settings(self):
         # Save settings from UI to keymap_data and file
@@ -632,9 +1303,68 @@ class KeymapEditorWindow(QMainWindow):
         # Bluetooth enabled is mapped to auto_reconnect for simplicity
         settings["auto_reconnect"] = self.bluetooth_combo.currentText() == "True"
         self.save_keymap_json()
+        self.push_settings({key: settings[key] for key in ("sleep_timeout_minutes", "device_id", "device_name",
+                                                           "auto_reconnect", "power_save_mode")})
         QMessageBox.information(self, "Settings Saved", "Basic settings have been saved.")
     # Removed duplicate init_ui method. Only the correct version with settings/info area remains.
     
+    def toggle_live_connection(self):
+        if self.live_client is not None:
+            self.close_live_connection("Not connected")
+            return
+        port = self.live_port_edit.text().strip()
+        if not port:
+            self.live_status_label.setText("Enter the pad's data serial port")
+            return
+        try:
+            self.live_client = LiveKeymapClient.open(port)
+            self.live_client.ping()
+        except (LiveKeymapError, OSError) as e:
+            logger.warning("Live connection to %s failed: %s", port, e)
+            self.close_live_connection(f"Connection failed: {e}")
+            return
+        self.live_connect_btn.setText("Disconnect")
+        self.live_status_label.setText(f"Connected to {port}")
+
+    def close_live_connection(self, status_text):
+        if self.live_client is not None:
+            try:
+                self.live_client.close()
+            except OSError:
+                pass
+            self.live_client = None
+        self.live_connect_btn.setText("Connect")
+        self.live_status_label.setText(status_text)
+
+    def push_button(self, button_id):
+        """Send one edited button to the connected pad"""
+        if self.live_client is None:
+            return
+        button_data = self.layer_buttons().get(button_id)
+        self.push_live(f"Button {int(button_id)+1}", self.live_client.send_button, button_id, button_data,
+                       self.current_layer)
+
+    def push_settings(self, settings):
+        if self.live_client is None:
+            return
+        self.push_live("Settings", self.live_client.send_settings, settings)
+
+    def push_live(self, what, send, *args, persist=True):
+        try:
+            status, apply_us = send(*args, persist=persist)
+        except (LiveKeymapError, OSError) as e:
+            logger.warning("Live push failed: %s", e)
+            self.close_live_connection(f"Disconnected: {e}")
+            return
+        round_trip_ms = self.live_client.last_round_trip_s * 1000
+        if status == STATUS_PERSIST_FAILED:
+            text = f"{what} applied, not saved on the pad (read-only drive)"
+        elif status == STATUS_OK:
+            text = f"{what} applied in {round_trip_ms:.0f}ms"
+        else:
+            text = f"{what}: {STATUS_NAMES[status]}"
+        self.live_status_label.setText(text)
+
     def update_button_text(self, button_id, text):
         """Update button text when name changes"""
         if button_id in self.buttons:
@@ -654,6 +1384,7 @@ class KeymapEditorWindow(QMainWindow):
         dialog.exec()
 
 if __name__ == "__main__":
+    setup_logging()
     app = QApplication(sys.argv)
     window = KeymapEditorWindow()
     window.show()
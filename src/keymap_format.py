@@ -0,0 +1,688 @@
+import binascii
+import json
+import struct
+
+# Shared by the keymap editor (desktop Python) and the firmware (CircuitPython),
+# so everything here has to run on both.
+
+# HID keyboard usage IDs for the key names used in keymap.json
+KEYCODES = {
+    'A': 0x04, 'B': 0x05, 'C': 0x06, 'D': 0x07, 'E': 0x08, 'F': 0x09,
+    'G': 0x0A, 'H': 0x0B, 'I': 0x0C, 'J': 0x0D, 'K': 0x0E, 'L': 0x0F,
+    'M': 0x10, 'N': 0x11, 'O': 0x12, 'P': 0x13, 'Q': 0x14, 'R': 0x15,
+    'S': 0x16, 'T': 0x17, 'U': 0x18, 'V': 0x19, 'W': 0x1A, 'X': 0x1B,
+    'Y': 0x1C, 'Z': 0x1D,
+    '1': 0x1E, '2': 0x1F, '3': 0x20, '4': 0x21, '5': 0x22,
+    '6': 0x23, '7': 0x24, '8': 0x25, '9': 0x26, '0': 0x27,
+    'Enter': 0x28, 'Escape': 0x29, 'Backspace': 0x2A, 'Tab': 0x2B, 'Space': 0x2C,
+    'CapsLock': 0x39,
+    'F1': 0x3A, 'F2': 0x3B, 'F3': 0x3C, 'F4': 0x3D, 'F5': 0x3E, 'F6': 0x3F,
+    'F7': 0x40, 'F8': 0x41, 'F9': 0x42, 'F10': 0x43, 'F11': 0x44, 'F12': 0x45,
+    'PrintScreen': 0x46, 'ScrollLock': 0x47, 'Pause': 0x48, 'Insert': 0x49,
+    'Home': 0x4A, 'PageUp': 0x4B, 'Delete': 0x4C, 'End': 0x4D, 'PageDown': 0x4E,
+    'Right': 0x4F, 'Left': 0x50, 'Down': 0x51, 'Up': 0x52, 'NumLock': 0x53,
+    # Modifier keys
+    'Ctrl': 0xE0,
+    'Shift': 0xE1,
+    'Alt': 0xE2,
+    'Win': 0xE3
+}
+
+MODIFIER_NAMES = ('Ctrl', 'Alt', 'Shift', 'Win')
+
+# Compiled macro step operations
+OP_PRESS = 0
+OP_RELEASE = 1
+OP_RELEASE_ALL = 2
+
+# Default minimum time a pressed key is held before its release report
+DEFAULT_MIN_HOLD_MS = 10
+
+# Text actions type a string through the US layout: the character at index i
+# of a table is HID usage 0x04 + i, typed with Shift held for TEXT_SHIFTED.
+# \x00 marks usages with no character of their own.
+TEXT_UNSHIFTED = "abcdefghijklmnopqrstuvwxyz1234567890\n\x00\x00\t -=[]\\\x00;'`,./"
+TEXT_SHIFTED = "ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&*()\x00\x00\x00\x00\x00_+{}|\x00:\"~<>?"
+TEXT_FIRST_USAGE = 0x04
+
+# Every character is a press and a release report and the host has to poll
+# each one: BLE hosts commonly poll every 15ms (about 33 cps), USB keyboards
+# every 1-8ms. text_cps, or cps on the action, raises it for USB-only use.
+DEFAULT_TEXT_CPS = 30
+
+# Layers: the top-level "buttons" are layer 0 and "layers" adds more, each
+# {"name": ..., "buttons": {...}}. A button with a "layer" field is a layer
+# key: pressing it switches to that layer (a name, a number, "next" or "prev")
+# instead of playing a macro.
+MAX_LAYERS = 16
+LAYER_NEXT = -1
+LAYER_PREV = -2
+DEFAULT_BASE_LAYER_NAME = 'Base'
+
+# Binary keymap layout (all little endian):
+#   header       magic, version, button count (u16), metadata length, keymap.json size
+#   metadata     compact JSON: {"settings": {...}, "names": [name or null, ...],
+#                "layers": [layer name, ...], "targets": [layer key target or null, ...],
+#                "debounce": [base layer debounce_ms override or null, ...],
+#                "source_crc": CRC-32 of keymap.json}
+#   index        per button: offset of its first step record, step count
+#   steps        per step: delay in ms (already scaled), op, keycode
+# Buttons are numbered layer * 16 + button; version 1 files have one layer
+# and no layer fields in the metadata. Files before version 3 carry no
+# source_crc, so they cannot be matched to keymap.json. Before version 4
+# the button count was a single byte, too small for MAX_LAYERS layers.
+KEYMAP_BIN_MAGIC = b'KYPD'
+KEYMAP_BIN_VERSION = 4
+BIN_HEADER = '<4sBHHI'
+BIN_HEADER_SIZE = struct.calcsize(BIN_HEADER)
+BIN_HEADER_V3 = '<4sBBHI'
+BIN_PREFIX = '<4sB'
+BIN_PREFIX_SIZE = struct.calcsize(BIN_PREFIX)
+BIN_INDEX_ENTRY = '<IH'
+BIN_INDEX_ENTRY_SIZE = struct.calcsize(BIN_INDEX_ENTRY)
+BIN_STEP = '<IBB'
+BIN_STEP_SIZE = struct.calcsize(BIN_STEP)
+BUTTON_COUNT = 16
+
+
+def get_keycode(key_name):
+    return KEYCODES.get(key_name, None)
+
+
+def scale_delay(delay, macro_speed):
+    """Convert a JSON delay in ms to playback ms using macro_playback_speed"""
+    if delay <= 0:
+        return 0
+    return int(delay / macro_speed)
+
+
+def parse_macro_legacy(macro_string):
+    """Parse a legacy "Ctrl+Shift+K" string into (modifier keycodes, keycode)"""
+    if not macro_string:
+        return None
+
+    modifiers = []
+    key = None
+    for part in macro_string.split('+'):
+        part = part.strip()
+        if part in MODIFIER_NAMES:
+            modifiers.append(KEYCODES[part])
+        else:
+            key = get_keycode(part)
+
+    if key is not None:
+        return modifiers, key
+    return None
+
+
+def compile_legacy_steps(parsed, delay, min_hold_ms, steps):
+    """Append the steps for a parsed legacy chord (modifiers + key tap)"""
+    if not parsed:
+        return
+    modifiers, key = parsed
+    for keycode in modifiers + [key]:
+        steps.append((delay, OP_PRESS, keycode))
+        delay = 0
+    steps.append((min_hold_ms, OP_RELEASE_ALL, 0))
+
+
+def text_usage(char):
+    """(keycode, shifted) that types char, or None if the layout has no such character"""
+    if char == '\x00':
+        return None
+    index = TEXT_UNSHIFTED.find(char)
+    if index >= 0:
+        return TEXT_FIRST_USAGE + index, False
+    index = TEXT_SHIFTED.find(char)
+    if index >= 0:
+        return TEXT_FIRST_USAGE + index, True
+    return None
+
+
+def untypeable_chars(text):
+    """Characters of text a text action would skip"""
+    return sorted(set(char for char in text if text_usage(char) is None))
+
+
+def compile_text(text, delay, cps, min_hold_ms, steps):
+    """Append the steps that type text at cps characters per second.
+
+    Each character is one press and one release report, held for half the
+    character period. Shift goes down with the first of a run of shifted
+    characters and up with the release of the last one, so it costs no
+    reports of its own. Characters the layout lacks are skipped.
+    """
+    period = max(2, round(1000 / max(1, cps)))
+    hold = max(min_hold_ms, period // 2)
+    gap = max(1, period - hold)
+    shift = KEYCODES['Shift']
+    shift_down = False
+    step_delay = delay
+    for char in text:
+        usage = text_usage(char)
+        if usage is None:
+            continue
+        keycode, shifted = usage
+        if shifted and not shift_down:
+            steps.append((step_delay, OP_PRESS, shift))
+            step_delay = 0
+        elif shift_down and not shifted:
+            steps.append((0, OP_RELEASE, shift))
+        shift_down = shifted
+        steps.append((step_delay, OP_PRESS, keycode))
+        steps.append((hold, OP_RELEASE, keycode))
+        step_delay = gap
+    if shift_down:
+        steps.append((0, OP_RELEASE, shift))
+
+
+def compile_action(action, delay, min_hold_ms, text_cps, steps):
+    """Append the steps for one macro action, its first event delayed by delay"""
+    # Support new simple format with keys array
+    if 'keys' in action and isinstance(action['keys'], list):
+        last_op = None
+        for key in action['keys']:
+            # Check if this is a press/release action
+            if '_' in key and (key.endswith('_press') or key.endswith('_release')):
+                key_name, press_release = key.rsplit('_', 1)
+                keycode = get_keycode(key_name)
+                if keycode:
+                    op = OP_PRESS if press_release == 'press' else OP_RELEASE
+                    if last_op is None:
+                        step_delay = delay
+                    elif op == OP_RELEASE and last_op == OP_PRESS:
+                        step_delay = min_hold_ms
+                    else:
+                        step_delay = 0
+                    steps.append((step_delay, op, keycode))
+                    last_op = op
+            else:
+                # Regular keyboard keys - treat as press+release
+                keycode = get_keycode(key)
+                if keycode:
+                    steps.append((delay if last_op is None else 0, OP_PRESS, keycode))
+                    steps.append((min_hold_ms, OP_RELEASE_ALL, 0))
+                    last_op = OP_RELEASE_ALL
+
+    elif action.get('action') == 'text':
+        compile_text(action.get('text', ''), delay, action.get('cps', text_cps), min_hold_ms, steps)
+
+    # Support legacy format with action type
+    elif action.get('action', 'key') == 'key':
+        compile_legacy_steps(parse_macro_legacy(action.get('keys', '')), delay, min_hold_ms, steps)
+
+
+def compile_macro(macro, macro_speed, min_hold_ms, text_cps=DEFAULT_TEXT_CPS):
+    """Compile a macro into a list of (delay_ms, op, keycode) steps.
+
+    Both the keys-array format and legacy "Ctrl+C" strings end up in this
+    form. An action's delay comes before its first key event; the remaining
+    events of the action share that moment and are merged into one HID
+    report, except that a release following a press waits min_hold_ms.
+    Text actions ({"action": "text", "text": ..., "cps": ...}) are paced by
+    cps instead, which macro_speed does not scale. An action with
+    "repeat": n plays n times in a row, each time after its delay.
+    """
+    steps = []
+    if not isinstance(macro, list):
+        compile_legacy_steps(parse_macro_legacy(macro), 0, min_hold_ms, steps)
+        return steps
+
+    for action in macro:
+        if not isinstance(action, dict):
+            continue
+
+        delay = scale_delay(action.get('delay', 0), macro_speed)
+        for _ in range(action.get('repeat', 1)):
+            compile_action(action, delay, min_hold_ms, text_cps, steps)
+
+    return steps
+
+
+# Streaming keymap.json loader
+STREAM_CHUNK_SIZE = 512
+WHITESPACE = b' \t\r\n'
+SCALAR_END = b',}] \t\r\n'
+QUOTE = 0x22
+BACKSLASH = 0x5C
+COLON = 0x3A
+COMMA = 0x2C
+OPEN_OBJECT = 0x7B
+CLOSE_OBJECT = 0x7D
+OPEN_ARRAY = 0x5B
+CLOSE_ARRAY = 0x5D
+
+
+class KeymapStreamReader:
+    """Reads keymap.json in small chunks and keeps only what the firmware runs.
+
+    Of each button only name, macro, debounce_ms and layer are kept; descriptions,
+    colors and other editor-only fields are stepped over without being
+    built. Macros are parsed one at a time, so only one macro's text is in
+    memory at once, and key names are interned so a key used in many macros
+    is a single string. sample, if given, is called after every button, e.g.
+    to track the heap high-water mark.
+    """
+
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE, sample=None):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.sample = sample
+        self.chunk = b''
+        self.pos = 0
+        self.interned = {}
+
+    def peek(self):
+        if self.pos >= len(self.chunk):
+            self.chunk = self.f.read(self.chunk_size)
+            self.pos = 0
+            if not self.chunk:
+                raise ValueError("keymap.json ended early")
+        return self.chunk[self.pos]
+
+    def skip_whitespace(self):
+        while self.peek() in WHITESPACE:
+            self.pos += 1
+
+    def expect(self, char):
+        self.skip_whitespace()
+        if self.peek() != char:
+            raise ValueError(f"Expected '{chr(char)}' in keymap.json")
+        self.pos += 1
+
+    def scan_value(self, keep):
+        """Move past one JSON value; returns its raw bytes if keep"""
+        self.skip_whitespace()
+        parts = [] if keep else None
+        first = self.peek()
+        scalar = first != QUOTE and first != OPEN_OBJECT and first != OPEN_ARRAY
+        depth = 0
+        in_string = False
+        escaped = False
+        while True:
+            chunk = self.chunk
+            start = pos = self.pos
+            end = len(chunk)
+            done = False
+            while pos < end:
+                if in_string:
+                    if escaped:
+                        escaped = False
+                        pos += 1
+                        continue
+                    # Jump to the closing quote unless a backslash comes first
+                    quote = chunk.find(b'"', pos)
+                    backslash = chunk.find(b'\\', pos, end if quote < 0 else quote)
+                    if backslash >= 0:
+                        escaped = True
+                        pos = backslash + 1
+                    elif quote < 0:
+                        pos = end
+                    else:
+                        pos = quote + 1
+                        in_string = False
+                        if not depth:
+                            done = True
+                            break
+                    continue
+                if depth:
+                    # Up to the next string, only count brackets, unless the value may close there
+                    quote = chunk.find(b'"', pos)
+                    stop = end if quote < 0 else quote
+                    closes = chunk.count(b'}', pos, stop) + chunk.count(b']', pos, stop)
+                    if depth > closes:
+                        depth += chunk.count(b'{', pos, stop) + chunk.count(b'[', pos, stop) - closes
+                        if quote < 0:
+                            pos = end
+                        else:
+                            pos = quote + 1
+                            in_string = True
+                        continue
+                char = chunk[pos]
+                pos += 1
+                if scalar:
+                    if char in SCALAR_END:
+                        pos -= 1
+                        done = True
+                        break
+                elif char == QUOTE:
+                    in_string = True
+                elif char == OPEN_OBJECT or char == OPEN_ARRAY:
+                    depth += 1
+                elif char == CLOSE_OBJECT or char == CLOSE_ARRAY:
+                    depth -= 1
+                    if not depth:
+                        done = True
+                        break
+            if keep:
+                parts.append(chunk[start:pos])
+            self.pos = pos
+            if done:
+                return b''.join(parts) if keep else None
+            self.peek()
+
+    def members(self):
+        """Yield the keys of the object at the current position; the caller reads each value"""
+        self.expect(OPEN_OBJECT)
+        self.skip_whitespace()
+        if self.peek() == CLOSE_OBJECT:
+            self.pos += 1
+            return
+        while True:
+            key = self.scan_value(True)[1:-1]
+            self.expect(COLON)
+            yield key
+            self.skip_whitespace()
+            char = self.peek()
+            self.pos += 1
+            if char == CLOSE_OBJECT:
+                return
+            if char != COMMA:
+                raise ValueError("Expected ',' or '}' in keymap.json")
+
+    def elements(self):
+        """Step into the array at the current position; yields once per element for the caller to read"""
+        self.expect(OPEN_ARRAY)
+        self.skip_whitespace()
+        if self.peek() == CLOSE_ARRAY:
+            self.pos += 1
+            return
+        while True:
+            yield
+            self.skip_whitespace()
+            char = self.peek()
+            self.pos += 1
+            if char == CLOSE_ARRAY:
+                return
+            if char != COMMA:
+                raise ValueError("Expected ',' or ']' in keymap.json")
+
+    def read_buttons(self):
+        buttons = {}
+        for button_id in self.members():
+            buttons[button_id.decode('utf-8')] = self.read_button()
+        return buttons
+
+    def intern(self, name):
+        return self.interned.setdefault(name, name)
+
+    def read_button(self):
+        button = {}
+        for field in self.members():
+            if field == b'macro':
+                macro = json.loads(self.scan_value(True))
+                # Legacy "Ctrl+C" string macros pass through as they are
+                for action in macro if isinstance(macro, list) else ():
+                    if not isinstance(action, dict):
+                        continue
+                    keys = action.get('keys')
+                    if isinstance(keys, list):
+                        for i in range(len(keys)):
+                            keys[i] = self.intern(keys[i])
+                    elif isinstance(keys, str):
+                        action['keys'] = self.intern(keys)
+                button['macro'] = macro
+            elif field == b'name':
+                button['name'] = json.loads(self.scan_value(True))
+            elif field == b'debounce_ms' or field == b'layer':
+                button[field.decode('utf-8')] = json.loads(self.scan_value(True))
+            else:
+                self.scan_value(False)
+        if self.sample is not None:
+            self.sample()
+        return button
+
+    def load(self):
+        keymap_data = {'buttons': {}, 'settings': {}}
+        for key in self.members():
+            if key == b'buttons':
+                keymap_data['buttons'] = self.read_buttons()
+            elif key == b'layers':
+                layers = keymap_data['layers'] = []
+                for _ in self.elements():
+                    layer = {}
+                    for field in self.members():
+                        if field == b'name':
+                            layer['name'] = json.loads(self.scan_value(True))
+                        elif field == b'buttons':
+                            layer['buttons'] = self.read_buttons()
+                        else:
+                            self.scan_value(False)
+                    layers.append(layer)
+            elif key == b'settings':
+                keymap_data['settings'] = json.loads(self.scan_value(True))
+            else:
+                self.scan_value(False)
+        return keymap_data
+
+
+def load_keymap_stream(f, sample=None):
+    """Load the parts of keymap.json the firmware uses from a file opened in binary mode"""
+    return KeymapStreamReader(f, sample=sample).load()
+
+
+def keymap_layers(keymap_data):
+    """[(layer name, buttons)] with the top-level buttons as layer 0"""
+    base_name = keymap_data.get('settings', {}).get('base_layer_name', DEFAULT_BASE_LAYER_NAME)
+    layers = [(base_name, keymap_data.get('buttons', {}))]
+    for layer in keymap_data.get('layers', []):
+        layers.append((layer.get('name', f'Layer {len(layers)}'), layer.get('buttons', {})))
+    if len(layers) > MAX_LAYERS:
+        raise ValueError(f"At most {MAX_LAYERS} layers are supported")
+    return layers
+
+
+def resolve_layer_target(target, layer_names):
+    """Layer number, LAYER_NEXT or LAYER_PREV for a layer key's "layer" field"""
+    if target == 'next':
+        return LAYER_NEXT
+    if target == 'prev':
+        return LAYER_PREV
+    if isinstance(target, int) and 0 <= target < len(layer_names):
+        return target
+    if target in layer_names:
+        return layer_names.index(target)
+    raise ValueError(f"Unknown layer {target}")
+
+
+def file_crc32(f, chunk_size=1024):
+    """CRC-32 of the rest of an open binary file, read in chunks"""
+    crc = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return crc & 0xFFFFFFFF
+        crc = binascii.crc32(chunk, crc)
+
+
+def pack_keymap(keymap_data, source):
+    """Build the binary keymap for keymap_data.
+
+    source is the content of the keymap.json written alongside; its size and
+    CRC-32 let the firmware tell when the JSON was edited without
+    regenerating the binary.
+    """
+    settings = keymap_data.get('settings', {})
+    macro_speed = settings.get('macro_playback_speed', 1.0)
+    min_hold_ms = settings.get('min_hold_ms', DEFAULT_MIN_HOLD_MS)
+    text_cps = settings.get('text_cps', DEFAULT_TEXT_CPS)
+    layers = keymap_layers(keymap_data)
+    layer_names = [name for name, _ in layers]
+    names = []
+    targets = []
+    for _, buttons in layers:
+        for button_index in range(BUTTON_COUNT):
+            button_data = buttons.get(str(button_index))
+            names.append(None if button_data is None else button_data.get('name', f'Button{button_index}'))
+            target = None if button_data is None else button_data.get('layer')
+            targets.append(None if target is None else resolve_layer_target(target, layer_names))
+    base_buttons = layers[0][1]
+    debounce = [base_buttons.get(str(button_index), {}).get('debounce_ms') for button_index in range(BUTTON_COUNT)]
+    metadata = {'settings': settings, 'names': names, 'layers': layer_names, 'targets': targets,
+                'debounce': debounce, 'source_crc': binascii.crc32(source) & 0xFFFFFFFF}
+    metadata_blob = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+
+    button_count = BUTTON_COUNT * len(layers)
+    index = bytearray()
+    stream = bytearray()
+    steps_start = BIN_HEADER_SIZE + len(metadata_blob) + button_count * BIN_INDEX_ENTRY_SIZE
+    for _, buttons in layers:
+        for button_index in range(BUTTON_COUNT):
+            button_data = buttons.get(str(button_index))
+            if button_data is None:
+                # Offset 0 marks a button without a mapping
+                index += struct.pack(BIN_INDEX_ENTRY, 0, 0)
+                continue
+            steps = compile_macro(button_data.get('macro', []), macro_speed, min_hold_ms, text_cps)
+            index += struct.pack(BIN_INDEX_ENTRY, steps_start + len(stream), len(steps))
+            for delay, op, keycode in steps:
+                stream += struct.pack(BIN_STEP, delay, op, keycode)
+
+    header = struct.pack(BIN_HEADER, KEYMAP_BIN_MAGIC, KEYMAP_BIN_VERSION, button_count,
+                         len(metadata_blob), len(source))
+    return header + metadata_blob + bytes(index) + bytes(stream)
+
+
+def read_keymap_header(f):
+    """Read header, metadata and button index from an open binary keymap.
+
+    Returns (metadata, index, source_size); index is a list of (offset, step
+    count) per layer * 16 + button, with offset 0 for unmapped buttons.
+    """
+    prefix = f.read(BIN_PREFIX_SIZE)
+    magic, version = struct.unpack(BIN_PREFIX, prefix)
+    if magic != KEYMAP_BIN_MAGIC or version not in (1, 2, 3, KEYMAP_BIN_VERSION):
+        raise ValueError("Not a supported binary keymap")
+    layout = BIN_HEADER if version == KEYMAP_BIN_VERSION else BIN_HEADER_V3
+    _, _, button_count, metadata_length, source_size = struct.unpack(
+        layout, prefix + f.read(struct.calcsize(layout) - BIN_PREFIX_SIZE))
+    metadata = json.loads(f.read(metadata_length))
+    index_data = f.read(button_count * BIN_INDEX_ENTRY_SIZE)
+    index = []
+    for button_index in range(button_count):
+        index.append(struct.unpack_from(BIN_INDEX_ENTRY, index_data, button_index * BIN_INDEX_ENTRY_SIZE))
+    return metadata, index, source_size
+
+
+def read_button_steps(f, offset, count):
+    """Seek to one button's step records and decode them"""
+    f.seek(offset)
+    data = f.read(count * BIN_STEP_SIZE)
+    steps = []
+    for step_index in range(count):
+        steps.append(struct.unpack_from(BIN_STEP, data, step_index * BIN_STEP_SIZE))
+    return tuple(steps)
+
+
+# Live keymap protocol on the USB CDC data channel (all little endian):
+#   frame    sync, type, flags, sequence, payload length, payload, CRC-16
+#   CRC-16/CCITT-FALSE over type through payload
+# Button payload:   JSON {"button": index, "layer": layer number, "data": button dict, or null to unmap}
+# Settings payload: JSON dict of the settings to change
+# Layer payload:    JSON {"layer": layer name or number}, persisted as the default_layer setting
+# Every frame is answered with an ACK frame of the same sequence carrying
+# ACK_PAYLOAD: status and the time the pad took to apply it in us.
+FRAME_SYNC = b'\xa5\x5a'
+FRAME_HEADER = '<2sBBBH'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+FRAME_CRC = '<H'
+FRAME_CRC_SIZE = struct.calcsize(FRAME_CRC)
+FRAME_MAX_PAYLOAD = 4096
+
+FRAME_BUTTON = 0x01
+FRAME_SETTINGS = 0x02
+FRAME_PING = 0x03
+FRAME_LAYER = 0x04
+FRAME_ACK = 0x80
+
+# Frame flags
+FLAG_PERSIST = 0x01  # also write the change to keymap.json
+
+ACK_PAYLOAD = '<BI'
+STATUS_OK = 0
+STATUS_RESTART = 1  # stored, but only takes effect after a restart
+STATUS_BAD_FRAME = 2  # CRC mismatch or unknown frame type
+STATUS_BAD_DELTA = 3  # payload could not be parsed or compiled
+STATUS_PERSIST_FAILED = 4  # applied in memory, keymap.json not written
+STATUS_NAMES = ('ok', 'restart needed', 'bad frame', 'bad delta', 'persist failed')
+
+
+def make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+
+CRC16_TABLE = make_crc16_table()
+
+
+def crc16(data, crc=0xFFFF):
+    table = CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def encode_frame(frame_type, sequence, payload=b'', flags=0):
+    header = struct.pack(FRAME_HEADER, FRAME_SYNC, frame_type, flags, sequence & 0xFF, len(payload))
+    body = header[2:] + payload
+    return FRAME_SYNC + body + struct.pack(FRAME_CRC, crc16(body))
+
+
+def encode_ack(sequence, status, apply_us):
+    return encode_frame(FRAME_ACK, sequence, struct.pack(ACK_PAYLOAD, status, apply_us))
+
+
+def decode_ack(payload):
+    """(status, apply time in us) from an ACK payload"""
+    return struct.unpack(ACK_PAYLOAD, payload)
+
+
+class FrameDecoder:
+    """Reassembles frames from a byte stream.
+
+    feed() the bytes as they arrive, then call next_frame() until it returns
+    None. Bytes before a sync marker are skipped; a frame that fails its CRC
+    comes back with payload None and decoding resyncs after its sync marker.
+    """
+
+    def __init__(self, max_payload=FRAME_MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self.buffer = b''
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        """(type, flags, sequence, payload) of the next whole frame, or None"""
+        buffer = self.buffer
+        start = buffer.find(FRAME_SYNC)
+        if start < 0:
+            # Keep a trailing first sync byte, it may be completed by the next feed
+            keep = 1 if buffer[-1:] == FRAME_SYNC[:1] else 0
+            self.skipped_bytes += len(buffer) - keep
+            self.buffer = buffer[len(buffer) - keep:]
+            return None
+        if start:
+            self.skipped_bytes += start
+            buffer = self.buffer = buffer[start:]
+        if len(buffer) < FRAME_HEADER_SIZE:
+            return None
+        _, frame_type, flags, sequence, length = struct.unpack_from(FRAME_HEADER, buffer)
+        if length > self.max_payload:
+            self.buffer = buffer[len(FRAME_SYNC):]
+            return (frame_type, flags, sequence, None)
+        end = FRAME_HEADER_SIZE + length
+        if len(buffer) < end + FRAME_CRC_SIZE:
+            return None
+        (crc,) = struct.unpack_from(FRAME_CRC, buffer, end)
+        if crc != crc16(buffer[len(FRAME_SYNC):end]):
+            self.buffer = buffer[len(FRAME_SYNC):]
+            return (frame_type, flags, sequence, None)
+        self.buffer = buffer[end + FRAME_CRC_SIZE:]
+        return (frame_type, flags, sequence, buffer[FRAME_HEADER_SIZE:end])
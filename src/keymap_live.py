@@ -0,0 +1,97 @@
+"""Pushes keymap changes from the editor to a running pad, no copy or reboot needed.
+
+Desktop side of the live keymap protocol in keymap_format.py, spoken over
+the pad's USB CDC data channel. The pad has to enable that channel in
+boot.py with usb_cdc.enable(console=True, data=True); it shows up as a
+second serial port next to the REPL.
+"""
+import json
+import logging
+import time
+
+from keymap_format import (FrameDecoder, encode_frame, decode_ack, FRAME_BUTTON, FRAME_SETTINGS,
+                           FRAME_PING, FRAME_LAYER, FRAME_ACK, FLAG_PERSIST, STATUS_NAMES)
+
+try:
+    import serial
+    SERIAL_AVAILABLE = True
+except ImportError:
+    SERIAL_AVAILABLE = False
+
+ACK_TIMEOUT_S = 1.0
+
+logger = logging.getLogger("kyupad.editor.live")
+
+
+class LiveKeymapError(Exception):
+    pass
+
+
+class LiveKeymapClient:
+    """Sends button and settings deltas to the pad and waits for each ACK.
+
+    stream is anything with write(), in_waiting and a read(n) that returns
+    b'' once its timeout passes, such as a pyserial Serial.
+    """
+
+    def __init__(self, stream, ack_timeout=ACK_TIMEOUT_S):
+        self.stream = stream
+        self.ack_timeout = ack_timeout
+        self.decoder = FrameDecoder()
+        self.sequence = 0
+        self.last_round_trip_s = None
+
+    @classmethod
+    def open(cls, port):
+        if not SERIAL_AVAILABLE:
+            raise LiveKeymapError("pyserial is not installed (pip install pyserial)")
+        try:
+            return cls(serial.Serial(port, timeout=0.05))
+        except serial.SerialException as e:
+            raise LiveKeymapError(str(e)) from e
+
+    def close(self):
+        self.stream.close()
+
+    def send_button(self, button_id, button_data, layer=0, persist=False):
+        """Replace one button of a layer on the pad; button_data None unmaps it"""
+        delta = {"button": int(button_id), "layer": layer, "data": button_data}
+        return self.send(FRAME_BUTTON, json.dumps(delta, separators=(",", ":")).encode("utf-8"), persist)
+
+    def select_layer(self, layer, persist=False):
+        """Switch the pad to a layer by name or number; persist makes it the boot layer"""
+        return self.send(FRAME_LAYER, json.dumps({"layer": layer}).encode("utf-8"), persist)
+
+    def send_settings(self, settings, persist=False):
+        return self.send(FRAME_SETTINGS, json.dumps(settings, separators=(",", ":")).encode("utf-8"), persist)
+
+    def ping(self):
+        return self.send(FRAME_PING)
+
+    def send(self, frame_type, payload=b"", persist=False):
+        """Send one frame and wait for its ACK; returns (status, pad apply time in us)"""
+        self.sequence = (self.sequence + 1) & 0xFF
+        sequence = self.sequence
+        start = time.perf_counter()
+        self.stream.write(encode_frame(frame_type, sequence, payload, FLAG_PERSIST if persist else 0))
+        deadline = start + self.ack_timeout
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is None:
+                if time.perf_counter() > deadline:
+                    raise LiveKeymapError(f"No ACK from the pad for frame {sequence}")
+                # read(1) returns as soon as a byte is there, then take whatever followed it
+                data = self.stream.read(1)
+                if data:
+                    self.decoder.feed(data + self.stream.read(self.stream.in_waiting))
+                continue
+            ack_type, _, ack_sequence, ack_payload = frame
+            if ack_type != FRAME_ACK or ack_sequence != sequence or ack_payload is None:
+                logger.debug("Ignoring frame type %d sequence %d while waiting for %d",
+                             ack_type, ack_sequence, sequence)
+                continue
+            status, apply_us = decode_ack(ack_payload)
+            self.last_round_trip_s = time.perf_counter() - start
+            logger.info("Frame %d: %s, applied in %dus, round trip %.1fms", sequence,
+                        STATUS_NAMES[status], apply_us, self.last_round_trip_s * 1000)
+            return status, apply_us
@@ -0,0 +1,158 @@
+"""Shrinks recorded macros before they are saved and sent to the pad.
+
+A recording keeps every key event the editor saw, including presses of
+keys that are already down, releases nobody pressed, keys the pad cannot
+type, and long runs of the same tap. optimize_macro() rewrites a
+keys-array macro so the pad plays the same key sequence with fewer stored
+events. Text and legacy actions pass through untouched.
+"""
+from keymap_format import (DEFAULT_MIN_HOLD_MS, DEFAULT_TEXT_CPS, compile_macro, get_keycode)
+
+
+def split_key(key):
+    """(key name, "press" | "release" | "tap") for one entry of an action's keys list"""
+    if key.endswith('_press') or key.endswith('_release'):
+        key_name, kind = key.rsplit('_', 1)
+        return key_name, kind
+    return key, 'tap'
+
+
+def is_keys_action(action):
+    return isinstance(action, dict) and isinstance(action.get('keys'), list)
+
+
+def quantize(delay, quantize_ms):
+    if quantize_ms <= 0:
+        return delay
+    return int(round(delay / quantize_ms)) * quantize_ms
+
+
+def key_groups(macro, quantize_ms):
+    """Split the keys actions into (delay, keys) groups with press/release pairing normalized.
+
+    A group runs from a moment when no key is held until all of its keys are
+    released again, so a recorded run of taps becomes one group per tap. An
+    action with a delay of its own closes the open group and starts the next
+    one, so its delay stays in front of its first key. Presses of held keys,
+    releases of keys that are not held and keys the pad has no keycode for
+    are dropped. Delays of actions that end up empty carry over to the next
+    group. Other actions come back as (delay, action) with keys None.
+    """
+    groups = []
+    held = []
+    keys = []
+    carried = 0
+    for action in macro:
+        if not isinstance(action, dict):
+            continue
+        delay = carried + quantize(action.get('delay', 0), quantize_ms)
+        carried = 0
+        if not is_keys_action(action):
+            if keys:
+                groups.append((pending_delay, keys))
+                keys = []
+            groups.append((delay, action))
+            continue
+
+        for _ in range(action.get('repeat', 1)):
+            action_delay = delay
+            if keys and action_delay:
+                groups.append((pending_delay, keys))
+                keys = []
+            for key in action['keys']:
+                key_name, kind = split_key(key)
+                if get_keycode(key_name) is None:
+                    continue
+                if kind == 'press':
+                    if key_name in held:
+                        continue
+                    held.append(key_name)
+                elif kind == 'release':
+                    if key_name not in held:
+                        continue
+                    held.remove(key_name)
+                else:
+                    # A tap releases everything that is down once it is done
+                    held = []
+                if not keys:
+                    pending_delay = action_delay
+                    action_delay = 0
+                keys.append(key)
+                if not held:
+                    groups.append((pending_delay, keys))
+                    keys = []
+            if action_delay:
+                carried += action_delay
+
+    if held:
+        if not keys:
+            pending_delay = 0
+        keys.extend(f"{key_name}_release" for key_name in reversed(held))
+    if keys:
+        groups.append((pending_delay, keys))
+    return groups
+
+
+def optimize_macro(macro, quantize_ms=0):
+    """Return an optimized copy of macro; quantize_ms > 0 rounds delays to that step.
+
+    Identical groups in a row fold into one action with "repeat": n, then
+    groups that follow without a delay merge into the action before them,
+    which plays them at the same moments. Unmatched presses get their
+    releases at the end of the macro.
+    """
+    if not isinstance(macro, list):
+        return macro
+
+    folded = []
+    for delay, keys in key_groups(macro, quantize_ms):
+        if isinstance(keys, list) and folded and folded[-1][:2] == [delay, keys]:
+            folded[-1][2] += 1
+        else:
+            folded.append([delay, keys, 1])
+
+    optimized = []
+    last = None
+    for delay, keys, repeat in folded:
+        if not isinstance(keys, list):
+            action = dict(keys)
+            action.pop('delay', None)
+            last = None
+        elif last is not None and not delay and repeat == 1 and last.get('repeat', 1) == 1:
+            last['keys'] = last['keys'] + keys
+            continue
+        else:
+            action = {'keys': keys}
+            last = action
+        if delay:
+            action['delay'] = delay
+        if repeat > 1:
+            action['repeat'] = repeat
+        optimized.append(action)
+    return optimized
+
+
+def macro_steps(macro, settings):
+    """Compiled (delay_ms, op, keycode) steps of a macro under the keymap settings"""
+    return compile_macro(macro, settings.get('macro_playback_speed', 1.0),
+                         settings.get('min_hold_ms', DEFAULT_MIN_HOLD_MS),
+                         settings.get('text_cps', DEFAULT_TEXT_CPS))
+
+
+def macro_stats(macro, settings):
+    """(stored events, played steps, playback ms) for a macro under the keymap settings.
+
+    Stored events count the entries the keymap keeps (a text action counts
+    its characters), played steps what the pad sends once repeats unroll.
+    """
+    events = 0
+    if isinstance(macro, list):
+        for action in macro:
+            if is_keys_action(action):
+                events += len(action['keys'])
+            elif isinstance(action, dict):
+                events += len(action.get('text', '')) or 1
+    elif macro:
+        events = 1
+    steps = macro_steps(macro, settings)
+    return events, len(steps), sum(step[0] for step in steps)
@@ -1,38 +1,1471 @@
-import json
 import time
+# Boot timing starts before the remaining imports
+BOOT_START_NS = time.monotonic_ns()
+import json
+import os
+import sys
+import array
 import usb_hid
-from adafruit_hid.keyboard import Keyboard
-from adafruit_hid.keycode import Keycode
+from adafruit_hid import find_device
 import digitalio
 import board
 import microcontroller
 import gc
+from keymap_format import (OP_PRESS, OP_RELEASE, OP_RELEASE_ALL, DEFAULT_MIN_HOLD_MS, DEFAULT_TEXT_CPS, compile_macro,
+                           read_keymap_header, read_button_steps, file_crc32, load_keymap_stream, keymap_layers,
+                           resolve_layer_target, LAYER_NEXT, LAYER_PREV, DEFAULT_BASE_LAYER_NAME,
+                           FrameDecoder, encode_ack, FRAME_BUTTON, FRAME_SETTINGS, FRAME_PING, FRAME_LAYER,
+                           FLAG_PERSIST, STATUS_OK,
+                           STATUS_RESTART, STATUS_BAD_FRAME, STATUS_BAD_DELTA, STATUS_PERSIST_FAILED,
+                           STATUS_NAMES)
+
+# keypad scans the matrix in C on CircuitPython 7+
+try:
+    import keypad
+    KEYPAD_AVAILABLE = True
+except ImportError:
+    KEYPAD_AVAILABLE = False
+
+try:
+    import supervisor
+    SUPERVISOR_AVAILABLE = True
+except ImportError:
+    SUPERVISOR_AVAILABLE = False
+
+# usb_cdc.data is only there when boot.py enables it: usb_cdc.enable(console=True, data=True)
+try:
+    import usb_cdc
+    USB_CDC_AVAILABLE = True
+except ImportError:
+    USB_CDC_AVAILABLE = False
+
+# gc.mem_free() is CircuitPython only
+MEM_FREE_AVAILABLE = hasattr(gc, 'mem_free')
+
+# supervisor.ticks_ms() wraps at 2**29
+TICKS_MASK = (1 << 29) - 1
+
+# ticks_ms() stays a small int, so reading it in the scan loop never allocates
+if SUPERVISOR_AVAILABLE:
+    ticks_ms = supervisor.ticks_ms
+else:
+    def ticks_ms():
+        return (time.monotonic_ns() // 1_000_000) & TICKS_MASK
+
+def ticks_to_ns(timestamp_ms):
+    """Convert a ticks_ms timestamp in the recent past to the monotonic_ns timeline"""
+    age_ms = (ticks_ms() - timestamp_ms) & TICKS_MASK
+    return time.monotonic_ns() - age_ms * 1_000_000
+
+# alarm provides light/deep sleep with pin wake-up on CircuitPython 6.1+
+try:
+    import alarm
+    ALARM_AVAILABLE = True
+except ImportError:
+    ALARM_AVAILABLE = False
+
+# Log levels; settings pick the console level ('log_level') and the ring level ('log_ring_level')
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVELS = {'debug': LOG_DEBUG, 'info': LOG_INFO, 'warning': LOG_WARNING, 'error': LOG_ERROR}
+LOG_LEVEL_NAMES = {LOG_DEBUG: 'DEBUG', LOG_INFO: 'INFO', LOG_WARNING: 'WARNING', LOG_ERROR: 'ERROR'}
+LOG_RING_SIZE = 64
+
+class Logger:
+    """Leveled logger with a ring buffer of recent messages.
+
+    Messages take %-style arguments that are only formatted when a record is
+    printed, so a disabled level costs a call and a comparison. Records at
+    ring_level and above are kept unformatted in a fixed-size ring that the
+    serial "log" command dumps, even when the console level hides them.
+    The ring is kept in preallocated parallel slots, so recording a message
+    without arguments allocates nothing. Printing over USB CDC blocks, so
+    the console default stays quiet.
+    """
+    def __init__(self, level=LOG_WARNING, ring_level=LOG_INFO):
+        self.ring_times = array.array('I', bytes(4 * LOG_RING_SIZE))
+        self.ring_levels = bytearray(LOG_RING_SIZE)
+        self.ring_messages = [None] * LOG_RING_SIZE
+        self.ring_args = [None] * LOG_RING_SIZE
+        self.ring_next = 0
+        self.ring_count = 0
+        self.set_levels(level, ring_level)
+
+    def set_levels(self, level, ring_level):
+        self.level = level
+        self.ring_level = ring_level
+        self.threshold = min(level, ring_level)
+
+    def log(self, level, message, args):
+        if level < self.threshold:
+            return
+        if level >= self.ring_level:
+            slot = self.ring_next
+            self.ring_times[slot] = ticks_ms()
+            self.ring_levels[slot] = level
+            self.ring_messages[slot] = message
+            self.ring_args[slot] = args
+            self.ring_next = (slot + 1) % LOG_RING_SIZE
+            if self.ring_count < LOG_RING_SIZE:
+                self.ring_count += 1
+        if level >= self.level:
+            print(message % args if args else message)
+
+    def enabled(self, level):
+        """True if a record at level would be printed or kept; guards arguments that are costly to build"""
+        return level >= self.threshold
+
+    def debug(self, message, *args):
+        self.log(LOG_DEBUG, message, args)
+
+    def info(self, message, *args):
+        self.log(LOG_INFO, message, args)
+
+    def warning(self, message, *args):
+        self.log(LOG_WARNING, message, args)
+
+    def error(self, message, *args):
+        self.log(LOG_ERROR, message, args)
+
+    def dump(self):
+        """Print the ring buffer, oldest record first"""
+        start = (self.ring_next - self.ring_count) % LOG_RING_SIZE
+        for offset in range(self.ring_count):
+            slot = (start + offset) % LOG_RING_SIZE
+            message = self.ring_messages[slot]
+            args = self.ring_args[slot]
+            print(f"[{self.ring_times[slot]:>9}] {LOG_LEVEL_NAMES[self.ring_levels[slot]]:<7} "
+                  f"{message % args if args else message}")
 
-# Bluetooth imports - will gracefully handle if not available
+log = Logger()
+
+# Bluetooth libraries are imported by load_bluetooth() only when a BLE connection
+# mode is configured, so USB-only boots skip their import time and RAM
+adafruit_ble = None
+ProvideServicesAdvertisement = None
+HIDService = None
+DeviceInfoService = None
+
+def load_bluetooth():
+    """Import the Bluetooth libraries on first use; returns False if unavailable"""
+    global adafruit_ble, ProvideServicesAdvertisement, HIDService, DeviceInfoService
+    if adafruit_ble is not None:
+        return True
+    try:
+        import adafruit_ble as ble_module
+        from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
+        from adafruit_ble.services.hid import HIDService
+        from adafruit_ble.services.deviceinfo import DeviceInfoService
+    except ImportError as e:
+        log.warning("Bluetooth not available: %s", e)
+        return False
+    adafruit_ble = ble_module
+    log.info("Bluetooth libraries loaded successfully")
+    return True
+
+# Instrumentation switch: set _STATS to 0 and const() lets the compiler drop
+# every "if _STATS:" block from the build
 try:
-    import adafruit_ble
-    from adafruit_ble.advertising import Advertisement
-    from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
-    from adafruit_ble.services.hid import HIDService
-    from adafruit_ble.services.deviceinfo import DeviceInfoService
-    BLUETOOTH_AVAILABLE = True
-    print("Bluetooth libraries loaded successfully")
-except ImportError as e:
-    BLUETOOTH_AVAILABLE = False
-    print(f"Bluetooth not available: {e}")
+    from micropython import const
+except ImportError:
+    def const(value):
+        return value
+
+_STATS = const(1)
+
+# Log2 histogram buckets: bucket 0 holds 0us, bucket b holds [2**(b-1), 2**b) us
+HISTOGRAM_BUCKETS = 24
+
+# How often the USB serial console is polled for commands
+SERIAL_POLL_INTERVAL_MS = 100
+
+# Status LED refresh interval in ms, independent of the scan rate
+LED_UPDATE_INTERVAL_MS = 10
+
+# Status LED effects, picked from the connection state
+LED_EFFECT_OFF = 0
+LED_EFFECT_USB = 1
+LED_EFFECT_ADVERTISING = 2
+LED_EFFECT_CONNECTED = 3
+
+# Effect timings in ms: blink periods, press flash length, low battery triple blink
+LED_USB_BLINK_MS = 1000
+LED_ADVERTISING_BLINK_MS = 5000
+LED_PRESS_FLASH_MS = 50
+LED_LOW_BATTERY_PERIOD_MS = 4000
+LED_LOW_BATTERY_BLINK_MS = 150
+
+# BLE advertising phases and the press buffer used while a dropped link comes back
+ADVERTISING_OFF = 0
+ADVERTISING_FAST = 1
+ADVERTISING_SLOW = 2
+BLE_PRESS_BUFFER_SIZE = 8
+
+# HID transport the reports currently go to
+TRANSPORT_NONE = 0
+TRANSPORT_USB = 1
+TRANSPORT_BLE = 2
+TRANSPORT_NAMES = ('none', 'USB', 'BLE')
+
+# Sent to a host the pad is leaving so no key stays held there
+RELEASED_REPORT = bytes(8)
+
+# Settings a live delta can change without a restart
+LIVE_SETTINGS = ('log_level', 'log_ring_level', 'debounce_ms', 'gc_idle_ms')
+
+# Battery voltage is sampled this often when battery_sense_pin is configured
+BATTERY_CHECK_INTERVAL_MS = 60_000
+
+# Slots in the key event ring and the pending macro queue
+KEY_EVENT_RING_SIZE = 32
+MACRO_QUEUE_SIZE = 16
+
+# Debounced key edges reported by KeyDebouncer.update
+EDGE_NONE = 0
+EDGE_PRESS = 1
+EDGE_RELEASE = 2
+
+class KeyDebouncer:
+    """Per-key debounce state machine.
+
+    In eager mode a press is reported on the first closed sample, and a
+    release only after the key has read open for its whole debounce window,
+    so press latency is one scan period and release chatter is filtered out.
+    In defer mode both edges wait for a full debounce window of stable reads.
+    Timing uses ticks_ms so that update() never allocates.
+    """
+
+    def __init__(self, debounce_ms_per_key, eager):
+        key_count = len(debounce_ms_per_key)
+        self.eager = eager
+        self.debounce_ms = list(debounce_ms_per_key)
+        self.raw = bytearray(key_count)
+        self.stable = bytearray(key_count)
+        self.changed_ms = [0] * key_count
+
+    def update(self, key, pressed, now_ms):
+        """Feed one raw sample for key and return the debounced edge"""
+        if pressed != self.raw[key]:
+            self.raw[key] = pressed
+            self.changed_ms[key] = now_ms
+
+        if pressed == self.stable[key]:
+            return EDGE_NONE
+
+        if not (pressed and self.eager):
+            if (now_ms - self.changed_ms[key]) & TICKS_MASK < self.debounce_ms[key]:
+                return EDGE_NONE
+
+        self.stable[key] = pressed
+        return EDGE_PRESS if pressed else EDGE_RELEASE
+
+    def edge_time_ms(self, key):
+        """Tick at which the raw signal settled into the state just reported"""
+        return self.changed_ms[key]
+
+class KeyEventRing:
+    """Fixed-size ring of (key index, edge, ticks_ms) records.
+
+    Scanners push debounced transitions and the dispatcher consumes them. The
+    storage is allocated once and timestamps stay small ints, so pushing and
+    popping never creates garbage.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = bytearray(size)
+        self.edges = bytearray(size)
+        self.times = array.array('I', bytes(4 * size))
+        self.head = 0
+        self.tail = 0
+        self.count = 0
+        self.dropped = 0
+
+    def push(self, key, edge, timestamp_ms):
+        if self.count == self.size:
+            self.dropped += 1
+            return False
+        head = self.head
+        self.keys[head] = key
+        self.edges[head] = edge
+        self.times[head] = timestamp_ms
+        self.head = (head + 1) % self.size
+        self.count += 1
+        return True
+
+    def advance(self):
+        """Discard the oldest record after reading it at self.tail"""
+        self.tail = (self.tail + 1) % self.size
+        self.count -= 1
+
+class LogHistogram:
+    """Fixed-size histogram of durations in microseconds with power-of-two buckets"""
+    def __init__(self, name):
+        self.name = name
+        self.buckets = array.array('I', [0] * HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.max_us = 0
+
+    def record(self, value_us):
+        if value_us < 0:
+            value_us = 0
+        bucket = 0
+        while value_us >> bucket and bucket < HISTOGRAM_BUCKETS - 1:
+            bucket += 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def percentile(self, fraction):
+        """Upper bound in us of the bucket that reaches fraction of the samples"""
+        target = self.count * fraction
+        seen = 0
+        for bucket in range(HISTOGRAM_BUCKETS):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return 1 << bucket
+        return self.max_us
+
+    def reset(self):
+        for bucket in range(HISTOGRAM_BUCKETS):
+            self.buckets[bucket] = 0
+        self.count = 0
+        self.max_us = 0
+
+    def report(self):
+        if not self.count:
+            print(f"{self.name}: no samples")
+            return
+        buckets = " ".join([f"<{1 << bucket}:{self.buckets[bucket]}"
+                            for bucket in range(HISTOGRAM_BUCKETS) if self.buckets[bucket]])
+        print(f"{self.name}: n={self.count} p50<{self.percentile(0.5)}us "
+              f"p99<{self.percentile(0.99)}us max={self.max_us}us | {buckets}")
+
+class FirmwareStats:
+    """Counters and latency histograms printed by the serial "stats" command.
+
+    time.monotonic_ns() returns a heap-allocated long on CircuitPython, so the
+    scan and loop timings are only taken between a key event and the idle
+    gc.collect() that follows it; the idle loop itself never allocates.
+    """
+    def __init__(self):
+        self.scan_us = LogHistogram("scan and dispatch (active)")
+        self.loop_us = LogHistogram("loop period (active)")
+        self.press_to_report_us = LogHistogram("press to report")
+        self.macro_us = LogHistogram("macro run")
+        self.hid_send_us = LogHistogram("hid send")
+        self.layer_switch_us = LogHistogram("layer switch (host-requested)")
+        self.histograms = (self.scan_us, self.loop_us, self.press_to_report_us,
+                           self.macro_us, self.hid_send_us, self.layer_switch_us)
+        self.reset()
+
+    def reset(self):
+        for histogram in self.histograms:
+            histogram.reset()
+        self.exceptions = 0
+        self.start_ms = ticks_ms()
+
+    def report(self):
+        elapsed_s = ((ticks_ms() - self.start_ms) & TICKS_MASK) // 1000
+        print(f"Stats over {elapsed_s}s: exceptions={self.exceptions}")
+        for histogram in self.histograms:
+            histogram.report()
+
+class MacroScheduler:
+    """Plays compiled macros as timestamped HID events from the main loop.
+
+    Each step is due a fixed time after the previous one, so the loop can keep
+    scanning the matrix and checking the connection between steps. Presses
+    that arrive while a macro is playing are queued with their own press time
+    and start once the current macro has finished. A macro's steps are timed
+    from the moment it starts, so one that starts late still keeps its delays;
+    the press time only feeds the press-to-report latency. The queue is preallocated
+    and holds layer * 16 + button, so a queued press plays the layer it was
+    pressed on.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.queue_buttons = bytearray(MACRO_QUEUE_SIZE)
+        # Press times in ticks_ms; the ns timeline is only used once a macro plays
+        self.queue_times = array.array('I', bytes(4 * MACRO_QUEUE_SIZE))
+        self.queue_head = 0
+        self.queue_count = 0
+        self.steps = None
+        self.step_index = 0
+        self.next_due_ns = 0
+        self.last_finish_ns = 0
+        self.button_index = 0
+        self.reports_at_start = 0
+        self.start_ns = 0
+        # Switch close time of the playing macro, cleared once its first report is out
+        self.press_ns = 0
+        self.first_report_pending = False
+        # HID reports sent by the last playback of each button's macro, and its
+        # step count, which is what one report per key event would have sent
+        self.report_counts = [0] * (16 * len(owner.layers))
+        self.step_counts = [0] * (16 * len(owner.layers))
+
+    @property
+    def busy(self):
+        return self.steps is not None or self.queue_count > 0
+
+    def submit(self, button_index, press_ms):
+        """Queue the macro of button_index triggered by a key press at ticks_ms press_ms"""
+        if self.queue_count == MACRO_QUEUE_SIZE:
+            return False
+        slot = (self.queue_head + self.queue_count) % MACRO_QUEUE_SIZE
+        self.queue_buttons[slot] = button_index
+        self.queue_times[slot] = press_ms
+        self.queue_count += 1
+        return True
+
+    def start_next(self, now_ns):
+        slot = self.queue_head
+        self.queue_head = (slot + 1) % MACRO_QUEUE_SIZE
+        self.queue_count -= 1
+        button_index = self.queue_buttons[slot]
+        steps = self.owner.macro_steps(button_index)
+        if not steps:
+            return
+        start_ns = max(now_ns, self.last_finish_ns)
+        self.button_index = button_index
+        self.reports_at_start = self.owner.keyboard.reports_sent
+        self.steps = steps
+        self.step_index = 0
+        self.next_due_ns = start_ns + steps[0][0] * 1_000_000
+        if _STATS:
+            self.start_ns = start_ns
+            # The macro's own leading delay is not latency
+            self.press_ns = ticks_to_ns(self.queue_times[slot]) + steps[0][0] * 1_000_000
+            self.first_report_pending = True
+
+    def note_first_report(self):
+        """Record press-to-report latency once the playing macro has sent a report"""
+        if self.owner.keyboard.reports_sent != self.reports_at_start:
+            self.first_report_pending = False
+            self.owner.stats.press_to_report_us.record((time.monotonic_ns() - self.press_ns) // 1000)
+
+    def service(self, now_ns):
+        """Send every step that is due at now_ns; never sleeps"""
+        while self.steps is None:
+            if not self.queue_count:
+                return
+            self.start_next(now_ns)
+
+        while self.steps is not None and now_ns >= self.next_due_ns:
+            _, op, keycode = self.steps[self.step_index]
+            self.owner.send_macro_step(op, keycode)
+            self.step_index += 1
+
+            if self.step_index < len(self.steps):
+                self.next_due_ns += self.steps[self.step_index][0] * 1_000_000
+            else:
+                self.owner.flush_report()
+                self.report_counts[self.button_index] = self.owner.keyboard.reports_sent - self.reports_at_start
+                self.step_counts[self.button_index] = len(self.steps)
+                if _STATS:
+                    if self.first_report_pending:
+                        self.note_first_report()
+                    self.owner.stats.macro_us.record((time.monotonic_ns() - self.start_ns) // 1000)
+                self.last_finish_ns = self.next_due_ns
+                self.steps = None
+                while self.steps is None and self.queue_count:
+                    self.start_next(now_ns)
+
+        # Everything that became due together leaves as a single report
+        self.owner.flush_report()
+        if _STATS and self.first_report_pending:
+            self.note_first_report()
+
+    def report(self):
+        played = []
+        for button_index in range(len(self.report_counts)):
+            if self.step_counts[button_index]:
+                layer = self.owner.layers[button_index // 16]
+                played.append(f"{layer.name}/{button_index % 16 + 1} {self.report_counts[button_index]}"
+                              f"/{self.step_counts[button_index]}")
+        print(f"Macro reports/steps (last playback): {', '.join(played) or 'none played'}")
+
+    def resume(self, now_ns):
+        """A host is back after service() was skipped: steps that fell due meanwhile play from now_ns"""
+        if self.steps is not None and now_ns > self.next_due_ns:
+            self.next_due_ns = now_ns
+
+    def cancel(self):
+        """Drop queued macros and release anything a half-played macro held"""
+        was_playing = self.steps is not None
+        self.queue_count = 0
+        self.steps = None
+        if was_playing:
+            self.owner.send_macro_step(OP_RELEASE_ALL, 0)
+            self.owner.flush_report()
+
+# Scan rate tiers picked by ScanGovernor
+TIER_FULL = 0
+TIER_REDUCED = 1
+TIER_MINIMAL = 2
+TIER_NAMES = ('full', 'reduced', 'minimal')
+
+class ScanGovernor:
+    """Chooses the main loop sleep from how long the pad has been idle.
+
+    Scanning runs at full rate while keys are held or a macro plays, drops to
+    a reduced rate after scan_idle_reduced_after_ms and to a minimal rate
+    after scan_idle_minimal_after_ms. The first key event switches straight
+    back to full rate. Time spent in each tier and the worst wake latency
+    (gap before the scan that saw the waking press) are kept for tuning.
+    """
+
+    def __init__(self, settings):
+        self.reduced_after_ms = settings.get('scan_idle_reduced_after_ms', 5000)
+        self.minimal_after_ms = settings.get('scan_idle_minimal_after_ms', 60000)
+        self.sleep_s = (
+            0.0005,
+            settings.get('scan_interval_reduced_ms', 10) / 1000.0,
+            settings.get('scan_interval_minimal_ms', 50) / 1000.0,
+        )
+        self.tier = TIER_FULL
+        self.tier_ms = [0, 0, 0]
+        self.wake_count = [0, 0, 0]
+        self.wake_latency_max_ms = [0, 0, 0]
+        self.last_update_ms = ticks_ms()
+
+    def update(self, now_ms, last_activity_ms, busy):
+        """Account the time since the last call and return the sleep for this pass"""
+        self.tier_ms[self.tier] += (now_ms - self.last_update_ms) & TICKS_MASK
+        self.last_update_ms = now_ms
+        
+        tier = TIER_FULL
+        if not busy:
+            idle_ms = (now_ms - last_activity_ms) & TICKS_MASK
+            if idle_ms >= self.minimal_after_ms:
+                tier = TIER_MINIMAL
+            elif idle_ms >= self.reduced_after_ms:
+                tier = TIER_REDUCED
+        
+        if tier != self.tier:
+            self.tier = tier
+            if log.enabled(LOG_INFO):
+                log.info("Scan rate: %s (%s)", TIER_NAMES[tier], self.summary())
+        return self.sleep_s[tier]
+
+    def note_activity(self, now_ms):
+        """A key event arrived: go back to full rate and record the wake latency"""
+        tier = self.tier
+        if tier == TIER_FULL:
+            return
+        latency_ms = (now_ms - self.last_update_ms) & TICKS_MASK
+        self.wake_count[tier] += 1
+        if latency_ms > self.wake_latency_max_ms[tier]:
+            self.wake_latency_max_ms[tier] = latency_ms
+        self.tier_ms[tier] += latency_ms
+        self.last_update_ms = now_ms
+        self.tier = TIER_FULL
+
+    def summary(self):
+        parts = []
+        for tier in range(3):
+            parts.append(f"{TIER_NAMES[tier]} {self.tier_ms[tier] // 1000}s"
+                         f" wakes={self.wake_count[tier]} max_wake={self.wake_latency_max_ms[tier]}ms")
+        return ", ".join(parts)
+
+    def report(self):
+        print(f"Scan tiers: {self.summary()}")
+
+class PowerManager:
+    """Puts the pad to sleep after sleep_timeout_minutes and wakes it on a key press.
+
+    Before sleeping every row is driven low and every column becomes a
+    pull-up PinAlarm, so closing any switch wakes the chip. After a light
+    sleep the scanner is rebuilt and the matrix scanned straight away, so the
+    key that woke the pad is reported like a normal press. If the BLE link is
+    not back yet, presses within wake_key_hold_ms are buffered by the BLE
+    connection manager until it reconnects. A deep sleep restarts code.py and
+    the same replay runs at boot. The wake latency is the time to the first
+    report within wake_key_hold_ms of the wake; without one nothing is recorded.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        settings = owner.settings
+        self.enabled = ALARM_AVAILABLE and settings.get('power_save_mode', False)
+        self.timeout_ms = settings.get('sleep_timeout_minutes', 30) * 60_000
+        self.sleep_mode = settings.get('sleep_mode', 'light')  # 'light' or 'deep'
+        self.wake_hold_ms = settings.get('wake_key_hold_ms', 3000)
+        self.wake_ns = 0
+        self.wake_ms = 0
+        self.measuring_wake = False
+        self.last_wake_latency_ms = -1
+        self.sleep_count = 0
+
+    def check(self, now_ms, last_activity_ms, busy):
+        """Enter sleep once the pad has been idle for the configured timeout"""
+        if self.measuring_wake and (now_ms - self.wake_ms) & TICKS_MASK >= self.wake_hold_ms:
+            # The wake key sent nothing, so a later press must not count as the wake latency
+            self.measuring_wake = False
+            log.info("%s: no report within %dms of waking", self.owner.device_name, self.wake_hold_ms)
+        if not self.enabled or busy:
+            return
+        if (now_ms - last_activity_ms) & TICKS_MASK < self.timeout_ms:
+            return
+        self.sleep()
+
+    def sleep(self):
+        owner = self.owner
+        log.info("%s: idle for %d min - entering %s sleep", owner.device_name, self.timeout_ms // 60_000, self.sleep_mode)
+        owner.macro_scheduler.cancel()
+        if owner.status_led:
+            owner.status_led.off()
+        
+        # Free the matrix pins, then set them up as wake sources
+        owner.scanner.deinit()
+        rows = []
+        for pin in owner.row_pins:
+            row = digitalio.DigitalInOut(pin)
+            row.direction = digitalio.Direction.OUTPUT
+            row.value = False
+            rows.append(row)
+        alarms = [alarm.pin.PinAlarm(pin=pin, value=False, pull=True) for pin in owner.col_pins]
+        self.sleep_count += 1
+        
+        if self.sleep_mode == 'deep':
+            try:
+                # Rows must stay driven low while the chip is off
+                alarm.exit_and_deep_sleep_until_alarms(*alarms, preserve_dios=rows)
+            except TypeError:
+                alarm.exit_and_deep_sleep_until_alarms(*alarms)
+        
+        alarm.light_sleep_until_alarms(*alarms)
+        self.start_wake()
+        for row in rows:
+            row.deinit()
+        owner.scanner = owner.create_scanner(owner.scanner.name)
+        owner.restore_link()
+        self.replay_wake_key()
+
+    def start_wake(self):
+        self.wake_ns = time.monotonic_ns()
+        self.wake_ms = ticks_ms()
+        self.measuring_wake = True
+        self.last_wake_latency_ms = -1
+        if self.owner.ble_link is not None:
+            self.owner.ble_link.open_buffer_window(self.wake_ms, self.wake_hold_ms)
+        log.info("%s: woke from sleep", self.owner.device_name)
+
+    def handle_boot_wake(self):
+        """After a deep sleep code.py restarts; replay the key that woke it"""
+        if not ALARM_AVAILABLE or not isinstance(alarm.wake_alarm, alarm.pin.PinAlarm):
+            return
+        self.start_wake()
+        # The chip reset on wake, so the monotonic clock started at the wake press
+        self.wake_ns = 0
+        self.replay_wake_key()
+
+    def replay_wake_key(self):
+        """Scan immediately so a still-held wake key is reported on this pass"""
+        owner = self.owner
+        owner.scan_matrix()
+        owner.last_activity = ticks_ms()
+
+    def note_report(self):
+        """Record wake-to-first-report latency on the first report after a wake"""
+        if not self.measuring_wake:
+            return
+        self.last_wake_latency_ms = (time.monotonic_ns() - self.wake_ns) // 1_000_000
+        self.measuring_wake = False
+        log.info("%s: wake to first report %dms", self.owner.device_name, self.last_wake_latency_ms)
+
+class BleConnectionManager:
+    """Owns the BLE radio, advertising and reconnects.
+
+    The advertisement is built once. Advertising starts at the fast interval
+    so a bonded host finds the pad quickly and drops to the slow interval after
+    ble_fast_advertising_ms. Once connected it asks for a short connection
+    interval. Bonds stay in _bleio's storage, so a known host reconnects
+    without pairing again. Presses made within ble_reconnect_buffer_ms of a
+    dropped link (or of a wake from sleep) are buffered and played once the
+    link is back; later ones are dropped and counted.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        settings = owner.settings
+        self.fast_interval_s = settings.get('ble_fast_advertising_interval_ms', 20) / 1000
+        self.slow_interval_s = settings.get('ble_slow_advertising_interval_ms', 1000) / 1000
+        self.fast_advertising_ms = settings.get('ble_fast_advertising_ms', 30_000)
+        self.connection_interval_ms = settings.get('ble_connection_interval_ms', 7.5)
+        self.poll_ms = settings.get('ble_poll_ms', 50)
+        self.buffer_window_ms = settings.get('ble_reconnect_buffer_ms', 3000)
+
+        self.ble = adafruit_ble.BLERadio()
+        self.hid_service = HIDService()
+        self.device_info = DeviceInfoService(
+            software_revision=adafruit_ble.__version__,
+            manufacturer="Kyupad",
+            model=f"ESP32-S3 4x4 Macropad #{owner.device_id}"
+        )
+        self.advertisement = ProvideServicesAdvertisement(self.hid_service)
+        self.advertisement.appearance = 961  # HID Keyboard
+        self.advertisement.complete_name = owner.device_name
+
+        self.connected = False
+        self.advertising = ADVERTISING_OFF
+        self.advertising_start_ms = 0
+        self.last_poll_ms = ticks_ms()
+        self.disconnect_ms = 0
+        self.ever_connected = False
+        self.window_start_ms = 0
+        self.window_ms = 0
+        self.buffer_buttons = bytearray(BLE_PRESS_BUFFER_SIZE)
+        self.buffer_count = 0
+
+        self.connects = 0
+        self.disconnects = 0
+        self.last_reconnect_ms = -1
+        self.max_reconnect_ms = 0
+        self.buffered_keys = 0
+        self.dropped_keys = 0
+
+    @property
+    def devices(self):
+        return self.hid_service.devices
+
+    @property
+    def keyboard_device(self):
+        return find_device(self.hid_service.devices, usage_page=0x1, usage=0x06)
+
+    def start_advertising(self, now_ms, mode):
+        interval_s = self.fast_interval_s if mode == ADVERTISING_FAST else self.slow_interval_s
+        try:
+            if self.ble.advertising:
+                self.ble.stop_advertising()
+            self.ble.start_advertising(self.advertisement, interval=interval_s)
+        except Exception as e:
+            log.error("Failed to start advertising: %s", e)
+            return
+        self.advertising = mode
+        self.advertising_start_ms = now_ms
+        log.info("%s: %s advertising every %dms", self.owner.device_name,
+                 "fast" if mode == ADVERTISING_FAST else "slow", int(interval_s * 1000))
+
+    def poll(self, now_ms):
+        """Track the link state; called from the main loop"""
+        if (now_ms - self.last_poll_ms) & TICKS_MASK < self.poll_ms:
+            return
+        self.last_poll_ms = now_ms
+        connected = self.ble.connected
+        if connected and not self.connected:
+            self.on_connect(now_ms)
+        elif self.connected and not connected:
+            self.on_disconnect(now_ms)
+        elif not connected:
+            if self.advertising == ADVERTISING_FAST:
+                if (now_ms - self.advertising_start_ms) & TICKS_MASK >= self.fast_advertising_ms:
+                    self.start_advertising(now_ms, ADVERTISING_SLOW)
+            elif not self.ble.advertising:
+                self.start_advertising(now_ms, ADVERTISING_FAST)
+
+    def on_connect(self, now_ms):
+        self.connected = True
+        self.connects += 1
+        if self.ble.advertising:
+            self.ble.stop_advertising()
+        self.advertising = ADVERTISING_OFF
+        for connection in self.ble.connections:
+            try:
+                connection.connection_interval = self.connection_interval_ms
+            except Exception as e:
+                log.warning("Connection interval request failed: %s", e)
+        
+        if self.ever_connected:
+            reconnect_ms = (now_ms - self.disconnect_ms) & TICKS_MASK
+            self.last_reconnect_ms = reconnect_ms
+            if reconnect_ms > self.max_reconnect_ms:
+                self.max_reconnect_ms = reconnect_ms
+            log.info("✅ %s Bluetooth reconnected in %dms", self.owner.device_name, reconnect_ms)
+        else:
+            log.info("✅ %s Bluetooth connected!", self.owner.device_name)
+        self.ever_connected = True
+        self.flush_buffer(now_ms)
+
+    def on_disconnect(self, now_ms):
+        self.connected = False
+        self.disconnects += 1
+        self.disconnect_ms = now_ms
+        self.open_buffer_window(now_ms, self.buffer_window_ms)
+        log.warning("❌ %s Bluetooth disconnected. Restarting advertising...", self.owner.device_name)
+        self.start_advertising(now_ms, ADVERTISING_FAST)
+
+    def open_buffer_window(self, now_ms, window_ms):
+        """Buffer presses for window_ms from now_ms while the link is down"""
+        self.window_start_ms = now_ms
+        self.window_ms = window_ms
+
+    def window_open(self, now_ms):
+        return (now_ms - self.window_start_ms) & TICKS_MASK < self.window_ms
+
+    def buffer_press(self, button_index, now_ms):
+        """Hold a press made while the link is down; False if it has to be dropped"""
+        if not self.window_open(now_ms) or self.buffer_count == BLE_PRESS_BUFFER_SIZE:
+            self.dropped_keys += 1
+            return False
+        self.buffer_buttons[self.buffer_count] = button_index
+        self.buffer_count += 1
+        self.buffered_keys += 1
+        return True
+
+    def flush_buffer(self, now_ms):
+        """Link is up: play buffered presses, unless the window ran out first.
+
+        They are submitted as pressed at now_ms, so each macro keeps its own
+        delays instead of bursting out as overdue.
+        """
+        count = self.buffer_count
+        self.buffer_count = 0
+        if not count:
+            return
+        if not self.window_open(now_ms):
+            self.dropped_keys += count
+            log.warning("%s: %d buffered key presses expired", self.owner.device_name, count)
+            return
+        for index in range(count):
+            self.owner.macro_scheduler.submit(self.buffer_buttons[index], now_ms)
+
+    def restore(self, now_ms):
+        """Resync after a sleep and check the link on the next poll"""
+        if self.ble.connected:
+            if not self.connected:
+                self.on_connect(now_ms)
+        else:
+            self.connected = False
+            if not self.ble.advertising:
+                log.info("%s: Restarting advertising after sleep...", self.owner.device_name)
+                self.start_advertising(now_ms, ADVERTISING_FAST)
+        self.last_poll_ms = (now_ms - self.poll_ms) & TICKS_MASK
+
+    def report(self):
+        print(f"BLE: connects={self.connects} disconnects={self.disconnects} "
+              f"reconnect last={self.last_reconnect_ms}ms max={self.max_reconnect_ms}ms "
+              f"buffered keys={self.buffered_keys} dropped keys={self.dropped_keys}")
+
+def usb_enumerated():
+    """True while a USB host has the pad enumerated"""
+    if SUPERVISOR_AVAILABLE:
+        # Older CircuitPython builds cannot tell, so assume USB is there
+        return getattr(supervisor.runtime, 'usb_connected', True)
+    return True
+
+class TransportManager:
+    """Sends the reports to whichever host is attached, preferring USB.
+
+    In auto mode USB HID and the BLE HID service are both kept ready. poll()
+    picks USB while it is enumerated, else a connected BLE host, and moves
+    the report to it at runtime: the host being left gets a release, the new
+    one the keys still held. While no transport is live, presses go to the BLE
+    press buffer and macros wait. Switch latency runs from the last poll that
+    saw the old transport live; time without a live transport is counted from
+    the first attach on.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.usb_device = owner.usb_device
+        self.ble_link = owner.ble_link
+        self.poll_ms = owner.settings.get('transport_poll_ms', 10)
+        now_ms = ticks_ms()
+        self.last_poll_ms = now_ms
+        self.active = self.select()
+        self.ever_live = self.active != TRANSPORT_NONE
+        self.live_ms = now_ms
+        self.outage_start_ms = now_ms
+        owner.is_connected = self.ever_live
+
+        self.switches = 0
+        self.last_switch_ms = -1
+        self.max_switch_ms = 0
+        self.outages = 0
+        self.no_transport_ms = 0
+
+    def select(self):
+        if self.usb_device is not None and usb_enumerated():
+            return TRANSPORT_USB
+        if self.ble_link is not None and self.ble_link.connected:
+            return TRANSPORT_BLE
+        return TRANSPORT_NONE
+
+    def device(self):
+        """HID device of the active transport, None while nothing is attached"""
+        if self.active == TRANSPORT_USB:
+            return self.usb_device
+        if self.active == TRANSPORT_BLE:
+            return self.ble_link.keyboard_device
+        return None
+
+    def poll(self, now_ms):
+        """Follow USB enumeration and the BLE link; called from the main loop"""
+        if self.ble_link is not None:
+            self.ble_link.poll(now_ms)
+        if (now_ms - self.last_poll_ms) & TICKS_MASK < self.poll_ms:
+            return
+        self.last_poll_ms = now_ms
+        target = self.select()
+        if target == self.active:
+            if target != TRANSPORT_NONE:
+                self.live_ms = now_ms
+            return
+        self.switch(target, now_ms)
+
+    def recheck(self):
+        """Poll again on the next loop, e.g. after a failed send"""
+        self.last_poll_ms = (self.last_poll_ms - self.poll_ms) & TICKS_MASK
+
+    def switch(self, target, now_ms):
+        owner = self.owner
+        previous = self.active
+        self.active = target
+        owner.keyboard.switch_device(self.device())
+        if target == TRANSPORT_NONE:
+            owner.is_connected = False
+            self.outage_start_ms = self.live_ms
+            self.outages += 1
+            if self.ble_link is not None:
+                self.ble_link.open_buffer_window(now_ms, self.ble_link.buffer_window_ms)
+            log.warning("%s: no live HID transport", owner.device_name)
+            return
+
+        owner.is_connected = True
+        if self.ever_live:
+            switch_ms = (now_ms - self.live_ms) & TICKS_MASK
+            if previous == TRANSPORT_NONE:
+                self.no_transport_ms += switch_ms
+            self.switches += 1
+            self.last_switch_ms = switch_ms
+            if switch_ms > self.max_switch_ms:
+                self.max_switch_ms = switch_ms
+            log.info("%s: sending to %s, switched in %dms", owner.device_name,
+                     TRANSPORT_NAMES[target], switch_ms)
+        else:
+            log.info("%s: sending to %s", owner.device_name, TRANSPORT_NAMES[target])
+        self.ever_live = True
+        self.live_ms = now_ms
+        # A macro that waited for the host continues with its remaining delays
+        owner.macro_scheduler.resume(time.monotonic_ns())
+        if self.ble_link is not None:
+            self.ble_link.flush_buffer(now_ms)
+
+    def restore(self, now_ms):
+        """Resync after a sleep and pick the transport on the next loop"""
+        if self.ble_link is not None:
+            self.ble_link.restore(now_ms)
+        if self.active == TRANSPORT_USB:
+            try:
+                self.owner.keyboard.release_all()
+                self.owner.keyboard.flush()
+            except OSError as e:
+                log.warning("USB HID not ready after sleep: %s", e)
+        self.recheck()
+
+    def report(self):
+        print(f"Transport: active={TRANSPORT_NAMES[self.active]} switches={self.switches} "
+              f"switch last={self.last_switch_ms}ms max={self.max_switch_ms}ms "
+              f"outages={self.outages} no transport={self.no_transport_ms}ms")
+
+class LiveKeymapLink:
+    """Applies keymap changes pushed by the editor over the USB CDC data channel.
+
+    Frames are read between scans. A button delta recompiles only that
+    button; a settings delta applies what can change at runtime and reports
+    the rest as needing a restart; a layer frame switches the current layer.
+    With FLAG_PERSIST the change is also
+    written to keymap.json, which needs the filesystem writable from code
+    (storage.remount in boot.py). Every frame is answered with an ACK.
+    """
+
+    def __init__(self, owner, stream):
+        self.owner = owner
+        self.stream = stream
+        stream.timeout = 0
+        stream.write_timeout = 0.1
+        self.decoder = FrameDecoder()
+        self.poll_ms = owner.settings.get('live_keymap_poll_ms', 10)
+        self.last_poll_ms = ticks_ms()
+        self.applied = 0
+        self.rejected = 0
+        self.last_apply_us = 0
+        self.max_apply_us = 0
+
+    def poll(self, now_ms):
+        """Apply every complete frame waiting on the data channel"""
+        if (now_ms - self.last_poll_ms) & TICKS_MASK < self.poll_ms:
+            return
+        self.last_poll_ms = now_ms
+        waiting = self.stream.in_waiting
+        if not waiting:
+            return
+        self.decoder.feed(self.stream.read(waiting))
+        frame = self.decoder.next_frame()
+        while frame is not None:
+            self.handle(frame)
+            frame = self.decoder.next_frame()
+
+    def handle(self, frame):
+        frame_type, flags, sequence, payload = frame
+        start_ns = time.monotonic_ns()
+        if payload is None:
+            status = STATUS_BAD_FRAME
+        elif frame_type == FRAME_PING:
+            status = STATUS_OK
+        elif frame_type == FRAME_BUTTON or frame_type == FRAME_SETTINGS or frame_type == FRAME_LAYER:
+            status = self.apply(frame_type, flags, payload)
+        else:
+            status = STATUS_BAD_FRAME
+        apply_us = (time.monotonic_ns() - start_ns) // 1000
+        if status == STATUS_BAD_FRAME or status == STATUS_BAD_DELTA:
+            self.rejected += 1
+            log.warning("Live keymap frame %d rejected: %s", sequence, STATUS_NAMES[status])
+        else:
+            self.applied += 1
+            self.last_apply_us = apply_us
+            if apply_us > self.max_apply_us:
+                self.max_apply_us = apply_us
+        try:
+            self.stream.write(encode_ack(sequence, status, apply_us))
+        except Exception as e:
+            log.warning("Live keymap ACK not sent: %s", e)
+
+    def apply(self, frame_type, flags, payload):
+        owner = self.owner
+        try:
+            delta = json.loads(payload.decode('utf-8'))
+            if frame_type == FRAME_BUTTON:
+                owner.apply_button_delta(delta['button'], delta.get('data'), delta.get('layer', 0))
+                status = STATUS_OK
+            elif frame_type == FRAME_LAYER:
+                owner.select_layer(delta['layer'])
+                status = STATUS_OK
+            else:
+                status = owner.apply_settings_delta(delta)
+        except Exception as e:
+            log.warning("Live keymap delta not applied: %s", e)
+            return STATUS_BAD_DELTA
+        if flags & FLAG_PERSIST:
+            try:
+                owner.persist_delta(frame_type, delta)
+            except Exception as e:
+                log.warning("Could not write keymap.json: %s", e)
+                return STATUS_PERSIST_FAILED
+        return status
+
+    def report(self):
+        print(f"Live keymap: applied={self.applied} rejected={self.rejected} "
+              f"apply last={self.last_apply_us}us max={self.max_apply_us}us "
+              f"skipped bytes={self.decoder.skipped_bytes}")
+
+class KeyboardReport:
+    """Builds 8-byte boot keyboard reports and sends them to the HID device.
+
+    Press/release calls only edit the report buffer; flush() sends it. That
+    lets every event due at the same moment go out as one report, where the
+    adafruit_hid Keyboard sends one report per call. With no device (no host
+    attached) the report is kept until switch_device() gives it one.
+    """
+
+    def __init__(self, device, stats):
+        self.device = device
+        self.stats = stats
+        self.report = bytearray(8)
+        self.dirty = False
+        self.batch_pressed = False
+        self.batch_released = False
+        self.reports_sent = 0
+        try:
+            self.release_all()
+            self.flush()
+        except OSError:
+            # USB may not be enumerated yet, same retry as adafruit_hid
+            time.sleep(1)
+            self.flush()
+
+    def press(self, keycode):
+        # A press after a release in the same batch must not cancel it out
+        if self.batch_released:
+            self.flush()
+        report = self.report
+        if 0xE0 <= keycode <= 0xE7:
+            report[0] |= 1 << (keycode - 0xE0)
+        else:
+            free_slot = 0
+            for i in range(2, 8):
+                if report[i] == keycode:
+                    return
+                if not free_slot and report[i] == 0:
+                    free_slot = i
+            if not free_slot:
+                raise ValueError("Trying to press more than six keys at once.")
+            report[free_slot] = keycode
+        self.dirty = True
+        self.batch_pressed = True
+
+    def release(self, keycode):
+        if self.batch_pressed:
+            self.flush()
+        report = self.report
+        if 0xE0 <= keycode <= 0xE7:
+            report[0] &= ~(1 << (keycode - 0xE0)) & 0xFF
+        else:
+            for i in range(2, 8):
+                if report[i] == keycode:
+                    report[i] = 0
+        self.dirty = True
+        self.batch_released = True
+
+    def release_all(self):
+        if self.batch_pressed:
+            self.flush()
+        report = self.report
+        for i in range(8):
+            report[i] = 0
+        self.dirty = True
+        self.batch_released = True
+
+    def flush(self):
+        """Send the report if anything changed since the last one"""
+        self.batch_pressed = False
+        self.batch_released = False
+        if not self.dirty or self.device is None:
+            return False
+        if _STATS:
+            # Reports only go out around key activity, which the idle gc.collect() follows
+            start_ns = time.monotonic_ns()
+            self.device.send_report(self.report)
+            self.stats.hid_send_us.record((time.monotonic_ns() - start_ns) // 1000)
+        else:
+            self.device.send_report(self.report)
+        # Only cleared once sent, so a failed send is repeated on the next host
+        self.dirty = False
+        self.reports_sent += 1
+        return True
+
+    def switch_device(self, device):
+        """Send to device from now on, moving the held keys over from the old one"""
+        old_device = self.device
+        self.device = device
+        if old_device is not None:
+            try:
+                old_device.send_report(RELEASED_REPORT)
+            except Exception as e:
+                log.debug("Release on the previous HID device failed: %s", e)
+        self.batch_pressed = False
+        self.batch_released = False
+        # The new host has seen nothing yet; an empty report needs no send
+        for byte in self.report:
+            if byte:
+                self.dirty = True
+                break
+        else:
+            self.dirty = False
+        self.flush()
+
+class StatusLed:
+    """Time-based status LED effects that never block.
+
+    update() works out the LED level from ticks_ms and only writes the pin
+    when the level changes. A press flash inverts the current effect for
+    LED_PRESS_FLASH_MS; low battery replaces the effect with a triple blink.
+    With status_led_pwm the LED runs through pwmio at status_led_brightness.
+    """
+
+    def __init__(self, pin, settings):
+        self.effect = LED_EFFECT_OFF
+        self.low_battery = False
+        self.flashing = False
+        self.flash_start_ms = 0
+        self.level = None
+        self.pwm = None
+        self.pin = None
+        brightness = min(max(int(settings.get('status_led_brightness', 100)), 0), 100)
+        self.on_duty = brightness * 65535 // 100
+        if settings.get('status_led_pwm', False):
+            try:
+                import pwmio
+                self.pwm = pwmio.PWMOut(pin, frequency=1000, duty_cycle=0)
+            except (ImportError, ValueError, RuntimeError) as e:
+                log.warning("PWM status LED unavailable (%s) - using on/off", e)
+        if self.pwm is None:
+            self.pin = digitalio.DigitalInOut(pin)
+            self.pin.direction = digitalio.Direction.OUTPUT
+        self.write(False)
+
+    def flash(self, now_ms):
+        self.flashing = True
+        self.flash_start_ms = now_ms
+
+    def update(self, now_ms):
+        if self.low_battery:
+            phase = now_ms % LED_LOW_BATTERY_PERIOD_MS
+            on = phase < 6 * LED_LOW_BATTERY_BLINK_MS and (phase // LED_LOW_BATTERY_BLINK_MS) % 2 == 0
+        elif self.effect == LED_EFFECT_CONNECTED:
+            on = True
+        elif self.effect == LED_EFFECT_ADVERTISING:
+            on = now_ms % LED_ADVERTISING_BLINK_MS < LED_ADVERTISING_BLINK_MS // 2
+        elif self.effect == LED_EFFECT_USB:
+            on = now_ms % LED_USB_BLINK_MS < LED_USB_BLINK_MS // 2
+        else:
+            on = False
+
+        if self.flashing:
+            if (now_ms - self.flash_start_ms) & TICKS_MASK >= LED_PRESS_FLASH_MS:
+                self.flashing = False
+            else:
+                on = not on
+
+        if on != self.level:
+            self.write(on)
+
+    def write(self, on):
+        self.level = on
+        if self.pwm is not None:
+            self.pwm.duty_cycle = self.on_duty if on else 0
+        else:
+            self.pin.value = on
+
+    def off(self):
+        self.flashing = False
+        self.write(False)
+
+class GPIOMatrixScanner:
+    """Scans the matrix from Python by driving rows and reading columns"""
+
+    name = 'gpio'
+
+    def __init__(self, row_pins, col_pins, debouncer, events):
+        self.debouncer = debouncer
+        self.events = events
+        rows = []
+        cols = []
+        
+        # Initialize row pins (outputs)
+        for pin in row_pins:
+            row = digitalio.DigitalInOut(pin)
+            row.direction = digitalio.Direction.OUTPUT
+            row.value = False
+            rows.append(row)
+        
+        # Initialize column pins (inputs with pull-up)
+        for pin in col_pins:
+            col = digitalio.DigitalInOut(pin)
+            col.direction = digitalio.Direction.INPUT
+            col.pull = digitalio.Pull.UP
+            cols.append(col)
+        
+        self.rows = tuple(rows)
+        self.cols = tuple(cols)
+
+    def scan(self, now_ms):
+        debouncer = self.debouncer
+        rows = self.rows
+        cols = self.cols
+        key = 0
+        row_idx = 0
+        while row_idx < 4:
+            row = rows[row_idx]
+            row.value = True
+            # Shorter delay for ESP32-S3 (faster GPIO)
+            time.sleep(0.00005)  # 50μs instead of 100μs
+            
+            col_idx = 0
+            while col_idx < 4:
+                edge = debouncer.update(key, not cols[col_idx].value, now_ms)
+                if edge:
+                    self.events.push(key, edge, debouncer.edge_time_ms(key))
+                key += 1
+                col_idx += 1
+            
+            row.value = False
+            row_idx += 1
+
+    def deinit(self):
+        for pin in self.rows + self.cols:
+            pin.deinit()
+
+class KeyMatrixScanner:
+    """Lets CircuitPython's keypad module scan the matrix in C in the background.
+
+    keypad queues timestamped state changes, and scan() feeds them through
+    the shared KeyDebouncer, so both debounce modes and per-key debounce_ms
+    overrides behave as with the GPIO scanner. keypad's own debounce_threshold
+    is left at one scan because it applies a single window to both edges of
+    every key. Keys whose raw state still differs from the debounced one are
+    re-checked on each scan until their window has passed.
+    """
+
+    name = 'keymatrix'
+
+    def __init__(self, row_pins, col_pins, interval_ms, debouncer, events):
+        self.debouncer = debouncer
+        self.events = events
+        self.matrix = keypad.KeyMatrix(row_pins, col_pins, interval=interval_ms / 1000.0, max_events=64)
+        self.event = keypad.Event()
+        # Bit per key waiting out its debounce window
+        self.unsettled = 0
+
+    def scan(self, now_ms):
+        events = self.matrix.events
+        event = self.event
+        while events.get_into(event):
+            # keypad timestamps come from supervisor.ticks_ms()
+            self.settle(event.key_number, 1 if event.pressed else 0,
+                        event.timestamp if SUPERVISOR_AVAILABLE else now_ms)
+        if events.overflowed:
+            log.warning("Key event queue overflowed - some key events were lost")
+            events.clear()
+            self.matrix.reset()
+
+        unsettled = self.unsettled
+        key = 0
+        while unsettled:
+            if unsettled & 1:
+                self.settle(key, self.debouncer.raw[key], now_ms)
+            unsettled >>= 1
+            key += 1
+
+    def settle(self, key, pressed, now_ms):
+        debouncer = self.debouncer
+        edge = debouncer.update(key, pressed, now_ms)
+        if edge:
+            self.events.push(key, edge, debouncer.edge_time_ms(key))
+        if debouncer.raw[key] != debouncer.stable[key]:
+            self.unsettled |= 1 << key
+        else:
+            self.unsettled &= ~(1 << key)
+
+    def deinit(self):
+        self.matrix.deinit()
+
+class FakeMatrixScanner:
+    """Matrix backend without hardware, driven by set_key() from host tests"""
+
+    name = 'fake'
+
+    def __init__(self, debouncer, events):
+        self.debouncer = debouncer
+        self.events = events
+        self.raw = bytearray(16)
+
+    def set_key(self, key, pressed):
+        self.raw[key] = 1 if pressed else 0
+
+    def scan(self, now_ms):
+        debouncer = self.debouncer
+        key = 0
+        while key < 16:
+            edge = debouncer.update(key, self.raw[key], now_ms)
+            if edge:
+                self.events.push(key, edge, debouncer.edge_time_ms(key))
+            key += 1
+
+    def deinit(self):
+        pass
+
+class Layer:
+    """One layer's 16 buttons, compiled at boot.
+
+    Everything a key press reads lives here, so switching layers is a single
+    assignment of KyupadFirmware.layer. Button i of a layer reaches the macro
+    scheduler as base + i.
+    """
+
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+        self.base = index * 16
+        self.compiled = [None] * 16
+        self.names = [None] * 16
+        # Layer keys: target layer number, LAYER_NEXT or LAYER_PREV
+        self.targets = [None] * 16
+        self.press_messages = [None] * 16
+        self.release_messages = [None] * 16
+        self.switch_message = None
+        # Heap the compiled layer takes, where gc.mem_free() is available
+        self.heap_bytes = 0
+
+class HeapProbe:
+    """Heap used since creation, read from gc.mem_free(); sample() tracks the peak"""
+
+    def __init__(self):
+        gc.collect()
+        self.start_free = gc.mem_free()
+        self.low_free = self.start_free
+
+    def sample(self):
+        free = gc.mem_free()
+        if free < self.low_free:
+            self.low_free = free
+
+    def peak(self):
+        self.sample()
+        return self.start_free - self.low_free
+
+    def retained(self):
+        gc.collect()
+        return self.start_free - gc.mem_free()
+
+class BootTimer:
+    """Durations of the boot phases, logged once the first scan is ready.
+
+    The timings are kept afterwards so the serial "stats" command can print
+    them at any log level.
+    """
+    def __init__(self, start_ns):
+        self.start_ns = start_ns
+        self.last_ns = start_ns
+        self.phases = []
+
+    def mark(self, name):
+        """End the current phase under name and start the next one"""
+        now_ns = time.monotonic_ns()
+        self.phases.append((name, (now_ns - self.last_ns) // 1000))
+        self.last_ns = now_ns
+
+    def summary(self):
+        phases = ", ".join([f"{name} {us / 1000:.1f}ms" for name, us in self.phases])
+        total_ms = (self.last_ns - self.start_ns) / 1_000_000
+        # monotonic_ns() counts from power-on on CircuitPython
+        return (f"Boot: {phases}",
+                f"Boot: code.py {total_ms:.1f}ms, first scan ready {self.last_ns // 1_000_000}ms after power-on")
+
+    def report(self):
+        if log.enabled(LOG_INFO):
+            for line in self.summary():
+                log.info("%s", line)
 
 class KyupadFirmware:
     def __init__(self):
-        print("Initializing Kyupad...")
+        log.info("Initializing Kyupad...")
+        self.boot_timer = BootTimer(BOOT_START_NS)
+        self.boot_timer.mark("imports")
         
+        self.keymap_bin = None
+        self.keymap_bin_index = None
+        self.keymap_bin_names = None
+        self.keymap_bin_layers = None
+        self.keymap_bin_targets = None
         self.keymap = self.load_keymap()
-        self.settings = self.keymap.get('settings', {})
+        self.settings = self.keymap.setdefault('settings', {})
+        self.apply_log_settings()
+        if self.settings.get('debug_keymap_heap', False) and MEM_FREE_AVAILABLE:
+            self.compare_keymap_heap()
         
         self.device_id = self.settings.get('device_id', 1)
         self.device_name = f"Kyupad-{self.device_id}"
         
-        print(f"Device ID: {self.device_id}")
-        print(f"Device Name: {self.device_name}")
+        log.info("Device ID: %s", self.device_id)
+        log.info("Device Name: %s", self.device_name)
+        self.boot_timer.mark("keymap")
         
         try:
             # ESP32-S3 Zero Super Mini pinout
@@ -41,209 +1474,288 @@ class KyupadFirmware:
             # Status LED pin for ESP32-S3
             self.status_led_pin = board.GPIO9
         except AttributeError as e:
-            print(f"Pin assignment error: {e}")
-            print("Trying alternative ESP32-S3 pin names...")
+            log.warning("Pin assignment error: %s", e)
+            log.warning("Trying alternative ESP32-S3 pin names...")
             try:
                 self.row_pins = [board.IO1, board.IO2, board.IO3, board.IO4]
                 self.col_pins = [board.IO5, board.IO6, board.IO7, board.IO8]
                 self.status_led_pin = board.IO9
             except AttributeError:
-                print("Trying legacy ESP32-C3 pin names...")
+                log.warning("Trying legacy ESP32-C3 pin names...")
                 try:
                     self.row_pins = [board.GP2, board.GP3, board.GP4, board.GP5]
                     self.col_pins = [board.GP6, board.GP7, board.GP8, board.GP9]
                     self.status_led_pin = None
                 except AttributeError:
-                    print("All pin assignment attempts failed. Check board pinout.")
+                    log.error("All pin assignment attempts failed. Check board pinout.")
                     microcontroller.reset()
         
-        self.rows = []
-        self.cols = []
-        
-        # Initialize row pins (outputs)
-        for pin in self.row_pins:
-            row = digitalio.DigitalInOut(pin)
-            row.direction = digitalio.Direction.OUTPUT
-            row.value = False
-            self.rows.append(row)
-        
-        # Initialize column pins (inputs with pull-up)
-        for pin in self.col_pins:
-            col = digitalio.DigitalInOut(pin)
-            col.direction = digitalio.Direction.INPUT
-            col.pull = digitalio.Pull.UP
-            self.cols.append(col)
-        
         # Initialize status LED if available (ESP32-S3 feature)
         self.status_led = None
         if hasattr(self, 'status_led_pin') and self.status_led_pin:
             try:
-                self.status_led = digitalio.DigitalInOut(self.status_led_pin)
-                self.status_led.direction = digitalio.Direction.OUTPUT
-                self.status_led.value = False
-                print("Status LED initialized on GPIO9")
+                self.status_led = StatusLed(self.status_led_pin, self.settings)
+                log.info("Status LED initialized on GPIO9")
             except Exception as e:
-                print(f"Status LED initialization failed: {e}")
+                log.warning("Status LED initialization failed: %s", e)
                 self.status_led = None
         
+        self.boot_timer.mark("pins")
+        
         self.connection_mode = self.settings.get('connection_mode', 'usb')  # 'usb', 'bluetooth', or 'auto'
-        self.bluetooth_enabled = BLUETOOTH_AVAILABLE and self.connection_mode in ['bluetooth', 'auto']
+        self.bluetooth_enabled = self.connection_mode in ['bluetooth', 'auto']
         
-        # Initialize HID interfaces
-        self.keyboard = None
-        self.ble = None
-        self.hid_service = None
+        self.stats = FirmwareStats() if _STATS else None
+        self.last_serial_check = ticks_ms()
+        self.serial_line = ""
+        
+        # Initialize HID interfaces; auto mode keeps both USB and BLE ready
+        self.usb_device = None
+        self.ble_link = None
         self.is_connected = False
         
         if self.bluetooth_enabled:
             self.init_bluetooth()
-        else:
+        if self.connection_mode != 'bluetooth' or self.ble_link is None:
             self.init_usb()
+        self.transport = TransportManager(self)
+        self.keyboard = KeyboardReport(self.transport.device(), self.stats)
+        self.boot_timer.mark("hid")
         
-        self.key_states = [[False for _ in range(4)] for _ in range(4)]
-        self.last_scan_time = time.monotonic()
-        self.last_connection_check = time.monotonic()
+        # Scan period per scan tier, measured over batches of 1000 scans in one tier,
+        # so the idle tiers' sleeps never inflate the full-rate period
+        self.scan_count = 0
+        self.scan_window_start = ticks_ms()
+        self.scan_window_tier = TIER_FULL
+        self.scan_period_us = [0, 0, 0]
+        self.last_led_update = ticks_ms()
+        self.init_battery_sense()
+        self.last_activity = ticks_ms()
+        self.keys_down = 0
+        self.scan_governor = ScanGovernor(self.settings)
+        self.power_manager = PowerManager(self)
+        self.idle_collected = True
+        self.gc_idle_ms = self.settings.get('gc_idle_ms', 250)
+        self.alloc_check_scans = self.settings.get('debug_alloc_check_scans', 0)  # 0 disables the check
+        self.alloc_check_count = 0
+        self.alloc_check_bytes = 0
         
-        self.debounce_delay = self.settings.get('debounce_ms', 50) / 1000.0
+        self.debounce_ms = self.settings.get('debounce_ms', 50)
+        self.debounce_mode = self.settings.get('debounce_mode', 'eager')  # 'eager' or 'defer'
+        self.debouncer = KeyDebouncer(self.debounce_ms_per_key(), self.debounce_mode == 'eager')
+        self.key_events = KeyEventRing(KEY_EVENT_RING_SIZE)
+        self.scanner = self.create_scanner(self.settings.get('scanner_backend', 'gpio'))  # 'gpio', 'keymatrix' or 'fake'
         self.macro_speed = self.settings.get('macro_playback_speed', 1.0)
+        self.min_hold_ms = self.settings.get('min_hold_ms', DEFAULT_MIN_HOLD_MS)
+        self.text_cps = self.settings.get('text_cps', DEFAULT_TEXT_CPS)
+        self.layers = self.compile_layers()
+        self.layer = self.layers[0]
+        default_layer = self.settings.get('default_layer')
+        if default_layer is not None:
+            try:
+                self.layer = self.layers[resolve_layer_target(default_layer, self.layer_names)]
+            except (ValueError, IndexError):
+                log.warning("Unknown default_layer %s - starting on %s", default_layer, self.layer.name)
+        # Layer each key was pressed on, so its release is logged for the same button
+        self.press_layers = bytearray(16)
+        # Switches made by layer keys; they are counted but not timed, since
+        # monotonic_ns() would allocate on the key path
+        self.layer_key_switches = 0
+        self.macro_scheduler = MacroScheduler(self)
+        self.live_link = None
+        if USB_CDC_AVAILABLE and usb_cdc.data is not None and self.settings.get('live_keymap', True):
+            self.live_link = LiveKeymapLink(self, usb_cdc.data)
+            log.info("Live keymap updates enabled on the USB data channel")
+        self.not_connected_message = f"{self.device_name}: Not connected - ignoring key press"
+        self.queue_full_message = f"{self.device_name}: Macro queue full - key press dropped"
         
-        print(f"{self.device_name} Firmware initialized")
-        print(f"Connection mode: {self.connection_mode}")
-        print(f"Loaded {len(self.keymap.get('buttons', {}))} button mappings")
-        print(f"Board: ESP32-S3 Zero Super Mini (optimized)")
+        log.info("%s Firmware initialized", self.device_name)
+        log.info("Connection mode: %s", self.connection_mode)
+        mapped = 0
+        for layer in self.layers:
+            mapped += len([name for name in layer.names if name is not None])
+        source = "keymap.bin" if self.keymap_bin is not None else "keymap.json"
+        log.info("Loaded %d button mappings in %d layers from %s", mapped, len(self.layers), source)
+        log.info("Board: ESP32-S3 Zero Super Mini (optimized)")
         
         # ESP32-S3 specific optimizations
         self.enable_esp32s3_optimizations()
         
+        if self.power_manager.enabled:
+            log.info("Power save: %s sleep after %d min idle", self.power_manager.sleep_mode, self.power_manager.timeout_ms // 60_000)
+        self.power_manager.handle_boot_wake()
+        
         gc.collect()
+        self.boot_timer.mark("setup")
+
+    def apply_log_settings(self):
+        log.set_levels(LOG_LEVELS.get(self.settings.get('log_level', 'warning'), LOG_WARNING),
+                       LOG_LEVELS.get(self.settings.get('log_ring_level', 'info'), LOG_INFO))
 
     def enable_esp32s3_optimizations(self):
         """Enable ESP32-S3 specific optimizations"""
         try:
             # Try to optimize for ESP32-S3 dual-core performance
-            print("Applying ESP32-S3 optimizations...")
+            log.info("Applying ESP32-S3 optimizations...")
             
-            # Reduce scan delay for faster response (ESP32-S3 can handle it)
-            if self.debounce_delay > 0.01:  # 10ms minimum for ESP32-S3
-                self.debounce_delay = max(0.01, self.debounce_delay * 0.5)
-                print(f"Optimized debounce delay: {self.debounce_delay*1000:.1f}ms")
+            # Debounce runs per key, so the matrix is scanned on every pass
+            log.info("Per-key debounce: %sms (%s mode)", self.debounce_ms, self.debounce_mode)
             
-            # Enable status LED blinking if available
             if self.status_led:
-                self.led_blink_counter = 0
-                print("Status LED ready for connection indication")
+                log.info("Status LED ready for connection indication")
                 
         except Exception as e:
-            print(f"ESP32-S3 optimization failed: {e}")
+            log.warning("ESP32-S3 optimization failed: %s", e)
 
-    def update_status_led(self):
-        """Update status LED based on connection state (ESP32-S3 feature)"""
-        if not self.status_led:
+    def update_status_led(self, now_ms):
+        """Pick the LED effect from the connection state and advance it (ESP32-S3 feature)"""
+        if (now_ms - self.last_led_update) & TICKS_MASK < LED_UPDATE_INTERVAL_MS:
             return
-            
+        self.last_led_update = now_ms
+        
+        active = self.transport.active
+        if active == TRANSPORT_USB:
+            # Fast blink on USB
+            self.status_led.effect = LED_EFFECT_USB
+        elif active == TRANSPORT_BLE:
+            self.status_led.effect = LED_EFFECT_CONNECTED
+        elif self.ble_link is not None:
+            # Slow blink while advertising
+            self.status_led.effect = LED_EFFECT_ADVERTISING
+        else:
+            self.status_led.effect = LED_EFFECT_OFF
         try:
-            if self.bluetooth_enabled:
-                if self.is_connected:
-                    # Solid on when connected
-                    self.status_led.value = True
-                else:
-                    # Slow blink when advertising
-                    self.led_blink_counter = (self.led_blink_counter + 1) % 200
-                    self.status_led.value = self.led_blink_counter < 100
-            else:
-                # Fast blink for USB mode
-                self.led_blink_counter = (self.led_blink_counter + 1) % 40
-                self.status_led.value = self.led_blink_counter < 20
+            self.status_led.update(now_ms)
         except Exception as e:
-            print(f"Status LED update failed: {e}")
+            log.warning("Status LED update failed: %s", e)
+
+    def init_battery_sense(self):
+        """Set up battery voltage sensing for the low battery LED warning if configured"""
+        self.battery_sense = None
+        self.last_battery_check = ticks_ms()
+        self.battery_divider = self.settings.get('battery_divider', 2.0)
+        self.battery_low_mv = self.settings.get('battery_low_mv', 3400)
+        pin_name = self.settings.get('battery_sense_pin')
+        if not pin_name or not self.status_led:
+            return
+        try:
+            import analogio
+            self.battery_sense = analogio.AnalogIn(getattr(board, pin_name))
+            log.info("Battery sense on %s, low below %dmV", pin_name, self.battery_low_mv)
+        except (ImportError, AttributeError, ValueError) as e:
+            log.warning("Battery sense unavailable: %s", e)
+
+    def check_battery(self, now_ms):
+        if (now_ms - self.last_battery_check) & TICKS_MASK < BATTERY_CHECK_INTERVAL_MS:
+            return
+        self.last_battery_check = now_ms
+        sense = self.battery_sense
+        battery_mv = int(sense.value * sense.reference_voltage * self.battery_divider * 1000 / 65535)
+        low = battery_mv < self.battery_low_mv
+        if low != self.status_led.low_battery:
+            self.status_led.low_battery = low
+            if low:
+                log.warning("%s: battery low (%dmV)", self.device_name, battery_mv)
+            else:
+                log.info("%s: battery ok (%dmV)", self.device_name, battery_mv)
 
     def init_bluetooth(self):
         """Initialize Bluetooth HID connection"""
         try:
-            print(f"Initializing Bluetooth HID for {self.device_name}...")
-            
-            # Create BLE instance
-            self.ble = adafruit_ble.BLERadio()
-            
-            # Create HID service
-            self.hid_service = HIDService()
-            
-            # Create device info service with ESP32-S3 specific info
-            device_info = DeviceInfoService(
-                software_revision=adafruit_ble.__version__,
-                manufacturer="Kyupad",
-                model=f"ESP32-S3 4x4 Macropad #{self.device_id}"
-            )
+            log.info("Initializing Bluetooth HID for %s...", self.device_name)
+            if not load_bluetooth():
+                raise RuntimeError("Bluetooth libraries missing")
             
-            # Create advertisement
-            advertisement = ProvideServicesAdvertisement(self.hid_service)
-            advertisement.appearance = 961  # HID Keyboard
-            advertisement.complete_name = self.device_name
-            
-            # Initialize HID keyboard only
-            self.keyboard = Keyboard(self.hid_service.devices)
+            # Radio, HID service and the advertisement are created once
+            self.ble_link = BleConnectionManager(self)
             
             # Start advertising
-            self.ble.start_advertising(advertisement)
-            print(f"Bluetooth advertising started as '{self.device_name}'")
-            print(f"Pair with '{self.device_name}' in your device's Bluetooth settings")
+            self.ble_link.start_advertising(ticks_ms(), ADVERTISING_FAST)
+            log.info("Bluetooth advertising started as '%s'", self.device_name)
+            log.info("Pair with '%s' in your device's Bluetooth settings", self.device_name)
             
         except Exception as e:
-            print(f"Bluetooth initialization failed: {e}")
-            print("Falling back to USB mode...")
+            log.error("Bluetooth initialization failed: %s", e)
+            log.warning("Falling back to USB mode...")
             self.bluetooth_enabled = False
-            self.init_usb()
+            self.ble_link = None
 
     def init_usb(self):
         """Initialize USB HID connection"""
         try:
-            print(f"Initializing USB HID for {self.device_name}...")
-            self.keyboard = Keyboard(usb_hid.devices)
-            self.is_connected = True
-            print(f"USB HID initialized successfully for {self.device_name}")
+            log.info("Initializing USB HID for %s...", self.device_name)
+            self.usb_device = find_device(usb_hid.devices, usage_page=0x1, usage=0x06)
+            log.info("USB HID initialized successfully for %s", self.device_name)
         except Exception as e:
-            print(f"USB HID initialization failed: {e}")
-            print("Make sure USB HID is enabled in boot.py")
-            microcontroller.reset()
+            log.error("USB HID initialization failed: %s", e)
+            log.error("Make sure USB HID is enabled in boot.py")
+            if self.ble_link is None:
+                microcontroller.reset()
 
-    def check_connection_status(self):
-        """Check and update connection status"""
-        current_time = time.monotonic()
-        
-        # Check connection every 2 seconds
-        if current_time - self.last_connection_check < 2.0:
-            return
+    def restore_link(self):
+        """Bring the HID link back after a sleep"""
+        self.transport.restore(ticks_ms())
+
+    def load_keymap_binary(self):
+        """Open keymap.bin if present and still matching keymap.json.
+
+        Only the header, settings and button index are read; macro steps are
+        read from the open file when a button is pressed. keymap.json is
+        read once to check its CRC-32, so an edit that keeps its size is
+        still noticed.
+        """
+        try:
+            f = open('keymap.bin', 'rb')
+        except OSError:
+            return None
         
-        self.last_connection_check = current_time
+        try:
+            metadata, index, source_size = read_keymap_header(f)
+            try:
+                stale = os.stat('keymap.json')[6] != source_size
+                if not stale:
+                    with open('keymap.json', 'rb') as source:
+                        stale = file_crc32(source) != metadata.get('source_crc')
+            except OSError:
+                stale = False
+            if stale:
+                log.warning("keymap.bin does not match keymap.json - using keymap.json")
+                f.close()
+                return None
+        except Exception as e:
+            log.error("Error loading keymap.bin: %s", e)
+            f.close()
+            return None
         
-        if self.bluetooth_enabled and self.ble:
-            was_connected = self.is_connected
-            self.is_connected = self.ble.connected
-            
-            if not was_connected and self.is_connected:
-                print(f"✅ {self.device_name} Bluetooth connected!")
-                # Stop advertising when connected
-                self.ble.stop_advertising()
-                
-            elif was_connected and not self.is_connected:
-                print(f"❌ {self.device_name} Bluetooth disconnected. Restarting advertising...")
-                # Restart advertising when disconnected
-                try:
-                    advertisement = ProvideServicesAdvertisement(self.hid_service)
-                    advertisement.appearance = 961
-                    advertisement.complete_name = self.device_name
-                    self.ble.start_advertising(advertisement)
-                except Exception as e:
-                    print(f"Failed to restart advertising: {e}")
+        self.keymap_bin = f
+        self.keymap_bin_index = index
+        self.keymap_bin_names = metadata['names']
+        self.keymap_bin_layers = metadata.get('layers', [DEFAULT_BASE_LAYER_NAME])
+        self.keymap_bin_targets = metadata.get('targets') or [None] * len(index)
+        # Per-key debounce overrides are the only button fields still read from self.keymap
+        buttons = {}
+        for button_index, debounce_ms in enumerate(metadata.get('debounce') or ()):
+            if debounce_ms is not None:
+                buttons[str(button_index)] = {'debounce_ms': debounce_ms}
+        log.info("Binary keymap loaded successfully")
+        return {"buttons": buttons, "settings": metadata['settings']}
 
     def load_keymap(self):
+        keymap_data = self.load_keymap_binary()
+        if keymap_data is not None:
+            return keymap_data
+        
+        probe = HeapProbe() if MEM_FREE_AVAILABLE else None
         try:
-            with open('keymap.json', 'r') as f:
-                keymap_data = json.load(f)
-            print("Keymap loaded successfully")
+            # Only macros, names and settings are kept; the file is read in small chunks
+            with open('keymap.json', 'rb') as f:
+                keymap_data = load_keymap_stream(f, probe.sample if probe else None)
+            log.info("Keymap loaded successfully")
+            if probe:
+                log.info("keymap.json heap: peak %d bytes, %d bytes retained", probe.peak(), probe.retained())
             return keymap_data
         except OSError:
-            print("keymap.json not found, creating default...")
+            log.warning("keymap.json not found, creating default...")
             fallback = {
                 "buttons": {str(i): {"name": f"Key{i}", "macro": [{"action": "key", "keys": "Space", "delay": 0}], "description": f"Button {i}"} 
                            for i in range(16)},
@@ -258,12 +1770,12 @@ class KyupadFirmware:
             try:
                 with open('keymap.json', 'w') as f:
                     json.dump(fallback, f)
-                print("Default keymap.json created")
+                log.info("Default keymap.json created")
             except OSError:
-                print("Could not create keymap.json")
+                log.error("Could not create keymap.json")
             return fallback
         except Exception as e:
-            print(f"Error loading keymap: {e}")
+            log.error("Error loading keymap: %s", e)
             return {
                 "buttons": {str(i): {"name": f"Key{i}", "macro": [{"action": "key", "keys": "Space", "delay": 0}], "description": f"Button {i}"} 
                            for i in range(16)},
@@ -276,240 +1788,518 @@ class KyupadFirmware:
                 }
             }
 
-    def parse_macro_array(self, macro_array):
-        if not isinstance(macro_array, list):
-            return self.parse_macro_legacy(macro_array)
+    def compare_keymap_heap(self):
+        """Debug: log the heap keymap.json takes with json.load against the streaming loader"""
+        try:
+            for name in ("json.load", "streaming"):
+                probe = HeapProbe()
+                if name == "json.load":
+                    with open('keymap.json', 'r') as f:
+                        keymap_data = json.load(f)
+                else:
+                    with open('keymap.json', 'rb') as f:
+                        keymap_data = load_keymap_stream(f, probe.sample)
+                peak = probe.peak()
+                retained = probe.retained()
+                keymap_data = None
+                log.info("keymap.json with %s: peak %d bytes, %d bytes retained", name, peak, retained)
+        except Exception as e:
+            log.warning("Keymap heap comparison failed: %s", e)
+
+    def create_scanner(self, backend):
+        """Create the matrix scanner backend selected in settings"""
+        if backend == 'fake':
+            return FakeMatrixScanner(self.debouncer, self.key_events)
         
-        parsed_actions = []
-        for action in macro_array:
-            if not isinstance(action, dict):
-                continue
-                
-            # Support new simple format with keys array
-            if 'keys' in action and isinstance(action['keys'], list):
-                keys_array = action['keys']
-                delay = action.get('delay', 0)
-                
-                # Process each key in the array - only keyboard keys
-                for key in keys_array:
-                    # Check if this is a press/release action
-                    if '_' in key and (key.endswith('_press') or key.endswith('_release')):
-                        key_name, action = key.rsplit('_', 1)
-                        keycode = self.get_keycode(key_name)
-                        if keycode:
-                            parsed_actions.append(('key_action', keycode, action, delay))
-                    else:
-                        # Regular keyboard keys - treat as press+release
-                        keycode = self.get_keycode(key)
-                        if keycode:
-                            parsed_actions.append(('keyboard', keycode, delay))
-                            
-            # Support legacy format with action type
+        if backend == 'keymatrix':
+            if KEYPAD_AVAILABLE:
+                interval_ms = self.settings.get('keymatrix_interval_ms', 5)
+                try:
+                    scanner = KeyMatrixScanner(self.row_pins, self.col_pins, interval_ms,
+                                               self.debouncer, self.key_events)
+                    log.info("Matrix scanner: keypad.KeyMatrix (%sms interval)", interval_ms)
+                    return scanner
+                except Exception as e:
+                    log.warning("keypad.KeyMatrix initialization failed: %s", e)
             else:
-                action_type = action.get('action', 'key')
-                keys = action.get('keys', '')
-                delay = action.get('delay', 0)
-                
-                if action_type == 'key':
-                    parsed = self.parse_macro_legacy(keys)
-                    if parsed:
-                        parsed_actions.append(('key', parsed, delay))
+                log.warning("keypad module not available")
+            log.warning("Falling back to GPIO matrix scanner...")
         
-        return parsed_actions
+        log.info("Matrix scanner: GPIO")
+        return GPIOMatrixScanner(self.row_pins, self.col_pins, self.debouncer, self.key_events)
 
-    def parse_macro_legacy(self, macro_string):
-        if not macro_string:
-            return None
-        
-        parts = macro_string.split('+')
-        modifiers = []
-        key = None
-        
-        for part in parts:
-            part = part.strip()
-            if part == 'Ctrl':
-                modifiers.append(Keycode.CONTROL)
-            elif part == 'Alt':
-                modifiers.append(Keycode.ALT)
-            elif part == 'Shift':
-                modifiers.append(Keycode.SHIFT)
-            elif part == 'Win':
-                modifiers.append(Keycode.GUI)
+    def debounce_ms_per_key(self):
+        """Debounce window for each key; a base layer button may override debounce_ms"""
+        buttons = self.keymap.get('buttons', {})
+        per_key = []
+        for button_index in range(16):
+            button_data = buttons.get(str(button_index), {})
+            per_key.append(button_data.get('debounce_ms', self.debounce_ms))
+        return per_key
+
+    def compile_layers(self):
+        """Compile every layer at boot so a layer switch never compiles or allocates"""
+        if self.keymap_bin is not None:
+            # Steps stay in flash and are read by macro_steps() on each press
+            self.layer_names = self.keymap_bin_layers
+        else:
+            layer_specs = keymap_layers(self.keymap)
+            self.layer_names = [name for name, _ in layer_specs]
+        layers = []
+        for layer_index in range(len(self.layer_names)):
+            probe = HeapProbe() if MEM_FREE_AVAILABLE else None
+            layer = Layer(layer_index, self.layer_names[layer_index])
+            if self.keymap_bin is not None:
+                layer.names = self.keymap_bin_names[layer.base:layer.base + 16]
+                layer.targets = self.keymap_bin_targets[layer.base:layer.base + 16]
             else:
-                key = self.get_keycode(part)
+                buttons = layer_specs[layer_index][1]
+                for button_index in range(16):
+                    button_data = buttons.get(str(button_index))
+                    if button_data is None:
+                        continue
+                    try:
+                        self.compile_button(layer, button_index, button_data)
+                    except ValueError as e:
+                        log.warning("%s button %d not mapped: %s", layer.name, button_index, e)
+                    # Only the compiled steps run, so the JSON form is not kept
+                    button_data.pop('macro', None)
+            self.build_key_messages(layer)
+            if probe:
+                layer.heap_bytes = probe.retained()
+            layers.append(layer)
+        return layers
+
+    def compile_button(self, layer, button_index, button_data):
+        """Compile one button into its layer's tables"""
+        target = button_data.get('layer')
+        if target is not None:
+            target = resolve_layer_target(target, self.layer_names)
+        layer.compiled[button_index] = tuple(compile_macro(button_data.get('macro', []), self.macro_speed,
+                                                           self.min_hold_ms, self.text_cps))
+        layer.names[button_index] = button_data.get('name', f'Button{button_index}')
+        layer.targets[button_index] = target
+
+    def apply_button_delta(self, button_index, button_data, layer_index=0):
+        """Replace one button's mapping in memory, recompiling only that button"""
+        if not 0 <= button_index < 16:
+            raise ValueError(f"No button {button_index}")
+        if not 0 <= layer_index < len(self.layers):
+            raise ValueError(f"No layer {layer_index}")
+        layer = self.layers[layer_index]
+        buttons = self.keymap.setdefault('buttons', {})
+        if button_data is None:
+            if layer_index == 0:
+                buttons.pop(str(button_index), None)
+            # Empty rather than None so a binary keymap's steps are not used either
+            layer.compiled[button_index] = ()
+            layer.names[button_index] = None
+            layer.targets[button_index] = None
+        else:
+            self.compile_button(layer, button_index, button_data)
+            if layer_index == 0:
+                # Same fields a loaded button keeps after compile_layers()
+                kept = {'name': layer.names[button_index]}
+                if 'debounce_ms' in button_data:
+                    kept['debounce_ms'] = button_data['debounce_ms']
+                buttons[str(button_index)] = kept
+                self.debouncer.debounce_ms[button_index] = kept.get('debounce_ms', self.debounce_ms)
+        self.build_key_messages(layer)
+        log.info("%s: %s button %d updated live", self.device_name, layer.name, button_index)
+
+    def select_layer(self, target):
+        """Switch to a layer given by name or number, e.g. from the host"""
+        if isinstance(target, str) and target.isdigit():
+            target = int(target)
+        target = resolve_layer_target(target, self.layer_names)
+        # Timed here rather than in switch_layer(), which layer keys call from the allocation-free key path
+        if _STATS:
+            start_ns = time.monotonic_ns()
+        self.switch_layer(target)
+        if _STATS:
+            self.stats.layer_switch_us.record((time.monotonic_ns() - start_ns) // 1000)
+
+    def switch_layer(self, target):
+        """Make a precompiled layer current: a layer number, LAYER_NEXT or LAYER_PREV"""
+        if target == LAYER_NEXT:
+            target = (self.layer.index + 1) % len(self.layers)
+        elif target == LAYER_PREV:
+            target = (self.layer.index - 1) % len(self.layers)
+        self.layer = self.layers[target]
+        log.info(self.layer.switch_message)
+
+    def validate_settings_delta(self, delta):
+        """Raise ValueError unless every live setting in delta has a usable value"""
+        if not isinstance(delta, dict):
+            raise ValueError("Settings delta is not an object")
+        for key in ('log_level', 'log_ring_level'):
+            if key in delta and delta[key] not in LOG_LEVELS:
+                raise ValueError(f"Unknown {key} {delta[key]}")
+        for key in ('debounce_ms', 'gc_idle_ms'):
+            if key in delta:
+                value = delta[key]
+                if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                    raise ValueError(f"{key} must be a whole number of ms, not {value}")
+
+    def apply_settings_delta(self, delta):
+        """Merge changed settings; STATUS_RESTART if some only apply after a restart.
+
+        The whole delta is validated before anything is merged, so a rejected
+        delta changes nothing and is never persisted.
+        """
+        self.validate_settings_delta(delta)
+        self.settings.update(delta)
+        status = STATUS_OK
+        for key in delta:
+            if key not in LIVE_SETTINGS:
+                status = STATUS_RESTART
+        if 'log_level' in delta or 'log_ring_level' in delta:
+            self.apply_log_settings()
+        if 'debounce_ms' in delta:
+            self.debounce_ms = delta['debounce_ms']
+            self.debouncer.debounce_ms = self.debounce_ms_per_key()
+        if 'gc_idle_ms' in delta:
+            self.gc_idle_ms = delta['gc_idle_ms']
+        log.info("%s: settings updated live: %s", self.device_name, ", ".join(delta))
+        return status
+
+    def persist_delta(self, frame_type, delta):
+        """Write a live change into keymap.json, dropping keymap.bin first so no boot pairs the two"""
+        self.drop_keymap_binary()
+        with open('keymap.json', 'r') as f:
+            keymap_data = json.load(f)
+        if frame_type == FRAME_BUTTON:
+            layer_index = delta.get('layer', 0)
+            if layer_index:
+                buttons = keymap_data['layers'][layer_index - 1].setdefault('buttons', {})
+            else:
+                buttons = keymap_data.setdefault('buttons', {})
+            if delta.get('data') is None:
+                buttons.pop(str(delta['button']), None)
+            else:
+                buttons[str(delta['button'])] = delta['data']
+        elif frame_type == FRAME_LAYER:
+            keymap_data.setdefault('settings', {})['default_layer'] = delta['layer']
+        else:
+            keymap_data.setdefault('settings', {}).update(delta)
+        with open('keymap.json', 'w') as f:
+            json.dump(keymap_data, f)
+
+    def build_key_messages(self, layer):
+        """Format a layer's log lines once so key presses do not build strings"""
+        if self.ble_link is None:
+            connection_type = "USB"
+        elif self.usb_device is None:
+            connection_type = "BT"
+        else:
+            connection_type = "USB+BT"
+        layer.switch_message = f"{self.device_name}: layer {layer.name}"
+        for button_index in range(16):
+            name = layer.names[button_index]
+            if name is None:
+                layer.press_messages[button_index] = f"{self.device_name}: Unknown button {button_index} pressed"
+                layer.release_messages[button_index] = None
+                continue
+            layer.press_messages[button_index] = f"[{self.device_name}-{connection_type}] Key pressed: {name} (Button {button_index})"
+            layer.release_messages[button_index] = f"[{self.device_name}] Key released: {name} (Button {button_index})"
+
+    def drop_keymap_binary(self):
+        """Read the steps still in keymap.bin into memory, then close and delete it.
+
+        The file is deleted only once it is closed, which FAT needs.
+        """
+        if self.keymap_bin is not None:
+            for layer in self.layers:
+                for button_index in range(16):
+                    if layer.compiled[button_index] is None:
+                        layer.compiled[button_index] = self.macro_steps(layer.base + button_index)
+            self.keymap_bin.close()
+            self.keymap_bin = None
+            self.keymap_bin_index = None
+            log.info("keymap.bin dropped, macros now run from memory")
+        try:
+            os.remove('keymap.bin')
+        except OSError:
+            pass
+
+    def macro_steps(self, button_index):
+        """Compiled steps for layer * 16 + button; binary keymaps are read from flash on demand"""
+        steps = self.layers[button_index >> 4].compiled[button_index & 15]
+        # With keymap.bin only buttons changed live are compiled in memory
+        if steps is not None or self.keymap_bin is None:
+            return steps
+        offset, count = self.keymap_bin_index[button_index]
+        if not offset:
+            return None
+        return read_button_steps(self.keymap_bin, offset, count)
+
+    def scan_matrix(self):
+        now_ms = ticks_ms()
         
-        if key is not None:
-            return ('keyboard', modifiers, key)
+        # Measure the real scan period over batches of scans; a tier change starts a new batch
+        tier = self.scan_governor.tier
+        if tier != self.scan_window_tier:
+            self.scan_window_tier = tier
+            self.scan_window_start = now_ms
+            self.scan_count = 0
+        self.scan_count += 1
+        if self.scan_count == 1000:
+            # 1000 scans in ms is the period of one in us
+            self.scan_period_us[tier] = (now_ms - self.scan_window_start) & TICKS_MASK
+            self.scan_window_start = now_ms
+            self.scan_count = 0
         
-        return None
+        self.scanner.scan(now_ms)
 
-    def get_keycode(self, key_string):
-        key_map = {
-            'A': Keycode.A, 'B': Keycode.B, 'C': Keycode.C, 'D': Keycode.D,
-            'E': Keycode.E, 'F': Keycode.F, 'G': Keycode.G, 'H': Keycode.H,
-            'I': Keycode.I, 'J': Keycode.J, 'K': Keycode.K, 'L': Keycode.L,
-            'M': Keycode.M, 'N': Keycode.N, 'O': Keycode.O, 'P': Keycode.P,
-            'Q': Keycode.Q, 'R': Keycode.R, 'S': Keycode.S, 'T': Keycode.T,
-            'U': Keycode.U, 'V': Keycode.V, 'W': Keycode.W, 'X': Keycode.X,
-            'Y': Keycode.Y, 'Z': Keycode.Z,
-            'Tab': Keycode.TAB, 'Space': Keycode.SPACE, 'Enter': Keycode.ENTER,
-            'Escape': Keycode.ESCAPE, 'Backspace': Keycode.BACKSPACE,
-            'Delete': Keycode.DELETE, 'Home': Keycode.HOME, 'End': Keycode.END,
-            'PageUp': Keycode.PAGE_UP, 'PageDown': Keycode.PAGE_DOWN,
-            'F1': Keycode.F1, 'F2': Keycode.F2, 'F3': Keycode.F3, 'F4': Keycode.F4,
-            'F5': Keycode.F5, 'F6': Keycode.F6, 'F7': Keycode.F7, 'F8': Keycode.F8,
-            'F9': Keycode.F9, 'F10': Keycode.F10, 'F11': Keycode.F11, 'F12': Keycode.F12,
-            '0': Keycode.ZERO, '1': Keycode.ONE, '2': Keycode.TWO, '3': Keycode.THREE,
-            '4': Keycode.FOUR, '5': Keycode.FIVE, '6': Keycode.SIX, '7': Keycode.SEVEN,
-            '8': Keycode.EIGHT, '9': Keycode.NINE,
-            # Modifier keys
-            'Ctrl': Keycode.CONTROL,
-            'Alt': Keycode.ALT,
-            'Shift': Keycode.SHIFT,
-            'Win': Keycode.GUI
-        }
-        
-        return key_map.get(key_string, None)
+    def dispatch_key_events(self):
+        """Consume debounced key transitions from the key event ring"""
+        events = self.key_events
+        while events.count:
+            tail = events.tail
+            key = events.keys[tail]
+            edge = events.edges[tail]
+            timestamp_ms = events.times[tail]
+            events.advance()
+            self.dispatch_key_event(key, edge == EDGE_PRESS, timestamp_ms)
 
-    def scan_matrix(self):
-        current_time = time.monotonic()
+    def dispatch_key_event(self, key, pressed, timestamp_ms):
+        """Route a debounced key event from any scanner backend"""
+        self.last_activity = ticks_ms()
+        self.scan_governor.note_activity(self.last_activity)
+        self.idle_collected = False
+        if pressed:
+            self.keys_down += 1
+            self.handle_key_press(key // 4, key % 4, timestamp_ms)
+        else:
+            self.keys_down = max(0, self.keys_down - 1)
+            self.handle_key_release(key // 4, key % 4, timestamp_ms)
+
+    def handle_key_press(self, row, col, press_ms):
+        button_index = row * 4 + col
+        layer = self.layer
+        self.press_layers[button_index] = layer.index
         
-        if current_time - self.last_scan_time < self.debounce_delay:
+        # Layer keys act on the pad itself, host or not
+        target = layer.targets[button_index]
+        if target is not None:
+            self.switch_layer(target)
+            self.layer_key_switches += 1
             return
         
-        # Update status LED (ESP32-S3 feature)
-        self.update_status_led()
-        
-        for row_idx in range(4):
-            self.rows[row_idx].value = True
-            # Shorter delay for ESP32-S3 (faster GPIO)
-            time.sleep(0.00005)  # 50μs instead of 100μs
-            
-            for col_idx in range(4):
-                pressed = not self.cols[col_idx].value
-                
-                if pressed != self.key_states[row_idx][col_idx]:
-                    self.key_states[row_idx][col_idx] = pressed
-                    
-                    if pressed:
-                        self.handle_key_press(row_idx, col_idx)
+        # No host attached: hold the press for the next one (BLE) or skip it
+        if not self.is_connected:
+            if self.ble_link is None or not self.ble_link.buffer_press(layer.base + button_index, ticks_ms()):
+                log.info(self.not_connected_message)
+            return
             
-            self.rows[row_idx].value = False
+        log.info(layer.press_messages[button_index])
         
-        self.last_scan_time = current_time
-
-    def handle_key_press(self, row, col):
-        # Skip if not connected (for Bluetooth mode)
-        if self.bluetooth_enabled and not self.is_connected:
-            print(f"{self.device_name}: Not connected - ignoring key press")
-            return
+        if layer.names[button_index] is not None:
+            # Brief LED flash on key press, timed by update_status_led()
+            if self.status_led:
+                self.status_led.flash(ticks_ms())
             
+            if not self.macro_scheduler.submit(layer.base + button_index, press_ms):
+                log.warning(self.queue_full_message)
+
+    def handle_key_release(self, row, col, release_ms):
         button_index = row * 4 + col
-        button_key = str(button_index)
+        message = self.layers[self.press_layers[button_index]].release_messages[button_index]
+        if message is not None:
+            log.info(message)
+
+    def collect_garbage_when_idle(self):
+        """Run gc.collect() in an idle window instead of letting it land mid-keypress"""
+        if self.idle_collected or self.keys_down or self.macro_scheduler.busy:
+            return
+        if (ticks_ms() - self.last_activity) & TICKS_MASK < self.gc_idle_ms:
+            return
+        gc.collect()
+        self.idle_collected = True
+
+    def scan_and_dispatch_checked(self):
+        """Debug mode: scan and dispatch, asserting the pair leaves gc.mem_free() unchanged.
+
+        Key presses, releases and layer keys are covered. Macro playback
+        runs later in the loop on the monotonic_ns() timeline, which
+        allocates on CircuitPython, and is not part of the check.
+        """
+        free_before = gc.mem_free()
+        self.scan_matrix()
+        self.dispatch_key_events()
+        self.alloc_check_bytes += free_before - gc.mem_free()
+        self.alloc_check_count += 1
+        if self.alloc_check_count < self.alloc_check_scans:
+            return
         
-        if button_key in self.keymap.get('buttons', {}):
-            button_data = self.keymap['buttons'][button_key]
-            macro = button_data.get('macro', [])
-            name = button_data.get('name', f'Button{button_index}')
-            
-            connection_type = "BT" if self.bluetooth_enabled else "USB"
-            print(f"[{self.device_name}-{connection_type}] Key pressed: {name} (Button {button_index})")
-            
-            # Brief LED flash on key press (ESP32-S3 feature)
-            if self.status_led and self.is_connected:
-                self.status_led.value = False
-                time.sleep(0.05)
-                self.status_led.value = True
-            
-            self.execute_macro(macro)
-        else:
-            print(f"{self.device_name}: Unknown button {button_index} pressed")
-
-    def execute_macro(self, macro):
-        if isinstance(macro, list):
-            parsed_actions = self.parse_macro_array(macro)
-            for action_tuple in parsed_actions:
-                if len(action_tuple) >= 3:
-                    action_type = action_tuple[0]
-                    
-                    # Extract delay - could be at different positions depending on action type
-                    if len(action_tuple) == 4 and action_type == 'key_action':
-                        _, keycode, press_release, delay = action_tuple
-                    else:
-                        delay = action_tuple[-1]  # Last element is always delay
-                    
-                    if delay > 0:
-                        time.sleep((delay / 1000.0) / self.macro_speed)
-                    
-                    try:
-                        if action_type == 'key':
-                            self.execute_keyboard_action(action_tuple[1])
-                        elif action_type == 'keyboard':
-                            # New simple format - single key press+release
-                            self.keyboard.press(action_tuple[1])
-                            time.sleep(0.01)
-                            self.keyboard.release_all()
-                        elif action_type == 'key_action':
-                            # Press/release action
-                            _, keycode, press_release, delay = action_tuple
-                            if press_release == 'press':
-                                self.keyboard.press(keycode)
-                            elif press_release == 'release':
-                                self.keyboard.release(keycode)
-                    except Exception as e:
-                        print(f"{self.device_name}: Error executing macro action: {e}")
-        else:
-            parsed = self.parse_macro_legacy(macro)
-            if parsed:
-                self.execute_keyboard_action(parsed)
-
-    def execute_keyboard_action(self, parsed_action):
-        if parsed_action[0] == 'keyboard':
-            modifiers = parsed_action[1]
-            key = parsed_action[2]
-            
-            if modifiers:
-                self.keyboard.press(*modifiers, key)
-                time.sleep(0.01)
-                self.keyboard.release_all()
+        allocated = self.alloc_check_bytes
+        self.alloc_check_count = 0
+        self.alloc_check_bytes = 0
+        assert allocated == 0, f"Scan and dispatch allocated {allocated} bytes over {self.alloc_check_scans} scans"
+
+    def send_macro_step(self, op, keycode):
+        try:
+            if op == OP_PRESS:
+                self.keyboard.press(keycode)
+            elif op == OP_RELEASE:
+                self.keyboard.release(keycode)
             else:
-                self.keyboard.press(key)
-                time.sleep(0.01)
                 self.keyboard.release_all()
+        except Exception as e:
+            log.error("%s: Error executing macro action: %s", self.device_name, e)
+
+    def flush_report(self):
+        try:
+            if self.keyboard.flush() and self.power_manager.measuring_wake:
+                self.power_manager.note_report()
+        except Exception as e:
+            log.error("%s: Error sending HID report: %s", self.device_name, e)
+            # The host may be gone; the unsent report goes to the next transport
+            self.transport.recheck()
+
+    def check_serial_commands(self, now_ms):
+        """Read commands typed on the USB serial console, one per line"""
+        if (now_ms - self.last_serial_check) & TICKS_MASK < SERIAL_POLL_INTERVAL_MS:
+            return
+        self.last_serial_check = now_ms
+        while supervisor.runtime.serial_bytes_available:
+            char = sys.stdin.read(1)
+            if char == "\r" or char == "\n":
+                command = self.serial_line.strip()
+                self.serial_line = ""
+                if command:
+                    self.handle_serial_command(command)
+            elif len(self.serial_line) < 32:
+                self.serial_line += char
+
+    def handle_serial_command(self, command):
+        # Command replies are printed directly; they are the output the user asked for
+        if _STATS and command == "stats":
+            self.print_stats()
+        elif _STATS and command == "stats reset":
+            self.stats.reset()
+            print("Stats reset")
+        elif command == "log":
+            log.dump()
+        elif command.startswith("log ") and command[4:] in LOG_LEVELS:
+            log.set_levels(LOG_LEVELS[command[4:]], log.ring_level)
+            print(f"Log level: {command[4:]}")
+        elif command == "layer":
+            print(f"Layer: {self.layer.name} ({', '.join(self.layer_names)})")
+        elif command.startswith("layer "):
+            try:
+                self.select_layer(command[6:])
+                print(f"Layer: {self.layer.name}")
+            except ValueError as e:
+                print(e)
+        else:
+            print(f"Unknown command: {command} (try 'stats', 'stats reset', 'log', 'log <level>', "
+                  f"'layer' or 'layer <name>')")
+
+    def print_stats(self):
+        self.stats.report()
+        self.macro_scheduler.report()
+        self.scan_governor.report()
+        for line in self.boot_timer.summary():
+            print(line)
+        self.transport.report()
+        if self.ble_link is not None:
+            self.ble_link.report()
+        if self.live_link is not None:
+            self.live_link.report()
+        layers = ", ".join([f"{layer.name} {layer.heap_bytes}B" for layer in self.layers])
+        print(f"Layer: {self.layer.name}, layer key switches: {self.layer_key_switches}, compiled layers: {layers}")
+        periods = ", ".join([f"{TIER_NAMES[tier]} {self.scan_period_us[tier]}us" for tier in range(3)])
+        print(f"Key events dropped: {self.key_events.dropped}, scan period: {periods}, "
+              f"scan tier: {TIER_NAMES[self.scan_governor.tier]}")
 
     def run(self):
-        print(f"{self.device_name} started - scanning for key presses...")
-        print("Matrix scan active...")
-        print("ESP32-S3 optimized firmware running...")
+        log.info("%s started - scanning for key presses...", self.device_name)
+        log.info("Matrix scan active...")
+        log.info("ESP32-S3 optimized firmware running...")
         
-        if self.bluetooth_enabled:
-            print(f"🔵 {self.device_name} Bluetooth mode - waiting for device pairing...")
+        if self.ble_link is not None and self.usb_device is not None:
+            log.info("🔀 %s Auto mode - USB when enumerated, Bluetooth otherwise", self.device_name)
+        elif self.ble_link is not None:
+            log.info("🔵 %s Bluetooth mode - waiting for device pairing...", self.device_name)
         else:
-            print(f"🔌 {self.device_name} USB mode - ready for input")
+            log.info("🔌 %s USB mode - ready for input", self.device_name)
+        
+        scan_report_pending = True
         
-        # Initialize LED counter for ESP32-S3
-        if not hasattr(self, 'led_blink_counter'):
-            self.led_blink_counter = 0
+        # First scan completes the boot timing
+        self.scan_matrix()
+        self.boot_timer.mark("first scan")
+        self.boot_timer.report()
+        loop_start_ns = 0
         
         while True:
             try:
-                # Check connection status periodically
-                if self.bluetooth_enabled:
-                    self.check_connection_status()
+                if _STATS:
+                    # Idle passes are not timed, so they allocate nothing between key presses
+                    timing = not self.idle_collected
+                    if timing:
+                        now_ns = time.monotonic_ns()
+                        if loop_start_ns:
+                            self.stats.loop_us.record((now_ns - loop_start_ns) // 1000)
+                        loop_start_ns = now_ns
+                    else:
+                        loop_start_ns = 0
+                if SUPERVISOR_AVAILABLE:
+                    self.check_serial_commands(ticks_ms())
+                
+                # Follow USB enumeration and the BLE link, switching hosts as they come and go
+                self.transport.poll(ticks_ms())
+                
+                # Keymap changes pushed from the editor, applied between scans
+                if self.live_link is not None:
+                    self.live_link.poll(ticks_ms())
                 
                 # Scan matrix for key presses
-                self.scan_matrix()
+                if _STATS and timing:
+                    scan_start_ns = time.monotonic_ns()
+                if self.alloc_check_scans:
+                    self.scan_and_dispatch_checked()
+                else:
+                    self.scan_matrix()
+                    self.dispatch_key_events()
+                if _STATS and timing:
+                    self.stats.scan_us.record((time.monotonic_ns() - scan_start_ns) // 1000)
+                
+                # Send any macro steps that are due; they wait while no host is attached
+                if self.macro_scheduler.busy:
+                    if self.is_connected:
+                        self.macro_scheduler.service(time.monotonic_ns())
+                else:
+                    self.collect_garbage_when_idle()
+                
+                # Status LED effects run on their own clock, never in the input path
+                if self.status_led:
+                    self.update_status_led(ticks_ms())
+                    if self.battery_sense is not None:
+                        self.check_battery(ticks_ms())
+                
+                # Report the measured scan period once the first batch is measured
+                if scan_report_pending and self.scan_period_us[TIER_FULL]:
+                    scan_report_pending = False
+                    log.info("Measured full-rate scan period: %dus (press latency bound while active)",
+                             self.scan_period_us[TIER_FULL])
                 
-                # Faster scan rate for ESP32-S3 (dual-core advantage)
-                time.sleep(0.0005)  # 500μs instead of 1ms
+                # Full scan rate after activity, slower tiers while idle
+                busy = self.keys_down or self.macro_scheduler.busy
+                self.power_manager.check(ticks_ms(), self.last_activity, busy)
+                time.sleep(self.scan_governor.update(ticks_ms(), self.last_activity, busy))
                 
             except KeyboardInterrupt:
-                print(f"{self.device_name} firmware stopped by user")
+                log.info("%s firmware stopped by user", self.device_name)
                 if self.status_led:
-                    self.status_led.value = False
+                    self.status_led.off()
                 break
             except Exception as e:
-                print(f"{self.device_name}: Error in main loop: {e}")
+                log.error("%s: Error in main loop: %s", self.device_name, e)
+                if _STATS:
+                    self.stats.exceptions += 1
+                self.macro_scheduler.cancel()
                 time.sleep(0.1)
                 gc.collect()
 
@@ -519,7 +2309,7 @@ if __name__ == "__main__":
         kyupad.run()
         
     except Exception as e:
-        print(f"Failed to start Kyupad firmware: {e}")
+        log.error("Failed to start Kyupad firmware: %s", e)
         import traceback
         traceback.print_exception(type(e), e, e.__traceback__)
         microcontroller.reset()
\ No newline at end of file